@@ -0,0 +1,119 @@
+# This file is part of Tryton & Nereid. The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""
+Throughput of rendering and queueing emails one at a time with
+render_email against doing it in bulk with queue_emails.
+
+    python benchmarks/bulk_email.py [count] [processes]
+"""
+import os
+import sys
+from time import time
+
+os.environ.setdefault('TRYTOND_DATABASE_URI', 'sqlite://')
+os.environ.setdefault('DB_NAME', ':memory:')
+
+import jinja2  # noqa
+import trytond.tests.test_tryton  # noqa
+from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT  # noqa
+from trytond.transaction import Transaction  # noqa
+from nereid import render_email, queue_emails  # noqa
+from nereid.testing import get_app  # noqa
+
+TEMPLATES = {
+    'bench-text.jinja': (
+        'Hello {{ name }},\n'
+        '{% for item in items %}{{ item }} costs {{ price }}\n{% endfor %}'
+    ),
+    'bench-html.jinja': (
+        '<p>Hello {{ name }},</p><ul>'
+        '{% for item in items %}<li>{{ item }}: {{ price }}</li>'
+        '{% endfor %}</ul>'
+    ),
+}
+
+
+def setup():
+    Currency = POOL.get('currency.currency')
+    Party = POOL.get('party.party')
+    Company = POOL.get('company.company')
+    Website = POOL.get('nereid.website')
+    WebsiteLocale = POOL.get('nereid.website.locale')
+    Language = POOL.get('ir.lang')
+
+    usd, = Currency.create([{'name': 'USD', 'code': 'USD', 'symbol': '$'}])
+    party, = Party.create([{'name': 'Openlabs'}])
+    company, = Company.create([{'party': party, 'currency': usd}])
+    en_us, = Language.search([('code', '=', 'en_US')])
+    locale, = WebsiteLocale.create([{
+        'code': 'en_US', 'language': en_us, 'currency': usd,
+    }])
+    Website.create([{
+        'name': 'localhost',
+        'company': company,
+        'application_user': USER,
+        'default_locale': locale,
+    }])
+
+
+def run(count, processes):
+    EmailQueue = POOL.get('email.queue')
+    app = get_app(TEMPLATE_PREFIX_WEBSITE_NAME=False)
+    app.jinja_loader._loaders.insert(0, jinja2.DictLoader(TEMPLATES))
+
+    recipients = [
+        ('user%d@example.com' % i, {'name': 'User %d' % i})
+        for i in xrange(count)
+    ]
+    shared = {'items': ['Item %d' % i for i in xrange(10)], 'price': '$10'}
+
+    with app.test_request_context('/'):
+        start = time()
+        for to, context in recipients:
+            context = dict(shared, **context)
+            message = render_email(
+                'sender@example.com', to, 'Newsletter',
+                text_template='bench-text.jinja',
+                html_template='bench-html.jinja', **context
+            )
+            EmailQueue.queue_mail(
+                'sender@example.com', to, message.as_string()
+            )
+        report('render_email', count, time() - start)
+
+        start = time()
+        queue_emails(
+            'sender@example.com', recipients, 'Newsletter',
+            text_template='bench-text.jinja',
+            html_template='bench-html.jinja', **shared
+        )
+        report('queue_emails', count, time() - start)
+
+        if processes:
+            start = time()
+            queue_emails(
+                'sender@example.com', recipients, 'Newsletter',
+                text_template='bench-text.jinja',
+                html_template='bench-html.jinja', processes=processes,
+                **shared
+            )
+            report(
+                'queue_emails (%d processes)' % processes, count,
+                time() - start
+            )
+
+
+def report(name, count, elapsed):
+    print '%-30s %6d messages in %7.3fs, %8.1f messages/s' % (
+        name, count, elapsed, count / elapsed
+    )
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    processes = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    trytond.tests.test_tryton.install_module('nereid')
+    with Transaction().start(DB_NAME, USER, CONTEXT):
+        setup()
+        run(count, processes)
+        Transaction().cursor.rollback()
@@ -0,0 +1,101 @@
+# This file is part of Tryton & Nereid. The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""
+Size of the stored values and time per get and set of typical cached
+values with the cache codecs, against the values pickled by the backend.
+
+    python benchmarks/cache_codecs.py [iterations] [memcached server]
+
+Without a memcached server, a SimpleCache is used as the backend, which
+pickles the values again, so the times are only comparable to each other.
+"""
+import sys
+from time import time
+from decimal import Decimal
+from datetime import datetime
+
+try:
+    import cPickle as pickle
+except ImportError:  # pragma: no cover
+    import pickle
+
+from werkzeug.contrib.cache import SimpleCache, MemcachedCache
+from nereid.cache_codecs import CacheCodec
+from nereid.cache_backends import CodecCache
+
+VALUES = {
+    'session': {
+        '_fresh': True, 'user_id': 42, 'csrf_token': 'a' * 40,
+        'cart': 1042, 'messages': [('info', u'Item added to cart')],
+    },
+    'rows': [
+        {
+            'id': i, 'name': u'Product %d' % i, 'code': 'P%05d' % i,
+            'price': 10.5 * i, 'active': True, 'categories': [1, 2, 3],
+        } for i in xrange(200)
+    ],
+    'records': [
+        {
+            'id': i, 'price': Decimal('10.50'),
+            'write_date': datetime(2015, 1, 1, 10, 0, i % 60),
+        } for i in xrange(200)
+    ],
+    'fragment': ''.join(
+        '<div class="product"><a href="/product/p%05d">Product %d</a>'
+        '<span class="price">$%d.50</span></div>\n' % (i, i, i)
+        for i in xrange(200)
+    ),
+}
+
+CODECS = [
+    ('pickle', {'codec': 'pickle', 'compress_threshold': None}),
+    ('pickle+zlib', {'codec': 'pickle', 'compress_threshold': 1024}),
+    ('marshal', {'codec': 'marshal', 'compress_threshold': None}),
+    ('marshal+zlib', {'codec': 'marshal', 'compress_threshold': 1024}),
+]
+
+
+def measure(cache, value, iterations):
+    start = time()
+    for i in xrange(iterations):
+        cache.set('bench-codec', value)
+    set_time = (time() - start) / iterations
+
+    start = time()
+    for i in xrange(iterations):
+        cache.get('bench-codec')
+    get_time = (time() - start) / iterations
+    return set_time, get_time
+
+
+def run(iterations, servers):
+    def make_backend():
+        if servers:
+            return MemcachedCache(servers)
+        return SimpleCache()
+
+    print '%-10s %-14s %9s %11s %11s' % (
+        'value', 'codec', 'bytes', 'set (us)', 'get (us)'
+    )
+    for name, value in sorted(VALUES.items()):
+        size = len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        set_time, get_time = measure(make_backend(), value, iterations)
+        report(name, 'backend', size, set_time, get_time)
+
+        for codec_name, options in CODECS:
+            size = len(CacheCodec(**options).dumps(value))
+            cache = CodecCache(make_backend(), **options)
+            set_time, get_time = measure(cache, value, iterations)
+            report(name, codec_name, size, set_time, get_time)
+
+
+def report(name, codec, size, set_time, get_time):
+    print '%-10s %-14s %9d %11.1f %11.1f' % (
+        name, codec, size, set_time * 1e6, get_time * 1e6
+    )
+
+
+if __name__ == '__main__':
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    servers = sys.argv[2:]
+    run(iterations, servers)
@@ -0,0 +1,88 @@
+# This file is part of Tryton & Nereid. The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""
+Latency of getting and saving sessions with the memcached session store
+against the SQLite session store.
+
+    python benchmarks/session_stores.py [count] [memcached server]
+
+Without a memcached server, the memcached store uses a SimpleCache, which
+only measures the overhead of the store.
+"""
+import os
+import sys
+import shutil
+import tempfile
+from time import time
+
+os.environ.setdefault('TRYTOND_DATABASE_URI', 'sqlite://')
+os.environ.setdefault('DB_NAME', ':memory:')
+
+import trytond.tests.test_tryton  # noqa
+from trytond.tests.test_tryton import USER, DB_NAME, CONTEXT  # noqa
+from trytond.transaction import Transaction  # noqa
+from nereid.sessions import MemcachedSessionStore, SQLiteSessionStore  # noqa
+from nereid.testing import get_app  # noqa
+
+
+def measure(store, count):
+    sessions = []
+    for i in xrange(count):
+        session = store.new()
+        session.update({
+            'user_id': i, '_fresh': True, 'csrf_token': 'a' * 40,
+            'cart': i, 'messages': [],
+        })
+        sessions.append(session)
+
+    start = time()
+    for session in sessions:
+        store.save(session)
+    save_time = (time() - start) / count
+
+    start = time()
+    for session in sessions:
+        store.get(session.sid)
+    get_time = (time() - start) / count
+    return save_time, get_time
+
+
+def run(count, servers):
+    if servers:
+        app = get_app(
+            CACHE_TYPE='werkzeug.contrib.cache.MemcachedCache',
+            CACHE_MEMCACHED_SERVERS=servers,
+        )
+    else:
+        app = get_app(
+            CACHE_TYPE='werkzeug.contrib.cache.SimpleCache',
+            CACHE_THRESHOLD=count * 2,
+        )
+
+    print '%-30s %12s %12s' % ('store', 'save (us)', 'get (us)')
+    with app.app_context():
+        report(
+            'memcached' if servers else 'memcached (SimpleCache)',
+            *measure(MemcachedSessionStore(), count)
+        )
+
+    directory = tempfile.mkdtemp()
+    try:
+        store = SQLiteSessionStore(
+            os.path.join(directory, 'sessions.db'), sweep_interval=None
+        )
+        report('sqlite', *measure(store, count))
+    finally:
+        shutil.rmtree(directory)
+
+
+def report(name, save_time, get_time):
+    print '%-30s %12.1f %12.1f' % (name, save_time * 1e6, get_time * 1e6)
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    servers = sys.argv[2:]
+    trytond.tests.test_tryton.install_module('nereid')
+    with Transaction().start(DB_NAME, USER, CONTEXT):
+        run(count, servers)
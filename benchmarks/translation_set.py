@@ -0,0 +1,89 @@
+# This file is part of Tryton & Nereid. The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""
+Time taken by the TranslationSet wizard to find the missing translations of
+a synthetic module with 10k template strings, against a search for each
+string as the wizard used to do.
+
+    python benchmarks/translation_set.py [count]
+"""
+import os
+import sys
+from time import time
+
+os.environ.setdefault('TRYTOND_DATABASE_URI', 'sqlite://')
+os.environ.setdefault('DB_NAME', ':memory:')
+
+import trytond.tests.test_tryton  # noqa
+from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT  # noqa
+from trytond.transaction import Transaction  # noqa
+
+
+def get_messages(count):
+    def messages():
+        for i in xrange(count):
+            yield (
+                'synthetic', 'template-%d.jinja' % (i % 100), i, '_',
+                u'Synthetic message %d' % i, []
+            )
+    return messages
+
+
+def search_each(count):
+    """
+    The lookups of the wizard before the diffing in memory
+    """
+    Translation = POOL.get('ir.translation')
+    missing = 0
+    for module, template, lineno, function, message, comments in \
+            get_messages(count)():
+        if not Translation.search([
+                ('lang', '=', 'en_US'),
+                ('type', '=', 'nereid_template'),
+                ('name', '=', template),
+                ('src', '=', message),
+                ('module', '=', module),
+                ('res_id', '=', lineno),
+                ], limit=1):
+            missing += 1
+    return missing
+
+
+def run(count):
+    TranslationSet = POOL.get('ir.translation.set', type='wizard')
+    Translation = POOL.get('ir.translation')
+
+    session_id, _, _ = TranslationSet.create()
+    wizard = TranslationSet(session_id)
+    wizard._get_nereid_template_messages = get_messages(count)
+
+    print '%-40s %10s' % ('step', 'time (s)')
+    start = time()
+    wizard.set_nereid_template()
+    report('create %d strings' % count, time() - start)
+
+    start = time()
+    wizard.set_nereid_template()
+    report('diff %d existing strings' % count, time() - start)
+
+    start = time()
+    search_each(count)
+    report('search each of %d strings' % count, time() - start)
+
+    Translation.delete(Translation.search([
+        ('module', '=', 'synthetic'),
+    ], limit=count / 10))
+    start = time()
+    wizard.set_nereid_template()
+    report('diff and create 10% missing', time() - start)
+
+
+def report(name, elapsed):
+    print '%-40s %10.3f' % (name, elapsed)
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    trytond.tests.test_tryton.install_module('nereid')
+    with Transaction().start(DB_NAME, USER, CONTEXT):
+        run(count)
@@ -18,4 +18,5 @@ from .helpers import flash, get_flashed_messages, url_for, \
 from .application import Nereid, Request, Response
 from .sessions import Session
 from .globals import cache, current_user
-from .templating import render_template, render_email, LazyRenderer
+from .templating import render_template, render_email, LazyRenderer, \
+    render_cached_template, render_emails, queue_emails
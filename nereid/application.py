@@ -6,15 +6,17 @@ from __future__ import with_statement
 import os  # noqa
 import warnings
 import inspect
+from time import time
+from collections import OrderedDict
 
 from flask import Flask
 from flask.config import ConfigAttribute
 from flask.globals import _request_ctx_stack, current_app
 from flask.helpers import locked_cached_property
-from jinja2 import MemcachedBytecodeCache
+from jinja2 import MemcachedBytecodeCache, TemplateNotFound, \
+    TemplateSyntaxError
 from werkzeug import import_string, abort
 import flask.ext.login
-from flask.ext.login import LoginManager
 from flask.ext.babel import Babel
 
 from trytond import backend
@@ -27,13 +29,21 @@ from trytond.transaction import Transaction
 
 from .wrappers import Request, Response
 from .session import NereidSessionInterface
+from .sessions import NereidLoginManager
 from .templating import nereid_default_template_ctx_processor, \
-    NEREID_TEMPLATE_FILTERS, ModuleTemplateLoader, LazyRenderer
+    NEREID_TEMPLATE_FILTERS, ModuleTemplateLoader, LazyRenderer, \
+    find_template_variables
 from .helpers import url_for, root_transaction_if_required
 from .ctx import RequestContext
 from .csrf import NereidCsrfProtect
 from .signals import transaction_start, transaction_stop
 from .routing import Rule
+from .cache_tags import CacheTagStore, bump_pending_cache_tags
+from .request_cache import flush_request_cache
+from .cache_backends import CodecCache
+from .cache_stats import InstrumentedCache, cache_stats_view
+from .globals import cache
+from .profiling import ProfilingTemplate, add_profile_header
 
 
 class Nereid(Flask):
@@ -148,11 +158,118 @@ class Nereid(Flask):
         'TEMPLATE_PREFIX_WEBSITE_NAME'
     )
 
+    #: The fraction of the template renders to be profiled. Profiling is
+    #: disabled if the value is 0 (default), while 1 profiles every render.
+    #: See :mod:`nereid.profiling`
+    template_profile_rate = ConfigAttribute('TEMPLATE_PROFILE_RATE')
+
+    #: Add the stats of the templates profiled in a request to the response
+    #: in the `X-Nereid-Template-Profile` header
+    template_profile_header = ConfigAttribute('TEMPLATE_PROFILE_HEADER')
+
+    #: Time in seconds for which the HTML rendered by the `rst` template
+    #: filter is stored in the application cache. The rendered HTML is
+    #: always memoised in the process, and the application cache is used
+    #: as a second tier only if this is set.
+    rst_cache_timeout = ConfigAttribute('RST_CACHE_TIMEOUT')
+
+    #: Access the cache through a :class:`~nereid.request_cache.RequestCache`
+    #: in requests, which batches the lookups of the keys declared with
+    #: :meth:`cache_prefetcher` and buffers the writes until the request is
+    #: torn down.
+    #:
+    #: .. versionadded:: 3.4.0.6
+    cache_request_buffer = ConfigAttribute('CACHE_REQUEST_BUFFER')
+
+    #: The codec used to encode the values stored in the cache, `pickle`
+    #: or `marshal`. If set, the cache backend is wrapped in a
+    #: :class:`~nereid.cache_backends.CodecCache`.
+    #:
+    #: .. versionadded:: 3.4.0.6
+    cache_codec = ConfigAttribute('CACHE_CODEC')
+
+    #: The size in bytes above which the values encoded with the
+    #: :attr:`cache_codec` are compressed with zlib, or `None` to never
+    #: compress them.
+    #:
+    #: .. versionadded:: 3.4.0.6
+    cache_compress_threshold = ConfigAttribute('CACHE_COMPRESS_THRESHOLD')
+
+    #: Record the stats of the use of the cache by namespace in
+    #: :attr:`cache_stats`, an :class:`~nereid.cache_stats.InstrumentedCache`
+    #: wrapping the cache backend.
+    #:
+    #: .. versionadded:: 3.4.0.6
+    cache_stats_enabled = ConfigAttribute('CACHE_STATS')
+
+    #: A dictionary of key prefixes and the namespaces of the keys starting
+    #: with them in the :attr:`cache_stats`
+    #:
+    #: .. versionadded:: 3.4.0.6
+    cache_stats_namespaces = ConfigAttribute('CACHE_STATS_NAMESPACES')
+
+    #: If set with :attr:`cache_stats_enabled`, the URL at which the cache
+    #: stats of the process are served as JSON to the users with the
+    #: :attr:`cache_stats_permission`.
+    #:
+    #: .. versionadded:: 3.4.0.6
+    cache_stats_url = ConfigAttribute('CACHE_STATS_URL')
+
+    #: The value of the nereid permission required to access the
+    #: :attr:`cache_stats_url`
+    #:
+    #: .. versionadded:: 3.4.0.6
+    cache_stats_permission = ConfigAttribute('CACHE_STATS_PERMISSION')
+
+    #: The number of seconds after which a session which did not change is
+    #: written again to extend its expiry in the session store, or `None`
+    #: to never write unchanged sessions.
+    #:
+    #: .. versionadded:: 3.4.0.6
+    session_touch_interval = ConfigAttribute('SESSION_TOUCH_INTERVAL')
+
+    #: The maximum size in bytes of the session cookie of the
+    #: :class:`~nereid.sessions.HybridSessionInterface`. Larger sessions
+    #: are saved in the session store.
+    #:
+    #: .. versionadded:: 3.4.0.6
+    session_cookie_threshold = ConfigAttribute('SESSION_COOKIE_THRESHOLD')
+
+    #: Warm up the application with :meth:`warmup` at the end of
+    #: :meth:`initialise`, so that the first requests do not pay for
+    #: building the URL maps, compiling the templates and loading the
+    #: translations.
+    #:
+    #: .. versionadded:: 3.4.0.6
+    warmup_on_initialise = ConfigAttribute('WARMUP')
+
+    #: The names of the templates compiled by :meth:`warmup`. If None
+    #: (default), every template the loader can list is compiled.
+    #:
+    #: .. versionadded:: 3.4.0.6
+    warmup_templates = ConfigAttribute('WARMUP_TEMPLATES')
+
+    #: The URLs requested through the test client by :meth:`warmup`. The
+    #: URLs could include the host to warm up a specific website.
+    #:
+    #: .. versionadded:: 3.4.0.6
+    warmup_urls = ConfigAttribute('WARMUP_URLS')
+
     #: Time in seconds for which the token is valid.
     token_validity_duration = ConfigAttribute(
         'TOKEN_VALIDITY_DURATION'
     )
 
+    #: The number of seconds for which the users authenticated by the
+    #: Basic or token credentials of the Authorization header are cached,
+    #: so that API clients sending them on every request do not pay for
+    #: the lookup of the user and the password hash. The cache is cleared
+    #: when users change, like their password or activation. `0` disables
+    #: the cache.
+    #:
+    #: .. versionadded:: 3.4.0.6
+    auth_cache_timeout = ConfigAttribute('AUTH_CACHE_TIMEOUT')
+
     def __init__(self, **config):
         """
         The import_name is forced into `Nereid`
@@ -164,16 +281,51 @@ class Nereid(Flask):
             'TRYTON_CONFIG': None,
             'TEMPLATE_PREFIX_WEBSITE_NAME': True,
             'TOKEN_VALIDITY_DURATION': 60 * 60,
+            'AUTH_CACHE_TIMEOUT': 60,
+            'SESSION_TOUCH_INTERVAL': 24 * 60 * 60,
+            'SESSION_COOKIE_THRESHOLD': 2048,
 
             'CACHE_TYPE': 'werkzeug.contrib.cache.NullCache',
             'CACHE_DEFAULT_TIMEOUT': 300,
             'CACHE_THRESHOLD': 500,
             'CACHE_INIT_KWARGS': {},
             'CACHE_KEY_PREFIX': '',
+            'CACHE_REQUEST_BUFFER': False,
+            'CACHE_CODEC': None,
+            'CACHE_COMPRESS_THRESHOLD': 1024,
+            'CACHE_STATS': False,
+            'CACHE_STATS_NAMESPACES': {},
+            'CACHE_STATS_URL': None,
+            'CACHE_STATS_PERMISSION': 'admin',
 
             'EAGER_TEMPLATE_RENDER': False,
+
+            'TEMPLATE_PROFILE_RATE': 0,
+            'TEMPLATE_PROFILE_HEADER': False,
+
+            'RST_CACHE_TIMEOUT': None,
+
+            'WARMUP': False,
+            'WARMUP_TEMPLATES': None,
+            'WARMUP_URLS': [],
         })
 
+        #: A dictionary of context variable names and the functions which
+        #: return their values. Unlike context processors, the functions
+        #: are called only when the template being rendered references the
+        #: variable. Use :meth:`lazy_context_processor` to register one.
+        #:
+        #: .. versionadded:: 3.4.0.6
+        self.lazy_context_processors = {}
+
+        #: Functions which return the cache keys a request will need, see
+        #: :meth:`cache_prefetcher`
+        self.cache_prefetchers = []
+
+        #: Cache of the variables referenced by the templates, see
+        #: :meth:`get_template_variables`
+        self._template_variables = {}
+
     def initialise(self):
         """
         The application needs initialisation to load the database
@@ -198,7 +350,7 @@ class Nereid(Flask):
         self.load_backend()
 
         #: Initialise the login handler
-        login_manager = LoginManager()
+        login_manager = NereidLoginManager()
         login_manager.user_loader(self._pool.get('nereid.user').load_user)
         login_manager.header_loader(
             self._pool.get('nereid.user').load_user_from_header
@@ -211,7 +363,13 @@ class Nereid(Flask):
         )
         login_manager.login_view = "nereid.website.login"
         login_manager.anonymous_user = self._pool.get('nereid.user.anonymous')
-        login_manager.init_app(self)
+        # The current_user is made available lazily instead of through the
+        # context processor of flask-login, so that templates which do not
+        # use it do not load the user.
+        login_manager.init_app(self, add_context_processor=False)
+        self.lazy_context_processor('current_user')(
+            flask.ext.login.current_user._get_current_object
+        )
 
         self.login_manager = login_manager
 
@@ -222,6 +380,8 @@ class Nereid(Flask):
         self.template_context_processors[None].append(
             self.get_context_processors()
         )
+        for name, function in self.get_lazy_context_processors():
+            self.lazy_context_processor(name)(function)
 
         # Add the additional template context processors
         self.template_context_processors[None].append(
@@ -232,12 +392,135 @@ class Nereid(Flask):
         for name, function in self.get_template_filters():
             self.jinja_env.filters[name] = function
 
+        if self.cache_request_buffer:
+            self.teardown_request(flush_request_cache)
+
+        if self.cache_stats is not None and self.cache_stats_url:
+            self.add_url_rule(
+                self.cache_stats_url, 'nereid.cache_stats', cache_stats_view
+            )
+
+        if self.template_profile_rate and self.template_profile_header:
+            self.after_request(add_profile_header)
+
         # Initialize Babel
         Babel(self)
 
         # Finally set the initialised attribute
         self.initialised = True
 
+        if self.warmup_on_initialise:
+            self.warmup()
+
+    def cache_prefetcher(self, f):
+        """
+        Registers a function which is called with the request and returns
+        the cache keys the request will need. The keys are fetched along
+        with the first cache lookup of the request if
+        :attr:`cache_request_buffer` is set::
+
+            @app.cache_prefetcher
+            def prefetch_menu(request):
+                return ['menu-%s' % request.nereid_website.id]
+
+        The functions are called lazily, when the request first accesses
+        the cache, and not before the request is dispatched. This is
+        usually within the tryton transaction of the request, so the
+        functions could read the database, but they delay the first lookup
+        of the request and should be cheap.
+
+        .. versionadded:: 3.4.0.6
+        """
+        self.cache_prefetchers.append(f)
+        return f
+
+    def warmup(self):
+        """
+        Warm up the application before it accepts traffic. The steps are:
+
+        * `url_maps`: build the URL maps of every active website
+        * `templates`: compile the templates in :attr:`warmup_templates`
+          (or every template) and analyse the variables they reference
+        * `translations`: load the nereid translations of the languages of
+          the active websites
+        * `urls`: request the URLs in :attr:`warmup_urls` through the test
+          client
+
+        The time taken by each step is logged and returned as an ordered
+        dictionary of step names and dictionaries with the `count` of
+        items warmed up and the `time` in seconds.
+
+        This is called from :meth:`initialise` if :attr:`warmup_on_initialise`
+        is set.
+
+        .. versionadded:: 3.4.0.6
+        """
+        report = OrderedDict()
+        for step, function in (
+                ('url_maps', self._warmup_url_maps),
+                ('templates', self._warmup_templates),
+                ('translations', self._warmup_translations),
+                ('urls', self._warmup_urls)):
+            start = time()
+            count = function()
+            report[step] = {'count': count, 'time': time() - start}
+            self.logger.info(
+                'Warmup %s: %d in %.3fs', step, count, report[step]['time']
+            )
+        return report
+
+    @root_transaction_if_required
+    def _warmup_url_maps(self):
+        Website = Pool().get('nereid.website')
+
+        websites = Website.search([])
+        for website in websites:
+            website.get_url_adapter(self)
+        return len(websites)
+
+    def _warmup_templates(self):
+        names = self.warmup_templates
+        if names is None:
+            names = self.jinja_env.list_templates()
+
+        count = 0
+        for name in names:
+            try:
+                template = self.jinja_env.get_template(name)
+            except (
+                    TemplateNotFound, TemplateSyntaxError,
+                    UnicodeDecodeError), exc:
+                self.logger.warning(
+                    'Warmup could not compile template %s: %s', name, exc
+                )
+                continue
+            self.get_template_variables(template)
+            count += 1
+        return count
+
+    @root_transaction_if_required
+    def _warmup_translations(self):
+        Website = Pool().get('nereid.website')
+        IRTranslation = Pool().get('ir.translation')
+
+        langs = set()
+        for website in Website.search([]):
+            if website.default_locale:
+                langs.add(website.default_locale.language.code)
+            langs.update(locale.language.code for locale in website.locales)
+        return IRTranslation.load_translations_4_nereid(list(langs))
+
+    def _warmup_urls(self):
+        client = self.test_client()
+        for url in self.warmup_urls:
+            response = client.get(url)
+            if response.status_code >= 500:
+                self.logger.warning(
+                    'Warmup request to %s failed with status %s',
+                    url, response.status_code
+                )
+        return len(self.warmup_urls)
+
     def get_urls(self):
         """
         Return the URL rules for routes formed by decorating methods with the
@@ -302,6 +585,94 @@ class Nereid(Flask):
 
         return get_ctx
 
+    @root_transaction_if_required
+    def get_lazy_context_processors(self):
+        """
+        Returns a list of name, method pairs for the context processors
+        registered in the models using the
+        :func:`~nereid.helpers.context_processor` decorator with `lazy`.
+
+        .. versionadded:: 3.4.0.6
+        """
+        models = Pool._pool[self.database_name]['model']
+        context_processors = []
+
+        for model_name, model in models.iteritems():
+            for f_name, f in inspect.getmembers(
+                    model, predicate=inspect.ismethod):
+
+                if getattr(f, '_lazy_context_processor', False):
+                    ctx_proc_as_func = getattr(Pool().get(model_name), f_name)
+                    context_processors.append(
+                        (ctx_proc_as_func.func_name, ctx_proc_as_func)
+                    )
+
+        return context_processors
+
+    def lazy_context_processor(self, name):
+        """
+        A decorator to register a function which returns the value of the
+        context variable `name`. The function is called only when the
+        template rendered (or the templates it includes, imports or extends)
+        references the variable::
+
+            @app.lazy_context_processor('cart')
+            def get_cart():
+                return Cart.open_cart()
+
+        .. versionadded:: 3.4.0.6
+        """
+        def decorator(f):
+            self.lazy_context_processors[name] = f
+            return f
+        return decorator
+
+    def update_template_context(self, context, template=None):
+        """
+        Update the template context with the context processors and the lazy
+        context processors. If the template is given, only the lazy context
+        processors for the variables the template references are called.
+        The values in the context are never overwritten.
+
+        :param context: the context as a dictionary that is updated in place
+                        to add extra variables.
+        :param template: the template being rendered
+        """
+        super(Nereid, self).update_template_context(context)
+
+        names = None
+        if template is not None:
+            names = self.get_template_variables(template)
+
+        for name, function in self.lazy_context_processors.iteritems():
+            if name in context:
+                continue
+            if names is not None and name not in names:
+                continue
+            context[name] = function()
+
+    def get_template_variables(self, template):
+        """
+        Returns the names of the variables the template, and the templates
+        it includes, imports or extends, look up in the context. The names
+        are found by static analysis of the templates and cached for the
+        template. None is returned if they cannot be determined.
+
+        .. versionadded:: 3.4.0.6
+        """
+        if template.name is None:
+            # Templates loaded from strings cannot be analysed
+            return None
+
+        cached = self._template_variables.get(template.name)
+        if cached is not None and cached[0] is template:
+            return cached[1]
+
+        names = find_template_variables(self.jinja_env, template.name)
+        # The template is stored along to detect reloads of the template
+        self._template_variables[template.name] = (template, names)
+        return names
+
     @root_transaction_if_required
     def get_template_filters(self):
         """
@@ -346,9 +717,45 @@ class Nereid(Flask):
                 self.cache_dir,
                 self.cache_threshold,
                 self.cache_default_timeout)
+        elif self.cache_type == 'nereid.cache_backends.SharedMemoryCache':
+            kwargs = dict(self.cache_init_kwargs)
+            kwargs.setdefault('default_timeout', self.cache_default_timeout)
+            if 'path' not in kwargs and self.cache_dir:
+                kwargs['path'] = os.path.join(
+                    self.cache_dir,
+                    '%s.cache' % (self.cache_key_prefix or 'nereid')
+                )
+            self.cache = BackendClass(**kwargs)
+        elif self.cache_type == 'nereid.cache_backends.TwoTierCache':
+            kwargs = dict(self.cache_init_kwargs)
+            kwargs.setdefault('default_timeout', self.cache_default_timeout)
+            kwargs.setdefault('key_prefix', self.cache_key_prefix)
+            self.cache = BackendClass(**kwargs)
         else:
             self.cache = BackendClass(**self.cache_init_kwargs)
 
+        #: The :class:`~nereid.cache_stats.InstrumentedCache` recording the
+        #: stats of the cache if :attr:`cache_stats_enabled` is set
+        self.cache_stats = None
+        if self.cache_stats_enabled:
+            # Instrument the backend under the codec, so that the bytes
+            # encoded are counted
+            self.cache = self.cache_stats = InstrumentedCache(
+                self.cache, self.cache_key_prefix,
+                self.cache_stats_namespaces
+            )
+
+        if self.cache_codec:
+            self.cache = CodecCache(
+                self.cache, codec=self.cache_codec,
+                compress_threshold=self.cache_compress_threshold
+            )
+
+        #: The tag version store used to invalidate cached fragments
+        self.cache_tags = CacheTagStore(
+            self.cache, self.cache_key_prefix + '-tag-'
+        )
+
     def load_backend(self):
         """
         This method loads the configuration file if specified and
@@ -453,6 +860,7 @@ class Nereid(Flask):
                         req, language=language, active_id=active_id
                     )
                     txn.cursor.commit()
+                    bump_pending_cache_tags()
                 except DatabaseOperationalError:
                     # Strict transaction handling may cause this.
                     # Rollback and Retry the whole transaction if within
@@ -517,6 +925,9 @@ class Nereid(Flask):
         """
         rv = super(Nereid, self).create_jinja_environment()
 
+        if self.template_profile_rate:
+            rv.template_class = ProfilingTemplate
+
         # Add the custom extensions specific to nereid
         rv.add_extension('jinja2.ext.i18n')
         rv.add_extension('nereid.templating.FragmentCacheExtension')
@@ -530,8 +941,9 @@ class Nereid(Flask):
             # Setup the bytecode cache
             rv.bytecode_cache = MemcachedBytecodeCache(self.cache)
             # Setup for fragmented caching
-            rv.fragment_cache = self.cache
+            rv.fragment_cache = cache
             rv.fragment_cache_prefix = self.cache_key_prefix + "-frag-"
+            rv.fragment_cache_tags = self.cache_tags
 
         # Install the gettext callables
         from .contrib.locale import TrytonTranslations
@@ -0,0 +1,692 @@
+# This file is part of Tryton & Nereid. The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""
+Cache backends which could be used as the `CACHE_TYPE` of the application
+in addition to the werkzeug backends.
+"""
+import os
+import mmap
+import zlib
+import fcntl
+import struct
+import binascii
+from time import time
+from threading import RLock, Lock
+from contextlib import contextmanager
+from collections import OrderedDict
+try:
+    import cPickle as pickle
+except ImportError:  # pragma: no cover
+    import pickle
+
+from werkzeug import import_string
+from werkzeug.contrib.cache import BaseCache
+
+from .cache_codecs import CacheCodec
+
+__all__ = ['TwoTierCache', 'SharedMemoryCache', 'CodecCache']
+
+
+class TwoTierCache(BaseCache):
+    """
+    A cache with a bounded in-process LRU (the local tier) in front of
+    another cache backend (the remote tier), usually shared by the
+    processes like memcached. Values found in the local tier are served
+    without a round trip to the remote cache.
+
+    Only the keys of the namespaces in `local_namespaces` (the rendered
+    pages, fragments and rst, and the memoized values) are stored in the
+    local tier, so the sessions and the versions of the cache tags are
+    always read from the remote cache. The namespace of a key is the part
+    after the `key_prefix` of the application, like `<key_prefix>-page-`.
+    Other keys could be allowed by setting `local_prefixes`, which
+    replaces the prefixes of the namespaces.
+
+    Values are retained in the local tier for `local_timeout` seconds at
+    most, and writes are not propagated to the local tiers of the other
+    processes. This suits the keys of nereid, whose values never change
+    under a key: the keys of the pages and fragments change with the
+    versions of their cache tags, those of the memoized values with the
+    version of their namespace and those of the rst with its source. A
+    value written or deleted under another key could be stale in the other
+    processes for `local_timeout` seconds at most, unless the prefix is
+    invalidated with :meth:`invalidate_local`. Each local prefix has a
+    version stored in the remote cache under the `version_key` and the
+    prefix, which each process checks at most every
+    `version_check_interval` seconds, evicting the keys of the prefixes
+    whose version changed from its local tier.
+
+    To use it, set the `CACHE_TYPE` and the `CACHE_INIT_KWARGS`::
+
+        CACHE_TYPE = 'nereid.cache_backends.TwoTierCache'
+        CACHE_INIT_KWARGS = {
+            'remote': 'werkzeug.contrib.cache.MemcachedCache',
+            'remote_kwargs': {'servers': ['127.0.0.1:11211']},
+        }
+
+    :param remote: The remote cache backend or the import name of its class
+    :param remote_kwargs: The arguments to initialise the remote backend
+                          with, if the import name is given
+    :param local_threshold: The maximum number of values in the local tier
+    :param local_max_bytes: The maximum size in bytes of the pickled values
+                            in the local tier
+    :param local_timeout: The maximum time in seconds for which a value is
+                          retained in the local tier
+    :param local_prefixes: If given, the keys starting with one of these
+                           prefixes are stored in the local tier instead
+                           of the keys of the `local_namespaces`
+    :param key_prefix: The `CACHE_KEY_PREFIX` of the application
+    :param version_key: The prefix of the keys in the remote cache holding
+                        the versions of the local prefixes
+    :param version_check_interval: The time in seconds between the checks
+                                   of the versions
+    :param default_timeout: The timeout used if none is given to `set`
+
+    .. versionadded:: 3.4.0.6
+    """
+
+    #: Time in seconds for which the version is retained in the remote cache
+    version_timeout = 30 * 24 * 60 * 60
+
+    #: The namespaces of the keys stored in the local tier by default
+    local_namespaces = ('page', 'frag', 'rst', 'memo')
+
+    def __init__(
+            self, remote, remote_kwargs=None, local_threshold=1000,
+            local_max_bytes=16 * 1024 * 1024, local_timeout=60,
+            local_prefixes=None, key_prefix='',
+            version_key='nereid-local-cache-version', version_check_interval=1,
+            default_timeout=300):
+        super(TwoTierCache, self).__init__(default_timeout)
+        if isinstance(remote, basestring):
+            remote = import_string(remote)(**(remote_kwargs or {}))
+        self.remote = remote
+        self.local_threshold = local_threshold
+        self.local_max_bytes = local_max_bytes
+        self.local_timeout = local_timeout
+        if local_prefixes is None:
+            local_prefixes = [
+                '%s-%s-' % (key_prefix or '', namespace)
+                for namespace in self.local_namespaces
+            ]
+        self.local_prefixes = tuple(local_prefixes)
+        self.version_key = version_key
+        self.version_check_interval = version_check_interval
+
+        self._lock = RLock()
+        #: Maps the keys to (expires, pickled value) in the order of use
+        self._local = OrderedDict()
+        self._local_bytes = 0
+        #: Maps the local prefixes to their version
+        self._versions = dict.fromkeys(self.local_prefixes)
+        self._version_checked = 0
+        self._stats = dict.fromkeys([
+            'local_hits', 'local_misses', 'remote_hits', 'remote_misses',
+        ], 0)
+
+    def _get_prefix(self, key):
+        """
+        Returns the local prefix of the key, or `None` if the key is not
+        stored in the local tier
+        """
+        for prefix in self.local_prefixes:
+            if key.startswith(prefix):
+                return prefix
+        return None
+
+    def _check_version(self):
+        """
+        Evict the keys of the prefixes whose version changed in the remote
+        cache from the local tier
+        """
+        now = time()
+        if now - self._version_checked < self.version_check_interval:
+            return
+        self._version_checked = now
+        if not self.local_prefixes:
+            return
+        versions = self.remote.get_many(*[
+            self.version_key + prefix for prefix in self.local_prefixes
+        ])
+        changed = [
+            prefix for prefix, version in zip(self.local_prefixes, versions)
+            if version != self._versions[prefix]
+        ]
+        if changed:
+            with self._lock:
+                for prefix, version in zip(self.local_prefixes, versions):
+                    self._versions[prefix] = version
+                self._clear_local(tuple(changed))
+
+    def invalidate_local(self, *prefixes):
+        """
+        Assign a new version to the given local prefixes, or all of them,
+        to make the other processes evict their keys from the local tier
+        on their next version check, and evict them from this process.
+        """
+        prefixes = prefixes or self.local_prefixes
+        for prefix in prefixes:
+            version = binascii.hexlify(os.urandom(6))
+            self.remote.set(
+                self.version_key + prefix, version, self.version_timeout
+            )
+            self._versions[prefix] = version
+        self._clear_local(tuple(prefixes))
+
+    def _clear_local(self, prefixes=None):
+        """
+        Evict the keys starting with one of the prefixes, or all keys if
+        no prefixes are given, from the local tier
+        """
+        with self._lock:
+            if prefixes is None:
+                self._local.clear()
+                self._local_bytes = 0
+                return
+            for key in [k for k in self._local if k.startswith(prefixes)]:
+                self._delete_local(key)
+
+    def _get_local(self, key):
+        with self._lock:
+            try:
+                expires, value = self._local.pop(key)
+            except KeyError:
+                return None
+            if expires < time():
+                self._local_bytes -= len(value)
+                return None
+            # Move to the end as the most recently used
+            self._local[key] = (expires, value)
+        return pickle.loads(value)
+
+    def _set_local(self, key, value, timeout=None):
+        if self._get_prefix(key) is None:
+            return
+        if not timeout or timeout > self.local_timeout:
+            timeout = self.local_timeout
+        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(value) > self.local_max_bytes:
+            self._delete_local(key)
+            return
+        with self._lock:
+            self._delete_local(key)
+            self._local[key] = (time() + timeout, value)
+            self._local_bytes += len(value)
+            while len(self._local) > self.local_threshold or \
+                    self._local_bytes > self.local_max_bytes:
+                _, (_, evicted) = self._local.popitem(last=False)
+                self._local_bytes -= len(evicted)
+
+    def _delete_local(self, key):
+        with self._lock:
+            entry = self._local.pop(key, None)
+            if entry is not None:
+                self._local_bytes -= len(entry[1])
+
+    def get(self, key):
+        return self.get_many(key)[0]
+
+    def get_many(self, *keys):
+        self._check_version()
+
+        rv = []
+        missing = []
+        for index, key in enumerate(keys):
+            value = self._get_local(key)
+            if value is None:
+                missing.append(index)
+            rv.append(value)
+        self._stats['local_hits'] += len(keys) - len(missing)
+        self._stats['local_misses'] += len(missing)
+
+        if missing:
+            values = self.remote.get_many(*[keys[i] for i in missing])
+            for index, value in zip(missing, values):
+                if value is None:
+                    self._stats['remote_misses'] += 1
+                    continue
+                self._stats['remote_hits'] += 1
+                rv[index] = value
+                self._set_local(keys[index], value)
+        return rv
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        rv = self.remote.set(key, value, timeout)
+        self._set_local(key, value, timeout)
+        return rv
+
+    def set_many(self, mapping, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        rv = self.remote.set_many(mapping, timeout)
+        for key, value in dict(mapping).iteritems():
+            self._set_local(key, value, timeout)
+        return rv
+
+    def add(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        rv = self.remote.add(key, value, timeout)
+        if rv:
+            self._set_local(key, value, timeout)
+        return rv
+
+    def delete(self, key):
+        return self.delete_many(key)
+
+    def delete_many(self, *keys):
+        rv = self.remote.delete_many(*keys)
+        for key in keys:
+            self._delete_local(key)
+        return rv
+
+    def clear(self):
+        rv = self.remote.clear()
+        self._clear_local()
+        self.invalidate_local(*self.local_prefixes)
+        return rv
+
+    def inc(self, key, delta=1):
+        rv = self.remote.inc(key, delta)
+        self._delete_local(key)
+        return rv
+
+    def dec(self, key, delta=1):
+        rv = self.remote.dec(key, delta)
+        self._delete_local(key)
+        return rv
+
+    def get_stats(self):
+        """
+        Returns the hits, misses and hit rate of each tier, and the number
+        of values and bytes in the local tier.
+        """
+        stats = {}
+        for tier in ('local', 'remote'):
+            hits = self._stats[tier + '_hits']
+            misses = self._stats[tier + '_misses']
+            stats[tier] = {
+                'hits': hits,
+                'misses': misses,
+                'hit_rate': float(hits) / (hits + misses) if hits else 0.0,
+            }
+        stats['local']['entries'] = len(self._local)
+        stats['local']['bytes'] = self._local_bytes
+        return stats
+
+
+class SharedMemoryCache(BaseCache):
+    """
+    A cache stored in a memory mapped file, shared by all the processes on
+    the host which open the same file, without a network round trip.
+
+    The file holds a fixed number of slots of a fixed size. The slots are
+    grouped into buckets of `ways` slots and a key can only be stored in
+    the bucket its hash points to. When the bucket is full, a slot is
+    evicted with the clock (second chance) algorithm: slots read since the
+    hand last passed them are skipped once. Values larger than a slot are
+    not stored.
+
+    Each bucket is locked with a lock on a byte of the file, so processes
+    only wait for each other when they use the same bucket.
+
+    To use it, set the `CACHE_TYPE` and the `CACHE_INIT_KWARGS`::
+
+        CACHE_TYPE = 'nereid.cache_backends.SharedMemoryCache'
+        CACHE_INIT_KWARGS = {
+            'path': '/dev/shm/my-site-cache',
+            'slots': 65536,
+            'slot_size': 4096,
+        }
+
+    If no `path` is given, the file is created in the `CACHE_DIR` and named
+    after the `CACHE_KEY_PREFIX` if any. The `CACHE_DEFAULT_TIMEOUT` is used
+    as the default timeout. The file is created if it does not exist, and
+    replaced by a new file if it was created with different dimensions.
+    The processes which opened the previous file keep using it until they
+    are restarted.
+
+    :param path: The path of the file
+    :param slots: The number of slots
+    :param slot_size: The size in bytes of a slot, including the key, the
+                      pickled value and a header of 20 bytes
+    :param ways: The number of slots in a bucket. The slots must be a
+                 multiple of it.
+    :param default_timeout: The timeout used if none is given to `set`. A
+                            timeout of 0 never expires.
+
+    .. versionadded:: 3.4.0.6
+    """
+
+    _magic = 'NRDSHM01'
+    _header = struct.Struct('<8sIII')
+    _slot_header = struct.Struct('<BBHIdI')
+
+    _EMPTY, _USED, _DELETED = 0, 1, 2
+
+    def __init__(
+            self, path, slots=8192, slot_size=4096, ways=8,
+            default_timeout=300):
+        super(SharedMemoryCache, self).__init__(default_timeout)
+        assert slots % ways == 0, 'slots must be a multiple of ways'
+        assert slot_size > self._slot_header.size
+        self.path = path
+        self.ways = ways
+        self.buckets = slots // ways
+        self.slot_size = slot_size
+
+        # The hands of the buckets follow the header and the slots are
+        # aligned after them
+        self._hands_offset = 64
+        self._slots_offset = (self._hands_offset + self.buckets + 7) & ~7
+        size = self._slots_offset + slots * slot_size
+
+        # fcntl locks do not exclude the threads of the process
+        self._thread_lock = Lock()
+
+        header = self._header.pack(
+            self._magic, self.ways, self.buckets, slot_size
+        )
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                try:
+                    current = os.stat(path).st_ino == os.fstat(fd).st_ino
+                except OSError:
+                    current = False
+                # The file could have been replaced by another process while
+                # waiting for the lock
+                if current and os.read(fd, self._header.size) == header:
+                    break
+                if current:
+                    self._create(size, header)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+        self._fd = fd
+        self._map = mmap.mmap(self._fd, size)
+
+    def _create(self, size, header):
+        """
+        Create a new file of the given size and move it in place of the
+        file. The file is never resized as other processes could have it
+        mapped, and accessing the pages of a mapped file beyond its end
+        crashes them. They keep using the previous file until they open the
+        cache again.
+        """
+        temp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        fd = os.open(temp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            os.ftruncate(fd, size)
+            os.write(fd, header)
+        finally:
+            os.close(fd)
+        os.rename(temp_path, self.path)
+
+    @staticmethod
+    def _encode_key(key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return key
+
+    def _hash(self, key):
+        return zlib.crc32(key) & 0xffffffff
+
+    @contextmanager
+    def _locked(self, bucket):
+        offset = self._hands_offset + bucket
+        with self._thread_lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, offset)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, offset)
+
+    def _slot_offset(self, bucket, way):
+        return self._slots_offset + \
+            (bucket * self.ways + way) * self.slot_size
+
+    def _find(self, bucket, key, key_hash):
+        """
+        Returns the offset of the slot holding the key and its header, or
+        None. Must be called with the bucket locked.
+        """
+        now = time()
+        for way in xrange(self.ways):
+            offset = self._slot_offset(bucket, way)
+            header = self._slot_header.unpack_from(self._map, offset)
+            state, _, key_len, slot_hash, expires, _ = header
+            if state != self._USED or slot_hash != key_hash:
+                continue
+            start = offset + self._slot_header.size
+            if self._map[start:start + key_len] != key:
+                continue
+            if expires and expires < now:
+                self._map[offset] = chr(self._DELETED)
+                return None
+            return offset, header
+        return None
+
+    def _read(self, offset, header):
+        _, _, key_len, _, _, value_len = header
+        # Mark the slot as referenced for the clock
+        self._map[offset + 1] = '\x01'
+        start = offset + self._slot_header.size + key_len
+        return self._map[start:start + value_len]
+
+    def _victim(self, bucket):
+        """
+        Returns the offset of a free slot in the bucket, evicting one with
+        the clock algorithm if there is none. Must be called with the
+        bucket locked.
+        """
+        now = time()
+        for way in xrange(self.ways):
+            offset = self._slot_offset(bucket, way)
+            state, _, _, _, expires, _ = self._slot_header.unpack_from(
+                self._map, offset
+            )
+            if state != self._USED or (expires and expires < now):
+                return offset
+
+        hand_offset = self._hands_offset + bucket
+        hand = ord(self._map[hand_offset])
+        while True:
+            offset = self._slot_offset(bucket, hand)
+            hand = (hand + 1) % self.ways
+            if self._map[offset + 1] == '\x00':
+                self._map[hand_offset] = chr(hand)
+                return offset
+            # Give the slot a second chance
+            self._map[offset + 1] = '\x00'
+
+    def _write(self, offset, key, key_hash, value, timeout):
+        if timeout is None:
+            timeout = self.default_timeout
+        expires = time() + timeout if timeout else 0
+        start = offset + self._slot_header.size
+        self._map[start:start + len(key)] = key
+        self._map[start + len(key):start + len(key) + len(value)] = value
+        self._slot_header.pack_into(
+            self._map, offset, self._USED, 1, len(key), key_hash, expires,
+            len(value)
+        )
+
+    def _store(self, key, value, timeout, only_new=False):
+        key = self._encode_key(key)
+        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        key_hash = self._hash(key)
+        bucket = key_hash % self.buckets
+        too_large = self._slot_header.size + len(key) + len(value) > \
+            self.slot_size
+
+        with self._locked(bucket):
+            found = self._find(bucket, key, key_hash)
+            if found is not None:
+                if only_new:
+                    return False
+                if too_large:
+                    # Do not leave the previous value behind
+                    self._map[found[0]] = chr(self._DELETED)
+                    return False
+                offset = found[0]
+            elif too_large:
+                return False
+            else:
+                offset = self._victim(bucket)
+            self._write(offset, key, key_hash, value, timeout)
+        return True
+
+    def get(self, key):
+        key = self._encode_key(key)
+        key_hash = self._hash(key)
+        bucket = key_hash % self.buckets
+        with self._locked(bucket):
+            found = self._find(bucket, key, key_hash)
+            if found is None:
+                return None
+            value = self._read(*found)
+        try:
+            return pickle.loads(value)
+        except Exception:
+            # A corrupt or truncated value is a miss
+            return None
+
+    def set(self, key, value, timeout=None):
+        return self._store(key, value, timeout)
+
+    def add(self, key, value, timeout=None):
+        return self._store(key, value, timeout, only_new=True)
+
+    def delete(self, key):
+        key = self._encode_key(key)
+        key_hash = self._hash(key)
+        bucket = key_hash % self.buckets
+        with self._locked(bucket):
+            found = self._find(bucket, key, key_hash)
+            if found is None:
+                return False
+            self._map[found[0]] = chr(self._DELETED)
+        return True
+
+    def clear(self):
+        empty = '\x00' * (self.ways * self.slot_size)
+        for bucket in xrange(self.buckets):
+            offset = self._slot_offset(bucket, 0)
+            with self._locked(bucket):
+                self._map[offset:offset + len(empty)] = empty
+        return True
+
+    def _add_delta(self, key, delta):
+        key = self._encode_key(key)
+        key_hash = self._hash(key)
+        bucket = key_hash % self.buckets
+        with self._locked(bucket):
+            found = self._find(bucket, key, key_hash)
+            value = 0
+            offset = None
+            if found is not None:
+                offset = found[0]
+                value = pickle.loads(self._read(*found)) or 0
+                expires = found[1][4]
+            value += delta
+            if offset is None:
+                offset = self._victim(bucket)
+                timeout = None
+            else:
+                # Retain the expiry of the counter
+                timeout = expires and max(expires - time(), 1)
+            self._write(
+                offset, key, key_hash,
+                pickle.dumps(value, pickle.HIGHEST_PROTOCOL), timeout
+            )
+        return value
+
+    def inc(self, key, delta=1):
+        return self._add_delta(key, delta)
+
+    def dec(self, key, delta=1):
+        return self._add_delta(key, -delta)
+
+    def close(self):
+        """
+        Unmap and close the file
+        """
+        self._map.close()
+        os.close(self._fd)
+
+
+class CodecCache(BaseCache):
+    """
+    Encodes the values with a :class:`~nereid.cache_codecs.CacheCodec`
+    before they are stored in another cache backend, to store plain data
+    with marshal and compress large values like rendered fragments.
+
+    The application wraps its cache backend in it if the `CACHE_CODEC` is
+    set::
+
+        CACHE_CODEC = 'marshal'
+        CACHE_COMPRESS_THRESHOLD = 1024
+
+    The counters of `inc` and `dec` are stored unencoded.
+
+    :param backend: The cache backend or the import name of its class
+    :param backend_kwargs: The arguments to initialise the backend with, if
+                           the import name is given
+    :param codec: The codec, see :class:`~nereid.cache_codecs.CacheCodec`
+    :param compress_threshold: The size in bytes above which values are
+                               compressed, or `None` to never compress
+    :param compress_level: The zlib compression level
+
+    .. versionadded:: 3.4.0.6
+    """
+
+    def __init__(
+            self, backend, backend_kwargs=None, codec='pickle',
+            compress_threshold=1024, compress_level=1):
+        if isinstance(backend, basestring):
+            backend = import_string(backend)(**(backend_kwargs or {}))
+        super(CodecCache, self).__init__(backend.default_timeout)
+        self.backend = backend
+        self.codec = CacheCodec(codec, compress_threshold, compress_level)
+
+    def _decode(self, data):
+        if self.codec.is_encoded(data):
+            return self.codec.loads(data)
+        return data
+
+    def get(self, key):
+        return self._decode(self.backend.get(key))
+
+    def get_many(self, *keys):
+        return map(self._decode, self.backend.get_many(*keys))
+
+    def set(self, key, value, timeout=None):
+        return self.backend.set(key, self.codec.dumps(value), timeout)
+
+    def set_many(self, mapping, timeout=None):
+        dumps = self.codec.dumps
+        return self.backend.set_many(dict(
+            (key, dumps(value)) for key, value in dict(mapping).iteritems()
+        ), timeout)
+
+    def add(self, key, value, timeout=None):
+        return self.backend.add(key, self.codec.dumps(value), timeout)
+
+    def delete(self, key):
+        return self.backend.delete(key)
+
+    def delete_many(self, *keys):
+        return self.backend.delete_many(*keys)
+
+    def clear(self):
+        return self.backend.clear()
+
+    def inc(self, key, delta=1):
+        return self.backend.inc(key, delta)
+
+    def dec(self, key, delta=1):
+        return self.backend.dec(key, delta)
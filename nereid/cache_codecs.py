@@ -0,0 +1,143 @@
+# This file is part of Tryton & Nereid. The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""
+Serialisation of the values stored in the cache.
+
+An encoded value is a header byte followed by the payload. The header byte
+holds the format version in bits 4 to 6, the zlib flag in bit 3 and the
+codec in bits 0 to 2. Values written in another version of the format are
+ignored. The header byte must never be a digit or a minus sign (it is a
+control character in this version), so that the values can be told apart
+from the counters of `inc` and `dec`, which the backends store unencoded.
+"""
+import zlib
+import marshal
+try:
+    import cPickle as pickle
+except ImportError:  # pragma: no cover
+    import pickle
+
+__all__ = ['CacheCodec', 'CODECS']
+
+#: The version of the format of the encoded values
+FORMAT_VERSION = 1
+
+_PICKLE = 1
+_MARSHAL = 2
+_ZLIB = 0x08
+
+#: The codecs which could be used
+CODECS = ('pickle', 'marshal')
+
+
+#: The types marshal writes faithfully. Subclasses of them (like
+#: :class:`~markupsafe.Markup`) are written by marshal as their base type.
+_PLAIN_TYPES = frozenset([
+    type(None), bool, int, long, float, complex, str, unicode,
+])
+_CONTAINER_TYPES = frozenset([tuple, list, set, frozenset])
+
+
+def _is_plain(value):
+    """
+    Returns `True` if the value, and any value it contains, is exactly of
+    a builtin type marshal handles.
+    """
+    value_type = type(value)
+    if value_type in _PLAIN_TYPES:
+        return True
+    if value_type in _CONTAINER_TYPES:
+        return all(_is_plain(item) for item in value)
+    if value_type is dict:
+        return all(
+            _is_plain(key) and _is_plain(item)
+            for key, item in value.iteritems()
+        )
+    return False
+
+
+def _header(codec, compressed):
+    return chr((FORMAT_VERSION << 4) | (compressed and _ZLIB) | codec)
+
+
+class CacheCodec(object):
+    """
+    Encodes values into strings and back.
+
+    The codecs are:
+
+    * `pickle`: pickle protocol 2, which handles any picklable value.
+    * `marshal`: marshal, which is several times faster than pickle but
+      only handles plain data (`None`, booleans, numbers, strings, tuples,
+      lists, dicts and sets, but not subclasses of them). Other values are
+      pickled. The marshal format
+      is specific to the version of python, so all the processes sharing
+      the cache must run the same version.
+
+    Payloads longer than `compress_threshold` bytes are compressed with
+    zlib if that makes them smaller.
+
+    :param codec: One of :data:`CODECS`
+    :param compress_threshold: The size in bytes above which payloads are
+                               compressed, or `None` to never compress
+    :param compress_level: The zlib compression level
+
+    .. versionadded:: 3.4.0.6
+    """
+
+    def __init__(self, codec='pickle', compress_threshold=1024,
+                 compress_level=1):
+        if codec not in CODECS:
+            raise ValueError('Unknown cache codec %r' % codec)
+        self.codec = codec
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+
+    def dumps(self, value):
+        """
+        Returns the encoded value
+        """
+        if self.codec == 'marshal' and _is_plain(value):
+            payload = marshal.dumps(value)
+            codec = _MARSHAL
+        else:
+            payload = pickle.dumps(value, 2)
+            codec = _PICKLE
+
+        compressed = False
+        if self.compress_threshold is not None and \
+                len(payload) > self.compress_threshold:
+            deflated = zlib.compress(payload, self.compress_level)
+            if len(deflated) < len(payload):
+                payload, compressed = deflated, True
+        return _header(codec, compressed) + payload
+
+    def loads(self, data):
+        """
+        Returns the value decoded from the data, or `None` if the data was
+        encoded in another version of the format or is corrupt.
+        """
+        header = ord(data[0])
+        if header >> 4 != FORMAT_VERSION:
+            return None
+        payload = data[1:]
+        try:
+            if header & _ZLIB:
+                payload = zlib.decompress(payload)
+            codec = header & 0x07
+            if codec == _MARSHAL:
+                return marshal.loads(payload)
+            if codec == _PICKLE:
+                return pickle.loads(payload)
+        except Exception:
+            return None
+        return None
+
+    @staticmethod
+    def is_encoded(data):
+        """
+        Returns `True` if the data was encoded by a codec, of any version
+        of the format, and not a counter stored by the backend.
+        """
+        return isinstance(data, str) and data != '' and \
+            data[0] not in '-0123456789'
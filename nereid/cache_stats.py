@@ -0,0 +1,277 @@
+# This file is part of Tryton & Nereid. The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""
+Statistics of the use of the application cache.
+
+When `CACHE_STATS` is set, the cache backend is wrapped in an
+:class:`InstrumentedCache` which records for each namespace of keys the
+hits, misses, sets, deletes, bytes and a histogram of the latency of the
+calls to the backend. The stats are available from `app.cache_stats` and,
+if `CACHE_STATS_URL` is set, as JSON from that URL.
+
+The namespace of a key is the explicit namespace of the longest prefix of
+`namespaces` it starts with, or else the part of the key before the first
+separator, once the `CACHE_KEY_PREFIX` is removed. So the keys of nereid
+are counted as `page`, `frag`, `rst`, `tag` and `memo:<namespace>` (the
+namespace of :func:`~nereid.memoize.memoize`), the jinja bytecode as
+`bytecode` and the sessions, whose keys are 40 hexadecimal digits, as
+`session`. Other keys without a separator are counted as `other`.
+
+The stats are kept in the process. The bytes are only known for the values
+stored as strings, like the rendered pages and fragments. When a
+`CACHE_CODEC` is set, every value is encoded before it reaches the
+instrumented cache, so the bytes are those stored in the backend.
+"""
+import os
+import re
+from time import time
+from bisect import bisect_left
+from threading import Lock
+
+from flask import current_app, jsonify
+from werkzeug.exceptions import abort
+from werkzeug.contrib.cache import BaseCache
+
+from .globals import request
+
+__all__ = ['InstrumentedCache', 'cache_stats_view']
+
+#: The upper bounds in milliseconds of the buckets of the latency histogram
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 1000)
+
+#: The namespace of the keys which do not have one
+OTHER = 'other'
+
+#: The namespace of the keys of the sessions
+SESSION = 'session'
+
+#: The keys of the sessions, see :class:`~nereid.sessions.NereidSessionStore`
+_SESSION_KEY_RE = re.compile(r'^[a-f0-9]{40}$')
+
+#: The counters of a namespace, in the order they are stored in
+_COUNTERS = (
+    'hits', 'misses', 'sets', 'deletes', 'bytes_read', 'bytes_written',
+)
+_HITS, _MISSES, _SETS, _DELETES, _BYTES_READ, _BYTES_WRITTEN, _LATENCY, \
+    _LATENCY_TOTAL = range(len(_COUNTERS) + 2)
+
+
+class InstrumentedCache(BaseCache):
+    """
+    Wraps a cache backend and records the stats of its use by namespace.
+
+    :param backend: The cache backend
+    :param key_prefix: The prefix of all keys, removed before the namespace
+                       is looked up
+    :param namespaces: A dictionary of key prefixes and the namespaces of
+                       the keys starting with them
+    :param separators: The characters ending the namespace of a key
+    :param nested: Namespaces in which the next part of the key is the
+                   namespace too, like the memoized functions
+    :param max_namespaces: The maximum number of namespaces. The keys of
+                           further namespaces are counted as `other`.
+
+    .. versionadded:: 3.4.0.6
+    """
+
+    def __init__(
+            self, backend, key_prefix='', namespaces=None, separators='-/:',
+            nested=('memo',), max_namespaces=200):
+        super(InstrumentedCache, self).__init__(backend.default_timeout)
+        self.backend = backend
+        self.key_prefix = key_prefix and key_prefix + '-'
+        self.namespaces = {'jinja2/bytecode/': 'bytecode'}
+        self.namespaces.update(namespaces or {})
+        self._prefixes = sorted(self.namespaces, key=len, reverse=True)
+        self._separator = re.compile('[%s]' % re.escape(separators))
+        self.nested = frozenset(nested)
+        self.max_namespaces = max_namespaces
+
+        self._lock = Lock()
+        self._stats = {}
+        #: The time since which the stats are recorded
+        self.started = time()
+
+    def get_namespace(self, key):
+        """
+        Returns the namespace of the key
+        """
+        for prefix in self._prefixes:
+            if key.startswith(prefix):
+                return self.namespaces[prefix]
+
+        start = 0
+        if self.key_prefix and key.startswith(self.key_prefix):
+            start = len(self.key_prefix)
+        match = self._separator.search(key, start)
+        if match is not None and match.start() == start:
+            # The keys built with an empty CACHE_KEY_PREFIX
+            start = match.end()
+            match = self._separator.search(key, start)
+        if match is None:
+            if _SESSION_KEY_RE.match(key):
+                return SESSION
+            return OTHER
+        namespace = key[start:match.start()]
+        if namespace in self.nested:
+            # The next part of the key is the namespace too
+            nested_match = self._separator.search(key, match.end())
+            if nested_match is not None:
+                namespace += ':' + key[match.end():nested_match.start()]
+        return namespace
+
+    def _get_counters(self, key):
+        namespace = self.get_namespace(key)
+        counters = self._stats.get(namespace)
+        if counters is None:
+            if len(self._stats) >= self.max_namespaces:
+                namespace = OTHER
+            counters = self._stats.setdefault(
+                namespace,
+                [0] * len(_COUNTERS) + [[0] * (len(LATENCY_BUCKETS) + 1), 0.0]
+            )
+        return counters
+
+    def _record(self, keys, started, counter=None, values=None):
+        """
+        Record a call for the keys, which started at the given time
+        """
+        elapsed = (time() - started) * 1000
+        bucket = bisect_left(LATENCY_BUCKETS, elapsed)
+        with self._lock:
+            recorded = set()
+            for index, key in enumerate(keys):
+                counters = self._get_counters(key)
+                if id(counters) not in recorded:
+                    # A call is recorded once in the latency of a namespace
+                    recorded.add(id(counters))
+                    counters[_LATENCY][bucket] += 1
+                    counters[_LATENCY_TOTAL] += elapsed
+                if values is None:
+                    counters[counter] += 1
+                    continue
+                value = values[index]
+                if counter is None:
+                    # A lookup
+                    if value is None:
+                        counters[_MISSES] += 1
+                        continue
+                    counters[_HITS] += 1
+                    size_counter = _BYTES_READ
+                else:
+                    counters[counter] += 1
+                    size_counter = _BYTES_WRITTEN
+                if isinstance(value, basestring):
+                    counters[size_counter] += len(value)
+
+    def get(self, key):
+        started = time()
+        rv = self.backend.get(key)
+        self._record((key,), started, values=(rv,))
+        return rv
+
+    def get_many(self, *keys):
+        started = time()
+        rv = self.backend.get_many(*keys)
+        self._record(keys, started, values=rv)
+        return rv
+
+    def set(self, key, value, timeout=None):
+        started = time()
+        rv = self.backend.set(key, value, timeout)
+        self._record((key,), started, _SETS, (value,))
+        return rv
+
+    def set_many(self, mapping, timeout=None):
+        mapping = dict(mapping)
+        started = time()
+        rv = self.backend.set_many(mapping, timeout)
+        self._record(mapping.keys(), started, _SETS, mapping.values())
+        return rv
+
+    def add(self, key, value, timeout=None):
+        started = time()
+        rv = self.backend.add(key, value, timeout)
+        self._record((key,), started, _SETS, (value,))
+        return rv
+
+    def delete(self, key):
+        started = time()
+        rv = self.backend.delete(key)
+        self._record((key,), started, _DELETES)
+        return rv
+
+    def delete_many(self, *keys):
+        started = time()
+        rv = self.backend.delete_many(*keys)
+        self._record(keys, started, _DELETES)
+        return rv
+
+    def clear(self):
+        return self.backend.clear()
+
+    def inc(self, key, delta=1):
+        started = time()
+        rv = self.backend.inc(key, delta)
+        self._record((key,), started, _SETS)
+        return rv
+
+    def dec(self, key, delta=1):
+        started = time()
+        rv = self.backend.dec(key, delta)
+        self._record((key,), started, _SETS)
+        return rv
+
+    def get_stats(self):
+        """
+        Returns the stats of each namespace as a dictionary of the counters
+        (`hits`, `misses`, `sets`, `deletes`, `bytes_read` and
+        `bytes_written`), the `hit_rate` and the `latency`, a dictionary
+        of the `count` and `total` time in milliseconds of the calls and
+        the `histogram`, a list of the upper bounds in milliseconds of the
+        buckets (`None` for the last) and the number of calls in them.
+        """
+        with self._lock:
+            stats = {}
+            for namespace, counters in self._stats.iteritems():
+                namespace_stats = dict(zip(_COUNTERS, counters))
+                lookups = namespace_stats['hits'] + namespace_stats['misses']
+                namespace_stats['hit_rate'] = lookups and \
+                    float(namespace_stats['hits']) / lookups
+                histogram = counters[_LATENCY]
+                namespace_stats['latency'] = {
+                    'count': sum(histogram),
+                    'total': counters[_LATENCY_TOTAL],
+                    'histogram': zip(
+                        LATENCY_BUCKETS + (None, ), histogram
+                    ),
+                }
+                stats[namespace] = namespace_stats
+        return stats
+
+    def reset_stats(self):
+        """
+        Reset the stats
+        """
+        with self._lock:
+            self._stats.clear()
+            self.started = time()
+
+
+def cache_stats_view():
+    """
+    Returns the stats of the cache of the process as JSON. The view is
+    registered at `CACHE_STATS_URL` if it is set, and is forbidden to the
+    users without the `CACHE_STATS_PERMISSION`.
+    """
+    permission = current_app.cache_stats_permission
+    if not permission or \
+            not request.nereid_user.has_permissions([permission]):
+        abort(403)
+
+    cache_stats = current_app.cache_stats
+    return jsonify(
+        pid=os.getpid(),
+        since=cache_stats.started,
+        namespaces=cache_stats.get_stats(),
+    )
@@ -0,0 +1,298 @@
+# This file is part of Tryton & Nereid. The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+from __future__ import absolute_import
+
+import os
+import logging
+import binascii
+from itertools import chain
+from threading import Lock
+
+from flask.globals import _app_ctx_stack, _request_ctx_stack
+from werkzeug.utils import import_string
+from trytond.config import config
+
+from .helpers import key_from_list
+
+__all__ = [
+    'CacheTagStore', 'invalidate_cache_tags', 'get_tag_store',
+    'get_configured_tag_store', 'bump_pending_cache_tags', 'CacheTagMixin',
+]
+
+logger = logging.getLogger('nereid.cache_tags')
+
+
+class CacheTagStore(object):
+    """
+    Stores a version for every cache tag in the cache backend of the
+    application. Keys of cached values which depend on a tag embed the
+    current version of the tag. Bumping the version of a tag makes every
+    value that depends on it a miss on the next lookup without having to
+    find or delete the keys.
+
+    A missing version (never set, evicted or expired) is replaced by a
+    fresh one, so losing a version can only cause misses and never serve
+    stale content.
+
+    :param cache: The werkzeug cache backend to store the versions in
+    :param prefix: Prefix added to the tag to build the cache key
+    :param timeout: Time in seconds for which a tag version is retained
+
+    .. versionadded:: 3.4.0.6
+    """
+
+    def __init__(self, cache, prefix='', timeout=30 * 24 * 60 * 60):
+        self.cache = cache
+        self.prefix = prefix
+        self.timeout = timeout
+
+    @staticmethod
+    def new_version():
+        """
+        Returns a new random version for a tag. The version is made of
+        digits, so that a :class:`~nereid.cache_backends.CodecCache` of the
+        application reads the versions set by a store without the codec,
+        like the one of :func:`get_configured_tag_store`.
+        """
+        return str(int(binascii.hexlify(os.urandom(6)), 16))
+
+    def get_versions(self, tags):
+        """
+        Returns the current versions of the given tags in one round trip
+        to the cache. Tags which do not have a version yet are initialised.
+        """
+        keys = [self.prefix + tag for tag in tags]
+        versions = self.cache.get_many(*keys)
+        for index, version in enumerate(versions):
+            if version is not None:
+                continue
+            version = self.new_version()
+            if not self.cache.add(keys[index], version, self.timeout):
+                # Another process initialised the version in the meantime
+                version = self.cache.get(keys[index]) or version
+            versions[index] = version
+        return versions
+
+    def versioned_key(self, key, tags):
+        """
+        Returns the key suffixed with a digest of the current versions of
+        the tags
+        """
+        if not tags:
+            return key
+        return '%s-%s' % (key, key_from_list(self.get_versions(tags)))
+
+    def bump(self, *tags):
+        """
+        Assign new versions to the given tags, invalidating every value
+        cached against any of them.
+        """
+        if tags:
+            self.cache.set_many(
+                dict((self.prefix + tag, self.new_version()) for tag in tags),
+                self.timeout
+            )
+
+
+_configured_tag_store = None
+_configured_tag_store_lock = Lock()
+
+
+def get_configured_tag_store():
+    """
+    Returns the tag store of the cache configured in the `nereid` section
+    of the tryton configuration, or `None` if `cache_type` is not set or
+    the cache cannot be created from it, in which case a warning is logged
+    once and the tags are not invalidated outside of the application.
+
+    The store is used to invalidate cache tags when records are changed
+    outside of a nereid application, like from the tryton client or the
+    cron. The options must point to the same cache as the configuration of
+    the application:
+
+    * `cache_type`: The import path of the werkzeug cache backend
+      (`CACHE_TYPE`)
+    * `cache_servers`: Comma separated `host:port` of the memcached servers
+      (`CACHE_MEMCACHED_SERVERS`) or of the redis server
+    * `cache_dir`: The directory of the cache (`CACHE_DIR`), required by
+      the file system and shared memory caches
+    * `cache_key_prefix`: The prefix of the keys (`CACHE_KEY_PREFIX`)
+
+    With :class:`~nereid.cache_backends.TwoTierCache`, whose tag versions
+    are kept in the remote tier, set `cache_type` to the remote backend.
+
+    .. versionadded:: 3.4.0.6
+    """
+    global _configured_tag_store
+
+    if _configured_tag_store is not None:
+        return _configured_tag_store or None
+
+    cache_type = config.get('nereid', 'cache_type')
+    if not cache_type:
+        return None
+
+    with _configured_tag_store_lock:
+        if _configured_tag_store is None:
+            key_prefix = config.get('nereid', 'cache_key_prefix') or ''
+            try:
+                cache = _make_configured_cache(cache_type, key_prefix)
+            except Exception:
+                logger.warning(
+                    'Cache tags are not invalidated outside of nereid, the '
+                    'cache_type %s of the nereid section of the configuration '
+                    'could not be created', cache_type, exc_info=True
+                )
+                _configured_tag_store = False
+            else:
+                _configured_tag_store = CacheTagStore(
+                    cache, key_prefix + '-tag-'
+                )
+    return _configured_tag_store or None
+
+
+def _make_configured_cache(cache_type, key_prefix):
+    """
+    Returns the cache backend of the `nereid` section of the tryton
+    configuration
+    """
+    BackendClass = import_string(cache_type)
+    servers = [
+        server.strip() for server in
+        (config.get('nereid', 'cache_servers') or '').split(',')
+        if server.strip()
+    ]
+    cache_dir = config.get('nereid', 'cache_dir')
+
+    if cache_type == 'werkzeug.contrib.cache.MemcachedCache':
+        return BackendClass(servers or None, key_prefix=key_prefix)
+    elif cache_type == 'werkzeug.contrib.cache.RedisCache':
+        host, _, port = (servers or ['localhost'])[0].partition(':')
+        return BackendClass(host, int(port or 6379), key_prefix=key_prefix)
+    elif cache_type in (
+            'werkzeug.contrib.cache.FileSystemCache',
+            'nereid.cache_backends.SharedMemoryCache'):
+        if not cache_dir:
+            raise ValueError('%s requires cache_dir' % cache_type)
+        if cache_type == 'werkzeug.contrib.cache.FileSystemCache':
+            return BackendClass(cache_dir)
+        return BackendClass(os.path.join(
+            cache_dir, '%s.cache' % (key_prefix or 'nereid')
+        ))
+    elif cache_type == 'nereid.cache_backends.TwoTierCache':
+        raise ValueError(
+            'Set cache_type to the remote backend of the TwoTierCache'
+        )
+    return BackendClass()
+
+
+def get_tag_store():
+    """
+    Returns the tag store of the current application or, if there is no
+    application context, the one of :func:`get_configured_tag_store`.
+
+    .. versionadded:: 3.4.0.6
+    """
+    ctx = _app_ctx_stack.top
+    if ctx is not None:
+        return getattr(ctx.app, 'cache_tags', None)
+    return get_configured_tag_store()
+
+
+def invalidate_cache_tags(*tags):
+    """
+    Invalidate the cached values depending on any of the given tags.
+
+    The tag store of the current application is used. If there is no
+    application context (for example, when the change is made from the
+    tryton client or the cron) the tag store configured in the tryton
+    configuration is used, see :func:`get_configured_tag_store`. Without
+    one, this is a no-op.
+
+    The tags are bumped right away, usually before the transaction which
+    changed the records is committed. A render in another transaction
+    between the bump and the commit reads the old records and caches them
+    against the new versions. Within a nereid request, the tags are bumped
+    again once the transaction is committed (see
+    :func:`bump_pending_cache_tags`). Outside of a request, this window
+    remains: values may then stay stale until they expire, unless the tags
+    are invalidated again after the commit.
+    """
+    tag_store = get_tag_store()
+    if tag_store is None:
+        return
+    tag_store.bump(*tags)
+    ctx = _request_ctx_stack.top
+    if ctx is not None and hasattr(ctx, 'pending_cache_tags'):
+        ctx.pending_cache_tags.update(tags)
+
+
+def bump_pending_cache_tags():
+    """
+    Bump again the tags invalidated during the current request. Called by
+    the application once the transaction of the request is committed, so
+    that values cached from the records before the commit are discarded.
+
+    .. versionadded:: 3.4.0.6
+    """
+    ctx = _request_ctx_stack.top
+    tags = getattr(ctx, 'pending_cache_tags', None)
+    if tags:
+        ctx.app.cache_tags.bump(*tags)
+        tags.clear()
+
+
+class CacheTagMixin(object):
+    """
+    A mixin for tryton models whose records are rendered into cached
+    fragments. Creating records bumps the tag of the model, while writing
+    or deleting them bumps the tag of the model and of each record::
+
+        class Product:
+            __metaclass__ = PoolMeta
+            __name__ = 'product.product'
+
+    becomes::
+
+        class Product(CacheTagMixin):
+            __metaclass__ = PoolMeta
+            __name__ = 'product.product'
+
+    and the fragments could then be tagged in the templates::
+
+        {% cache key, 3600, tags=['product.product:%d' % product.id] %}
+
+    The static files of nereid (`nereid.static.file`) use the mixin. To
+    invalidate the tags when the records are changed from the tryton client
+    or the cron, configure the cache in the `nereid` section of the tryton
+    configuration, see :func:`get_configured_tag_store`.
+    """
+
+    @classmethod
+    def get_cache_tags(cls, records):
+        """
+        Returns the tags to be invalidated when the given records change
+        """
+        return [cls.__name__] + [
+            '%s:%d' % (cls.__name__, record.id) for record in records
+        ]
+
+    @classmethod
+    def create(cls, vlist):
+        records = super(CacheTagMixin, cls).create(vlist)
+        invalidate_cache_tags(cls.__name__)
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        records = list(chain(*args[::2]))
+        rv = super(CacheTagMixin, cls).write(*args)
+        invalidate_cache_tags(*cls.get_cache_tags(records))
+        return rv
+
+    @classmethod
+    def delete(cls, records):
+        tags = cls.get_cache_tags(records)
+        rv = super(CacheTagMixin, cls).delete(records)
+        invalidate_cache_tags(*tags)
+        return rv
@@ -7,7 +7,9 @@ from warnings import warn
 
 from flask.globals import current_app
 
-warn(DeprecationWarning("This API will be deprecated"))
+warn(DeprecationWarning(
+    "This API will be deprecated, use nereid.memoize instead"
+))
 
 
 class Cache(object):
@@ -49,10 +49,10 @@ class NereidCsrfProtect(CsrfProtect):
                     return csrf_token
             return None
 
-        # expose csrf_token as a helper in all templates
-        @app.context_processor
+        # expose csrf_token as a helper in the templates which use it
+        @app.lazy_context_processor('csrf_token')
         def csrf_token():
-            return dict(csrf_token=generate_csrf)
+            return generate_csrf
 
         @app.before_request
         def _csrf_protect():
@@ -16,3 +16,6 @@ class RequestContext(RequestContextBase):
         super(RequestContext, self).__init__(app, environ, request)
         self.transaction = None
         self.cache = app.cache
+        #: Cache tags invalidated during the request, bumped again once the
+        #: transaction is committed
+        self.pending_cache_tags = set()
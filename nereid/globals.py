@@ -4,13 +4,16 @@ from flask.globals import (_request_ctx_stack, current_app,  # noqa
     request, session, g, LocalProxy, _find_app)
 from flask.ext.login import current_user                     # noqa
 
+from .request_cache import get_request_cache
+
 
 def _find_cache():
     """
     The application context will be automatically handled by
-    _find_app method in flask
+    _find_app method in flask. Within a request, the request cache is
+    returned if the application is configured to buffer the cache access.
     """
     app = _find_app()
-    return app.cache
+    return get_request_cache(app)
 
 cache = LocalProxy(_find_cache)
@@ -10,11 +10,14 @@ import re
 import warnings
 import unicodedata
 from functools import wraps
-from hashlib import md5
+from hashlib import md5, sha1
+from threading import Lock
 
 import trytond.modules
+from trytond import backend
 from trytond.transaction import Transaction
 from trytond.config import config
+from trytond.cache import LRUDict
 from speaklater import is_lazy_string
 from flask.helpers import (_PackageBoundObject, locked_cached_property,  # noqa
         get_flashed_messages, flash as _flash, url_for as flask_url_for)
@@ -24,6 +27,11 @@ from flask.ext.login import login_required      # noqa
 
 from .globals import current_app, request
 
+try:
+    from docutils import core as docutils_core
+except ImportError:
+    docutils_core = None
+
 
 _SLUGIFY_STRIP_RE = re.compile(r'[^\w\s-]')
 _SLUGIFY_HYPHENATE_RE = re.compile(r'[-\s]+')
@@ -290,12 +298,146 @@ def slugify(value):
     return _SLUGIFY_HYPHENATE_RE.sub('-', value)
 
 
+#: Maximum number of rendered RST values retained in the process
+RST_CACHE_SIZE = 1024
+
+_rst_cache = LRUDict(RST_CACHE_SIZE)
+_rst_cache_lock = Lock()
+
+
+def _rst_digest(value):
+    """
+    Returns the digest of the RST text used to identify the rendered HTML
+    """
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return sha1(value).hexdigest()
+
+
+def _rst_cache_timeout():
+    """
+    Returns the timeout for the rendered RST in the application cache, or
+    None if the application cache is not to be used
+    """
+    try:
+        return current_app.rst_cache_timeout
+    except RuntimeError:
+        # Working outside of the application context
+        return None
+
+
+def _rst_lookup(digest):
+    """
+    Lookup the rendered HTML in the process cache, marking it as the most
+    recently used
+    """
+    with _rst_cache_lock:
+        rv = _rst_cache.pop(digest, None)
+        if rv is not None:
+            _rst_cache[digest] = rv
+    return rv
+
+
+def _rst_store(digest, html):
+    with _rst_cache_lock:
+        _rst_cache[digest] = html
+
+
+def _rst_publish(value):
+    """
+    Converts RST text to HTML using docutils
+    """
+    try:
+        parts = docutils_core.publish_parts(source=value, writer_name='html')
+        return parts['body_pre_docinfo'] + parts['fragment']
+    except Exception:
+        return value
+
+
+def rst_to_html_many(values):
+    """
+    Converts a list of RST texts to HTML and returns the list of HTML in the
+    same order. The texts are identified by the hash of their content and the
+    HTML is memoised in a bounded in-process cache. If `RST_CACHE_TIMEOUT` is
+    configured, the application cache is used as a second tier which is
+    looked up and updated in a single round trip each.
+
+    This could be used to warm up the caches for many records at once. See
+    :func:`prerender_rst_fields`.
+
+    If docutils is not installed, the texts are returned as such.
+
+    .. versionadded:: 3.4.0.6
+    """
+    if docutils_core is None:
+        return list(values)
+
+    digests = [
+        _rst_digest(value) if value and isinstance(value, basestring)
+        else None for value in values
+    ]
+    rendered = {}
+    for digest in set(filter(None, digests)):
+        html = _rst_lookup(digest)
+        if html is not None:
+            rendered[digest] = html
+
+    to_render = dict(
+        (digest, value) for digest, value in zip(digests, values)
+        if digest and digest not in rendered
+    )
+    timeout = _rst_cache_timeout()
+    if to_render and timeout is not None:
+        # Lookup the misses in the application cache
+        missing = to_render.keys()
+        for digest, html in zip(missing, current_app.cache.get_many(*[
+                current_app.cache_key_prefix + '-rst-' + digest
+                for digest in missing])):
+            if html is not None:
+                rendered[digest] = html
+                _rst_store(digest, html)
+                del to_render[digest]
+
+    if to_render:
+        published = {}
+        for digest, value in to_render.iteritems():
+            published[digest] = rendered[digest] = _rst_publish(value)
+            _rst_store(digest, published[digest])
+        if timeout is not None:
+            current_app.cache.set_many(dict(
+                (current_app.cache_key_prefix + '-rst-' + digest, html)
+                for digest, html in published.iteritems()
+            ), timeout)
+
+    return [
+        rendered[digest] if digest else value
+        for digest, value in zip(digests, values)
+    ]
+
+
+def prerender_rst_fields(records, *field_names):
+    """
+    Render the RST in the given fields of the records to warm up the caches
+    used by the `rst` template filter. All the values are rendered with a
+    single call to :func:`rst_to_html_many`::
+
+        prerender_rst_fields(Product.search([]), 'description')
+
+    .. versionadded:: 3.4.0.6
+    """
+    rst_to_html_many([
+        getattr(record, field_name)
+        for record in records for field_name in field_names
+    ])
+
+
 def _rst_to_html_filter(value):
     """
     Converts RST text to HTML
     ~~~~~~~~~~~~~~~~~~~~~~~~~
     This uses docutils, if the library is missing, then the
-    original text is returned
+    original text is returned. The rendered HTML is memoised by
+    the hash of the text. See :func:`rst_to_html_many`.
 
     Loading to environment::
              from jinja2 import Environment
@@ -304,12 +446,7 @@ def _rst_to_html_filter(value):
              template = env.from_string("Welcome {{name|rst}}")
              template.render(name="**Sharoon**")
     """
-    try:
-        from docutils import core
-        parts = core.publish_parts(source=value, writer_name='html')
-        return parts['body_pre_docinfo'] + parts['fragment']
-    except Exception:
-        return value
+    return rst_to_html_many([value])[0]
 
 
 def key_from_list(list_of_args):
@@ -407,6 +544,25 @@ def root_transaction_if_required(function):
     return decorated_function
 
 
+def forget_inherited_transaction():
+    """
+    Forget the transaction and the database connections a worker process
+    inherited from its parent, without closing them. They belong to the
+    parent and using or closing them from the worker would corrupt them.
+    Called by the initializers of the worker pools.
+
+    .. versionadded:: 3.4.0.6
+    """
+    transaction = Transaction()
+    transaction.cursor = transaction.database = transaction.user = None
+    transaction.close = transaction.context = None
+
+    Database = backend.get('Database')
+    if hasattr(Database, '_databases'):
+        # The databases of the parent hold pools of its connections
+        Database._databases = {}
+
+
 def flash(message, category='message'):
     """
     Lazy strings are no real strings so pickling them results in strange issues.
@@ -467,7 +623,7 @@ def get_version():
     return trytond.modules.get_module_info('nereid')['version']
 
 
-def context_processor(name=None):
+def context_processor(name=None, lazy=False):
     """Makes method available in template context. By default method will be
     registered by its name.
 
@@ -486,9 +642,27 @@ def context_processor(name=None):
             def get_sale_price(cls):
                 ...
                 return 'Product sale price'
+
+    If `lazy` is set, the method is called without arguments when a
+    template references the name, and its return value is made available
+    in the template context instead of the method. Templates which do not
+    reference the name do not pay for the call.
+
+    .. code-block:: python
+
+            @classmethod
+            @context_processor('cart', lazy=True)
+            def get_cart(cls):
+                return cls.open_cart()
+
+    .. versionchanged:: 3.4.0.6
+        The `lazy` argument was added
     """
     def decorator(f):
-        f._context_processor = True
+        if lazy:
+            f._lazy_context_processor = True
+        else:
+            f._context_processor = True
         if name is not None:
             f.func_name = name
         return f
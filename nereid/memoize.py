@@ -0,0 +1,209 @@
+# This file is part of Tryton & Nereid. The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""
+Memoisation of functions and methods in the application cache.
+
+This replaces the memoize decorators of :mod:`nereid.caching`, which hash
+the `repr` of the arguments. The `repr` of active records and decimals is
+slow and differs between processes, so the cache keys were neither cheap
+nor shared.
+"""
+import inspect
+from decimal import Decimal
+from functools import wraps
+from hashlib import sha1
+
+from flask.globals import current_app, _request_ctx_stack
+from trytond.model import Model
+
+__all__ = ['memoize', 'invalidate_memoized', 'default_key_builder']
+
+
+def _key_part(value):
+    """
+    Returns a value with a cheap and stable `repr` for the given argument.
+    The values which are not plain are tagged with their type, so that they
+    do not share the key of a plain value.
+    """
+    if isinstance(value, Model):
+        if value.id is None or value.id < 0:
+            raise ValueError(
+                'Unsaved %s records cannot be memoized' % value.__name__
+            )
+        return ('record', value.__name__, value.id)
+    if isinstance(value, type):
+        if issubclass(value, Model):
+            # Tryton models are named by __name__
+            return ('model', value.__name__)
+        return ('type', value.__module__, value.__name__)
+    if isinstance(value, Decimal):
+        return ('decimal', str(value))
+    if isinstance(value, (list, tuple)):
+        return ('sequence', tuple(map(_key_part, value)))
+    if isinstance(value, dict):
+        return ('dict', tuple(sorted(
+            (_key_part(key), _key_part(item))
+            for key, item in value.iteritems()
+        )))
+    if isinstance(value, (set, frozenset)):
+        return ('set', tuple(sorted(map(_key_part, value))))
+    return value
+
+
+def default_key_builder(values):
+    """
+    Builds the key for the tuple of the values of the arguments of a
+    memoized call. Active records are identified by their model and id,
+    and tryton models by their name, so the keys are the same in every
+    process. Records which are not saved have no id, so they cannot be
+    memoized and a :exc:`ValueError` is raised.
+    """
+    return sha1(repr(_key_part(values))).hexdigest()
+
+
+def _make_binder(function):
+    """
+    Returns a function which binds the arguments of a call to the function
+    into a tuple of values in the order of the parameters, with the
+    defaults filled in. The signature is inspected only once.
+    """
+    names, varargs, varkw, defaults = inspect.getargspec(function)
+    count = len(names)
+    defaults = dict(zip(names[count - len(defaults or ()):], defaults or ()))
+    positional = not (varargs or varkw)
+
+    def bind(args, kwargs):
+        if positional and not kwargs and len(args) == count:
+            return args
+
+        values = list(args[:count])
+        for name in names[len(values):]:
+            if name in kwargs:
+                values.append(kwargs[name])
+            elif name in defaults:
+                values.append(defaults[name])
+            else:
+                raise TypeError(
+                    '%s() missing argument %r' % (function.__name__, name)
+                )
+        extra_args = tuple(args[count:])
+        extra_kwargs = tuple(sorted(
+            item for item in kwargs.iteritems() if item[0] not in names
+        ))
+        if extra_args or extra_kwargs:
+            values.append((extra_args, extra_kwargs))
+        return tuple(values)
+
+    return bind
+
+
+def _namespace_tag(namespace):
+    return 'memoize:' + namespace
+
+
+def _get_namespace_version(namespace):
+    """
+    Returns the version of the namespace. The version is looked up once in
+    a request.
+    """
+    tag = _namespace_tag(namespace)
+    ctx = _request_ctx_stack.top
+    versions = None
+    if ctx is not None:
+        versions = ctx.__dict__.setdefault('memoize_versions', {})
+        if tag in versions:
+            return versions[tag]
+
+    version, = current_app.cache_tags.get_versions([tag])
+    if versions is not None:
+        versions[tag] = version
+    return version
+
+
+def invalidate_memoized(*namespaces):
+    """
+    Invalidate every value memoized in the given namespaces by assigning
+    new versions to them.
+    """
+    tags = map(_namespace_tag, namespaces)
+    current_app.cache_tags.bump(*tags)
+
+    ctx = _request_ctx_stack.top
+    if ctx is not None:
+        versions = ctx.__dict__.get('memoize_versions', {})
+        for tag in tags:
+            versions.pop(tag, None)
+
+
+def memoize(namespace=None, timeout=None, unless=None, key_builder=None):
+    """
+    Decorator to memoize the return value of the function in the
+    application cache by the values of the arguments::
+
+        class Product:
+            __name__ = 'product.product'
+
+            @classmethod
+            @memoize('product.product.get_best_sellers', 3600)
+            def get_best_sellers(cls, category, limit=10):
+                ...
+
+    The calls `get_best_sellers(category)` and
+    `get_best_sellers(category, limit=10)` share the value. Active records
+    are identified by their model and id in the key, so instance methods
+    and arguments which are records are memoized too. Calls with records
+    which are not saved raise a :exc:`ValueError`.
+
+    All the values memoized for the function are invalidated at once with
+    `get_best_sellers.invalidate()` or
+    :func:`invalidate_memoized` with the namespace.
+
+    A return value of `None` is not memoized.
+
+    :param namespace: Name of the function in the cache. Defaults to the
+                      module and name of the function.
+    :param timeout: Time in seconds to retain the value
+    :param unless: Callable called with no arguments before anything else.
+                   If it returns a true value, the function is called and
+                   the cache is not used.
+    :param key_builder: Callable which returns the key for the tuple of the
+                        argument values. Defaults to
+                        :func:`default_key_builder`.
+
+    .. versionadded:: 3.4.0.6
+    """
+    if key_builder is None:
+        key_builder = default_key_builder
+
+    def decorator(function):
+        ns = namespace or '%s.%s' % (function.__module__, function.__name__)
+        bind = _make_binder(function)
+
+        def make_cache_key(*args, **kwargs):
+            """
+            Returns the cache key for the call with the given arguments
+            """
+            return '%s-memo-%s-%s-%s' % (
+                current_app.cache_key_prefix, ns,
+                _get_namespace_version(ns), key_builder(bind(args, kwargs)),
+            )
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if unless is not None and unless():
+                return function(*args, **kwargs)
+
+            cache_key = make_cache_key(*args, **kwargs)
+            rv = current_app.cache.get(cache_key)
+            if rv is None:
+                rv = function(*args, **kwargs)
+                if rv is not None:
+                    current_app.cache.set(cache_key, rv, timeout)
+            return rv
+
+        wrapper.namespace = ns
+        wrapper.make_cache_key = make_cache_key
+        wrapper.invalidate = lambda: invalidate_memoized(ns)
+        wrapper.uncached = function
+        return wrapper
+    return decorator
@@ -0,0 +1,215 @@
+# This file is part of Tryton & Nereid. The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""
+Profiling of template rendering.
+
+When enabled with the `TEMPLATE_PROFILE_RATE` configuration, a sample of
+the renders of :class:`~nereid.templating.LazyRenderer` are profiled. For
+every template rendered (including the templates included, imported or
+extended) the time spent, the number of SQL statements executed and the
+number of active record fields looked up are recorded. The cursor of the
+transaction and the active records are instrumented only while a render
+is being profiled.
+
+The stats are sent with the
+:data:`~nereid.signals.template_profiled` signal and if
+`TEMPLATE_PROFILE_HEADER` is set, added to the response in the
+`X-Nereid-Template-Profile` header.
+"""
+import random
+from time import time
+from collections import OrderedDict
+from threading import Lock
+from contextlib import contextmanager
+
+from jinja2 import Template
+from werkzeug.local import Local
+from flask.globals import _request_ctx_stack
+from trytond.model.modelstorage import ModelStorage
+from trytond.transaction import Transaction
+
+from .signals import template_profiled
+
+__all__ = ['ProfilingTemplate', 'profile_render']
+
+#: State of the profiling in the current context
+_state = Local()
+
+
+def _is_active():
+    return getattr(_state, 'stats', None) is not None
+
+
+class ProfilingTemplate(Template):
+    """
+    A template class which records the stats of the render when a render
+    is being profiled. The root render function is wrapped, so the
+    templates included, imported or extended are recorded too.
+    """
+
+    @classmethod
+    def _from_namespace(cls, environment, namespace, globals):
+        template = super(ProfilingTemplate, cls)._from_namespace(
+            environment, namespace, globals
+        )
+        root_render_func = template.root_render_func
+
+        def profiled_root_render_func(context):
+            if not _is_active():
+                return root_render_func(context)
+            return _profile_events(
+                template.name, root_render_func(context)
+            )
+
+        template.root_render_func = profiled_root_render_func
+        return template
+
+
+def _profile_events(name, events):
+    """
+    Yield the events of the render and record the time, queries and field
+    loads spent in producing them. The time spent by the consumer of the
+    events is not accounted.
+    """
+    elapsed = queries = field_loads = 0
+    events = iter(events)
+    try:
+        while True:
+            queries_before = _state.queries
+            field_loads_before = _state.field_loads
+            start = time()
+            try:
+                event = next(events)
+            finally:
+                elapsed += time() - start
+                queries += _state.queries - queries_before
+                field_loads += _state.field_loads - field_loads_before
+            yield event
+    except StopIteration:
+        pass
+    finally:
+        if _is_active():
+            stats = _state.stats.setdefault(name, {
+                'template': name,
+                'count': 0,
+                'time': 0.0,
+                'queries': 0,
+                'field_loads': 0,
+            })
+            stats['count'] += 1
+            stats['time'] += elapsed
+            stats['queries'] += queries
+            stats['field_loads'] += field_loads
+
+
+@contextmanager
+def _count_queries():
+    """
+    Count the SQL statements executed on the cursor of the transaction
+    within the context
+    """
+    cursor = Transaction().cursor
+    if cursor is None:
+        yield
+        return
+
+    patched = vars(cursor).get('execute')
+    execute = cursor.execute
+
+    def counting_execute(*args, **kwargs):
+        _state.queries += 1
+        return execute(*args, **kwargs)
+
+    cursor.execute = counting_execute
+    try:
+        yield
+    finally:
+        if patched is None:
+            del cursor.execute
+        else:
+            cursor.execute = patched
+
+
+#: The lock and number of the profiled renders in progress in the process,
+#: and the `__getattr__` of the active records they replaced
+_field_loads_lock = Lock()
+_field_loads_count = 0
+_getattr = None
+
+
+def _counting_getattr(self, name):
+    if _is_active() and name in self._fields:
+        _state.field_loads += 1
+    return _getattr(self, name)
+
+
+@contextmanager
+def _count_field_loads():
+    """
+    Count the fields of the active records looked up within the context.
+    The lookups are counted by replacing `__getattr__` of the active records
+    for the process, so it is replaced while a render is being profiled in
+    any thread, and restored after the last one.
+    """
+    global _field_loads_count, _getattr
+    with _field_loads_lock:
+        if not _field_loads_count:
+            _getattr = ModelStorage.__dict__['__getattr__']
+            ModelStorage.__getattr__ = _counting_getattr
+        _field_loads_count += 1
+    try:
+        yield
+    finally:
+        with _field_loads_lock:
+            _field_loads_count -= 1
+            if not _field_loads_count:
+                ModelStorage.__getattr__ = _getattr
+                _getattr = None
+
+
+@contextmanager
+def profile_render(app, template_name_or_list):
+    """
+    Profile the render within the context if the render is sampled. The
+    stats are sent with the `template_profiled` signal at the end.
+    """
+    if _is_active() or not app.template_profile_rate or \
+            random.random() >= app.template_profile_rate:
+        # Nested renders are recorded in the outer profile
+        yield
+        return
+
+    # The templates are recorded in the order in which they complete
+    _state.stats = OrderedDict()
+    _state.queries = _state.field_loads = 0
+    try:
+        with _count_queries(), _count_field_loads():
+            yield
+    finally:
+        stats = _state.stats.values()
+        _state.stats = None
+
+    ctx = _request_ctx_stack.top
+    if ctx is not None:
+        if not hasattr(ctx, 'template_profile'):
+            ctx.template_profile = []
+        ctx.template_profile.extend(stats)
+    template_profiled.send(
+        app, template=template_name_or_list, stats=stats
+    )
+
+
+def add_profile_header(response):
+    """
+    An `after_request` function which adds the stats of the templates
+    profiled in the request to the response
+    """
+    stats = getattr(_request_ctx_stack.top, 'template_profile', None)
+    if stats:
+        response.headers['X-Nereid-Template-Profile'] = ', '.join([
+            '%s;count=%d;time=%.3f;queries=%d;field_loads=%d' % (
+                s['template'], s['count'], s['time'] * 1000, s['queries'],
+                s['field_loads'],
+            ) for s in stats
+        ])
+    return response
@@ -0,0 +1,156 @@
+# This file is part of Tryton & Nereid. The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""
+A per request view of the application cache which batches the round trips
+to the cache backend.
+
+When `CACHE_REQUEST_BUFFER` is set, :data:`nereid.globals.cache`, the
+session store and the fragment cache access the cache through the
+:class:`RequestCache` of the current request:
+
+* The keys declared by the functions registered with
+  :meth:`~nereid.application.Nereid.cache_prefetcher`, which are called
+  when the request first accesses the cache, are fetched along with the
+  first lookup of the request in a single `get_many`.
+* Values looked up are remembered for the rest of the request.
+* Values set are buffered and written in a single `set_many` (for each
+  timeout) when the request is torn down.
+"""
+from flask.globals import _request_ctx_stack
+
+__all__ = ['RequestCache', 'get_request_cache', 'flush_request_cache']
+
+
+class RequestCache(object):
+    """
+    A view of a cache backend for the duration of a request. It implements
+    the interface of the werkzeug cache backends.
+
+    :param cache: The cache backend
+    :param prefetch_keys: Keys to be fetched along with the first lookup
+
+    .. versionadded:: 3.4.0.6
+    """
+
+    def __init__(self, cache, prefetch_keys=()):
+        self.cache = cache
+        #: The number of calls made to the cache backend
+        self.round_trips = 0
+        self._values = {}
+        self._writes = {}
+        self._pending = list(prefetch_keys)
+
+    def prefetch(self, *keys):
+        """
+        Declare keys to be fetched along with the next lookup which is
+        not answered from the values already fetched.
+        """
+        self._pending.extend(keys)
+
+    def get_many(self, *keys):
+        missing = [key for key in keys if key not in self._values]
+        if missing:
+            fetch = []
+            for key in self._pending + missing:
+                if key not in self._values and key not in fetch:
+                    fetch.append(key)
+            self._pending = []
+            self.round_trips += 1
+            self._values.update(zip(fetch, self.cache.get_many(*fetch)))
+        return [self._values[key] for key in keys]
+
+    def get(self, key):
+        return self.get_many(key)[0]
+
+    def get_dict(self, *keys):
+        return dict(zip(keys, self.get_many(*keys)))
+
+    def _forget_write(self, key):
+        for writes in self._writes.itervalues():
+            writes.pop(key, None)
+
+    def set(self, key, value, timeout=None):
+        self._forget_write(key)
+        self._values[key] = value
+        self._writes.setdefault(timeout, {})[key] = value
+        return True
+
+    def set_many(self, mapping, timeout=None):
+        for key, value in dict(mapping).iteritems():
+            self.set(key, value, timeout)
+        return True
+
+    def add(self, key, value, timeout=None):
+        # The backend decides atomically if the key exists
+        self.flush()
+        self.round_trips += 1
+        rv = self.cache.add(key, value, timeout)
+        if rv:
+            self._values[key] = value
+        return rv
+
+    def delete(self, key):
+        return self.delete_many(key)
+
+    def delete_many(self, *keys):
+        for key in keys:
+            self._forget_write(key)
+            self._values[key] = None
+        self.round_trips += 1
+        return self.cache.delete_many(*keys)
+
+    def clear(self):
+        self._values.clear()
+        self._writes.clear()
+        self.round_trips += 1
+        return self.cache.clear()
+
+    def inc(self, key, delta=1):
+        self.flush()
+        self._values.pop(key, None)
+        self.round_trips += 1
+        return self.cache.inc(key, delta)
+
+    def dec(self, key, delta=1):
+        self.flush()
+        self._values.pop(key, None)
+        self.round_trips += 1
+        return self.cache.dec(key, delta)
+
+    def flush(self):
+        """
+        Write the buffered values to the cache backend
+        """
+        writes, self._writes = self._writes, {}
+        for timeout, mapping in writes.iteritems():
+            if mapping:
+                self.round_trips += 1
+                self.cache.set_many(mapping, timeout)
+
+
+def get_request_cache(app):
+    """
+    Returns the :class:`RequestCache` of the current request, or the cache
+    of the application if the buffer is disabled or there is no request.
+    """
+    ctx = _request_ctx_stack.top
+    if ctx is None or not app.cache_request_buffer or ctx.app is not app:
+        return app.cache
+
+    request_cache = getattr(ctx, 'request_cache', None)
+    if request_cache is None:
+        keys = []
+        for prefetcher in app.cache_prefetchers:
+            keys.extend(prefetcher(ctx.request))
+        request_cache = ctx.request_cache = RequestCache(app.cache, keys)
+    return request_cache
+
+
+def flush_request_cache(exception=None):
+    """
+    A `teardown_request` function which writes the values buffered in the
+    request
+    """
+    request_cache = getattr(_request_ctx_stack.top, 'request_cache', None)
+    if request_cache is not None:
+        request_cache.flush()
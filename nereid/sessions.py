@@ -1,14 +1,73 @@
 # This file is part of Tryton & Nereid. The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import os
+import sqlite3
+import threading
+from time import time, sleep
 from datetime import datetime  # noqa
+try:
+    import cPickle as pickle
+except ImportError:  # pragma: no cover
+    import pickle
 
-from flask.sessions import SessionInterface, SessionMixin
+from flask.globals import _request_ctx_stack
+from flask.sessions import SessionInterface, SessionMixin, \
+    session_json_serializer, total_seconds
+from flask.ext.login import LoginManager
+from itsdangerous import URLSafeTimedSerializer, BadSignature
 from werkzeug.contrib.sessions import Session as SessionBase, SessionStore
-from flask.globals import current_app
+
+from .globals import cache
+
+
+#: The key of the session holding the time it was last touched
+TOUCHED_KEY = '_touched'
+
+
+def _dumps(value):
+    return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
 
 
 class Session(SessionBase, SessionMixin):
-    "Nereid Default Session Object"
+    """
+    Nereid Default Session Object
+
+    The values of the session are serialised when it is opened, so that
+    the keys changed during the request are known, including the changes
+    to mutable values which do not mark the session as modified.
+    """
+
+    def __init__(self, data, sid, new=False):
+        super(Session, self).__init__(data, sid, new)
+        self.snapshot()
+
+    def snapshot(self):
+        """
+        Remember the serialised values of the session as unchanged
+        """
+        self._snapshot = dict(
+            (key, _dumps(value)) for key, value in self.iteritems()
+        )
+
+    @property
+    def dirty_keys(self):
+        """
+        The set of keys added, changed or removed since the session was
+        opened or last saved
+        """
+        snapshot = self._snapshot
+        keys = set(key for key in snapshot if key not in self)
+        for key, value in self.iteritems():
+            if key not in snapshot or snapshot[key] != _dumps(value):
+                keys.add(key)
+        return keys
+
+    @property
+    def is_empty(self):
+        """
+        True if the session holds no value other than its touch time
+        """
+        return not any(key != TOUCHED_KEY for key in self)
 
 
 class NullSession(Session):
@@ -27,6 +86,77 @@ class NullSession(Session):
     del _fail
 
 
+class LazySession(Session):
+    """
+    A session which is loaded from the session store only when it is first
+    accessed, so that the requests which do not use the session do not
+    call the store.
+
+    :param store: The session store
+    :param sid: The id of the session in the store
+
+    .. versionadded:: 3.4.0.6
+    """
+
+    def __init__(self, store, sid):
+        # Do not load the session to take the snapshot of the empty data
+        self.loaded = True
+        super(LazySession, self).__init__({}, sid, False)
+        self.store = store
+        self.loaded = False
+
+    def load(self):
+        """
+        Load the session from the store if it is not loaded yet
+        """
+        if self.loaded:
+            return
+        self.loaded = True
+        session = self.store.get(self.sid)
+        # The store starts a new session if the sid is not valid
+        self.sid, self.new = session.sid, session.new
+        dict.update(self, session)
+        self.snapshot()
+
+
+def _load_first(name):
+    method = getattr(Session, name)
+
+    def wrapper(self, *args, **kwargs):
+        if not self.loaded:
+            self.load()
+        return method(self, *args, **kwargs)
+    wrapper.__name__ = name
+    return wrapper
+
+
+for name in (
+        '__getitem__', '__setitem__', '__delitem__', '__contains__',
+        '__iter__', '__len__', '__eq__', '__ne__', '__repr__', 'get',
+        'has_key', 'keys', 'values', 'items', 'iterkeys', 'itervalues',
+        'iteritems', 'viewkeys', 'viewvalues', 'viewitems', 'copy',
+        'clear', 'pop', 'popitem', 'setdefault', 'update'):
+    setattr(LazySession, name, _load_first(name))
+del name
+
+
+class NereidLoginManager(LoginManager):
+    """
+    The login manager of nereid, which does not load the session after
+    the requests which did not use it.
+    """
+
+    def _update_remember_cookie(self, response):
+        # The session says if the remember cookie must change only if the
+        # request logged the user in or out
+        session = _request_ctx_stack.top.session
+        if isinstance(session, LazySession) and not session.loaded:
+            return response
+        return super(NereidLoginManager, self)._update_remember_cookie(
+            response
+        )
+
+
 class MemcachedSessionStore(SessionStore):
     """
     Session store that stores session on memcached
@@ -41,7 +171,7 @@ class MemcachedSessionStore(SessionStore):
         """
         Updates the session
         """
-        current_app.cache.set(
+        cache.set(
             session.sid, dict(session), 30 * 24 * 60 * 60
         )
 
@@ -49,7 +179,7 @@ class MemcachedSessionStore(SessionStore):
         """
         Deletes the session
         """
-        current_app.cache.delete(session.sid)
+        cache.delete(session.sid)
 
     def get(self, sid):
         """
@@ -57,7 +187,7 @@ class MemcachedSessionStore(SessionStore):
         """
         if not self.is_valid_key(sid):
             return self.new()
-        session_data = current_app.cache.get(sid)
+        session_data = cache.get(sid)
         if session_data is None:
             session_data = {}
         return self.session_class(session_data, sid, False)
@@ -69,6 +199,180 @@ class MemcachedSessionStore(SessionStore):
         raise Exception("Not implemented yet")
 
 
+class SQLiteSessionStore(SessionStore):
+    """
+    Session store that stores the sessions in a SQLite database in WAL
+    mode, which is shared by the processes of the host and is durable,
+    unlike memcached which evicts sessions under memory pressure.
+
+    The sessions are indexed by their expiry and by the id of the user
+    logged in (the `user_id` of Flask-Login), so that the expired sessions
+    are deleted in batches and all the sessions of a user are revoked at
+    once. The expired sessions are deleted by a background thread every
+    `sweep_interval` seconds.
+
+    To use it, set the session store of the session interface::
+
+        app.session_interface.session_store = SQLiteSessionStore(
+            '/var/lib/my-site/sessions.db'
+        )
+
+    :param path: The path of the database
+    :param timeout: The time in seconds after which a session which is not
+                    saved again expires
+    :param sweep_interval: The time in seconds between the sweeps of the
+                           expired sessions, or `None` to not sweep them in
+                           the background
+    :param sweep_batch_size: The number of sessions deleted in a statement
+    :param session_class: The session class to use.
+
+    .. versionadded:: 3.4.0.6
+    """
+
+    def __init__(
+            self, path, timeout=30 * 24 * 60 * 60, sweep_interval=300,
+            sweep_batch_size=1000, session_class=Session):
+        SessionStore.__init__(self, session_class)
+        self.path = path
+        self.timeout = timeout
+        self.sweep_interval = sweep_interval
+        self.sweep_batch_size = sweep_batch_size
+        self._local = threading.local()
+        self._sweeper_pid = None
+        self._sweeper_lock = threading.Lock()
+
+        connection = self._connect()
+        connection.executescript("""
+            CREATE TABLE IF NOT EXISTS session (
+                sid TEXT PRIMARY KEY,
+                data BLOB NOT NULL,
+                user_id INTEGER,
+                expires REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS session_expires
+                ON session (expires);
+            CREATE INDEX IF NOT EXISTS session_user_id
+                ON session (user_id);
+        """)
+
+    def _connect(self):
+        """
+        Returns the connection of the thread, which is opened again in
+        forked processes
+        """
+        pid = os.getpid()
+        if getattr(self._local, 'pid', None) != pid:
+            connection = sqlite3.connect(
+                self.path, timeout=30, isolation_level=None
+            )
+            connection.text_factory = str
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+            self._local.pid = pid
+        return self._local.connection
+
+    @property
+    def connection(self):
+        if self.sweep_interval and self._sweeper_pid != os.getpid():
+            self.start_sweeper()
+        return self._connect()
+
+    def save(self, session):
+        """
+        Saves the session
+        """
+        self.connection.execute(
+            'INSERT OR REPLACE INTO session (sid, data, user_id, expires) '
+            'VALUES (?, ?, ?, ?)', (
+                session.sid,
+                sqlite3.Binary(_dumps(dict(session))),
+                session.get('user_id'),
+                time() + self.timeout,
+            )
+        )
+
+    def delete(self, session):
+        """
+        Deletes the session
+        """
+        self.connection.execute(
+            'DELETE FROM session WHERE sid = ?', (session.sid, )
+        )
+
+    def get(self, sid):
+        """
+        Returns session
+        """
+        if not self.is_valid_key(sid):
+            return self.new()
+        row = self.connection.execute(
+            'SELECT data FROM session WHERE sid = ? AND expires > ?',
+            (sid, time())
+        ).fetchone()
+        session_data = {}
+        if row is not None:
+            session_data = pickle.loads(str(row[0]))
+        return self.session_class(session_data, sid, False)
+
+    def list(self):
+        """
+        Lists the ids of the sessions which did not expire
+        """
+        return [row[0] for row in self.connection.execute(
+            'SELECT sid FROM session WHERE expires > ?', (time(), )
+        )]
+
+    def revoke_user(self, user_id):
+        """
+        Deletes all the sessions of the user and returns their number
+        """
+        return self.connection.execute(
+            'DELETE FROM session WHERE user_id = ?', (user_id, )
+        ).rowcount
+
+    def sweep(self):
+        """
+        Deletes the expired sessions in batches and returns their number
+        """
+        connection = self._connect()
+        deleted = 0
+        while True:
+            count = connection.execute(
+                'DELETE FROM session WHERE rowid IN ('
+                'SELECT rowid FROM session WHERE expires <= ? LIMIT ?)',
+                (time(), self.sweep_batch_size)
+            ).rowcount
+            deleted += count
+            if count < self.sweep_batch_size:
+                return deleted
+
+    def start_sweeper(self):
+        """
+        Starts the background thread sweeping the expired sessions, once in
+        each process
+        """
+        with self._sweeper_lock:
+            if self._sweeper_pid == os.getpid():
+                return
+            self._sweeper_pid = os.getpid()
+            thread = threading.Thread(
+                target=self._run_sweeper, name='nereid-session-sweeper'
+            )
+            thread.daemon = True
+            thread.start()
+
+    def _run_sweeper(self):
+        pid = os.getpid()
+        while self._sweeper_pid == pid:
+            sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except sqlite3.Error:
+                # Retry on the next sweep, if the database was locked
+                pass
+
+
 class NereidSessionInterface(SessionInterface):
     """Session Management Class"""
 
@@ -77,13 +381,14 @@ class NereidSessionInterface(SessionInterface):
 
     def open_session(self, app, request):
         """
-        Creates or opens a new session.
+        Creates or opens a new session. An existing session is loaded from
+        the store when it is first accessed.
 
         :param request: an instance of :attr:`request_class`.
         """
         sid = request.cookies.get(app.session_cookie_name, None)
         if sid:
-            return self.session_store.get(sid)
+            return LazySession(self.session_store, sid)
         else:
             return self.session_store.new()
 
@@ -92,11 +397,32 @@ class NereidSessionInterface(SessionInterface):
         Saves the session if it needs updates.  For the default
         implementation, check :meth:`open_session`.
 
+        The session is written only if a value changed, so the requests
+        which only read the session or set the same values again do not
+        write it. Sessions with no values are not created, and removed if
+        they were stored.
+
+        Unchanged sessions are written at most once in the number of seconds
+        of the `SESSION_TOUCH_INTERVAL`, if it is set, to extend their
+        expiry while they are used.
+
         :param session: the session to be saved
         :param response: an instance of :attr:`response_class`
         """
-        if session.should_save:
+        if isinstance(session, LazySession) and not session.loaded:
+            # The session was not used
+            return
+
+        write = self.needs_write(app, session)
+        if session.is_empty:
+            if write and not session.new:
+                # Everything was removed from the stored session
+                self.session_store.delete(session)
+            return
+
+        if write:
             self.session_store.save(session)
+            session.snapshot()
             expires = self.get_expiration_time(app, session)
             domain = self.get_cookie_domain(app)
 
@@ -110,3 +436,133 @@ class NereidSessionInterface(SessionInterface):
                     app.session_cookie_name, session.sid,
                     expires=expires, httponly=False, domain=domain
                 )
+
+    def needs_write(self, app, session):
+        """
+        Returns True if a value of the session changed, or if the session
+        must be touched to extend its expiry, in which case the touch time
+        is updated.
+        """
+        # Values changed in place do not mark the session modified
+        dirty = bool(session.dirty_keys)
+        interval = app.session_touch_interval
+        if interval and not session.is_empty:
+            now = int(time())
+            if dirty or now - session.get(TOUCHED_KEY, 0) >= interval:
+                session[TOUCHED_KEY] = now
+                return True
+        return dirty
+
+
+class HybridSessionInterface(NereidSessionInterface):
+    """
+    A session interface which keeps small sessions in a signed and
+    compressed cookie, so that they need no round trip to the session
+    store. Sessions whose cookie would be larger than the
+    `SESSION_COOKIE_THRESHOLD` in bytes, or which hold values which can
+    not be serialised to JSON, are saved in the :attr:`session_store` and
+    the cookie holds the session id, like the
+    :class:`NereidSessionInterface`.
+
+    A session moves between the two forms as it grows and shrinks, and is
+    removed from the store when it moves to the cookie.
+
+    To use it, set the session interface of the application::
+
+        app.session_interface = HybridSessionInterface()
+
+    .. versionadded:: 3.4.0.6
+    """
+
+    salt = 'nereid-session'
+
+    def get_signing_serializer(self, app):
+        return URLSafeTimedSerializer(
+            app.secret_key, salt=self.salt,
+            serializer=session_json_serializer
+        )
+
+    def open_session(self, app, request):
+        """
+        Opens the session from the cookie, or from the store when it is
+        first accessed if the cookie holds the session id.
+
+        :param request: an instance of :attr:`request_class`.
+        """
+        value = request.cookies.get(app.session_cookie_name, None)
+        if value and '.' not in value:
+            # The session ids have no dots, unlike the signed data
+            return LazySession(self.session_store, value)
+
+        if value:
+            max_age = total_seconds(app.permanent_session_lifetime)
+            try:
+                data = self.get_signing_serializer(app).loads(
+                    value, max_age=max_age
+                )
+            except BadSignature:
+                pass
+            else:
+                # The session is not in the store, hence new
+                return self.session_store.session_class(
+                    data, self.session_store.generate_key(), True
+                )
+        return self.session_store.new()
+
+    def save_session(self, app, session, response):
+        """
+        Saves the session in the cookie, or in the store if it is too large
+        for the cookie.
+
+        :param session: the session to be saved
+        :param response: an instance of :attr:`response_class`
+        """
+        if isinstance(session, LazySession) and not session.loaded:
+            # The session was not used
+            return
+
+        write = self.needs_write(app, session)
+        domain = self.get_cookie_domain(app)
+
+        from nereid.globals import request
+        value = request.cookies.get(app.session_cookie_name, None)
+
+        if session.is_empty:
+            if write:
+                if not session.new:
+                    self.session_store.delete(session)
+                if value:
+                    response.delete_cookie(
+                        app.session_cookie_name, domain=domain
+                    )
+            return
+
+        if not write:
+            return
+
+        try:
+            data = self.get_signing_serializer(app).dumps(dict(session))
+        except TypeError:
+            # Values which can only be pickled
+            data = None
+
+        if data is not None and len(data) <= app.session_cookie_threshold:
+            if not session.new:
+                # The session moves from the store to the cookie
+                self.session_store.delete(session)
+                session.new = True
+            value = data
+        else:
+            self.session_store.save(session)
+            session.new = False
+            if value == session.sid:
+                session.snapshot()
+                return
+            value = session.sid
+
+        session.snapshot()
+        response.set_cookie(
+            app.session_cookie_name, value,
+            expires=self.get_expiration_time(app, session),
+            httponly=False, domain=domain
+        )
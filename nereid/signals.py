@@ -24,3 +24,8 @@ registration = _signals.signal('registration')
 
 transaction_start = _signals.signal('nereid.transaction.start')
 transaction_stop = _signals.signal('nereid.transaction.stop')
+
+#: Template profiled
+#: Triggered after a sampled render of a template is profiled. The stats
+#: of every template rendered are sent as a list of dictionaries
+template_profiled = _signals.signal('nereid.template.profiled')
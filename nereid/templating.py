@@ -2,24 +2,32 @@
 # This file is part of Tryton & Nereid. The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
 import os
+import re
 import contextlib
+import multiprocessing
 from decimal import Decimal
+from itertools import islice
 
-from flask.templating import render_template as flask_render_template
+from flask.templating import _render as flask_render
 from jinja2 import (BaseLoader, TemplateNotFound, nodes, Template,  # noqa
-        ChoiceLoader, FileSystemLoader, BaseLoader)
+        ChoiceLoader, FileSystemLoader, BaseLoader, Markup, meta)
+from werkzeug.local import Local
 from speaklater import _LazyString
 from jinja2.ext import Extension
+from itsdangerous import URLSafeSerializer, BadSignature
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.MIMEBase import MIMEBase
 from email.header import Header
 from email import Encoders, Charset
 import trytond.tools as tools
+from trytond.pool import Pool
 from trytond.transaction import Transaction
 
 from .globals import request, current_app  # noqa
-from .helpers import _rst_to_html_filter, make_crumbs
+from .helpers import _rst_to_html_filter, make_crumbs, key_from_list, \
+    forget_inherited_transaction
+from .profiling import profile_render
 
 
 # Override python's weird assumption that utf-8 text should be encoded with
@@ -100,9 +108,12 @@ class LazyRenderer(_LazyString):
         """
         Return the rendered template with the current context
         """
-        return flask_render_template(
-            self.template_name_or_list, **self.context
-        )
+        with profile_render(
+                current_app._get_current_object(),
+                self.template_name_or_list):
+            return _render_template(
+                self.template_name_or_list, **self.context
+            )
 
     def __getstate__(self):
         return (
@@ -117,6 +128,125 @@ class LazyRenderer(_LazyString):
                 self.headers, self.status = tup
 
 
+class CachedLazyRenderer(LazyRenderer):
+    """
+    A :class:`LazyRenderer` which caches the rendered page in the
+    application cache. The blocks of the template marked as dynamic with
+    the `{% dynamic %}` tag are not cached, but replaced with placeholders
+    which are rendered and spliced into the cached page on every render.
+
+    Use :func:`render_cached_template` to create one.
+    """
+
+    __slots__ = ('cache_key', 'cache_timeout', 'cache_tags')
+
+    def __init__(
+        self, template_name_or_list, context, cache_key, cache_timeout=None,
+        cache_tags=None, headers=None, eager=False
+    ):
+        self.cache_key = cache_key
+        self.cache_timeout = cache_timeout
+        self.cache_tags = cache_tags
+        super(CachedLazyRenderer, self).__init__(
+            template_name_or_list, context, headers, eager
+        )
+
+    def render(self):
+        """
+        Return the cached page with the dynamic blocks rendered in the
+        current context. The page is cached for each language, website and
+        template.
+        """
+        website = request.nereid_website
+        key = current_app.cache_key_prefix + '-page-' + key_from_list([
+            Transaction().language, website and website.id,
+            self.template_name_or_list, self.cache_key
+        ])
+        if self.cache_tags:
+            key = current_app.cache_tags.versioned_key(key, self.cache_tags)
+
+        rv = current_app.cache.get(key)
+        if rv is None:
+            with defer_dynamic_blocks():
+                rv = super(CachedLazyRenderer, self).render()
+            current_app.cache.set(key, rv, self.cache_timeout)
+        return render_dynamic_blocks(rv)
+
+    def __getstate__(self):
+        return super(CachedLazyRenderer, self).__getstate__() + (
+            self.cache_key,
+            self.cache_timeout,
+            self.cache_tags,
+        )
+
+    def __setstate__(self, tup):
+        super(CachedLazyRenderer, self).__setstate__(tup[:4])
+        self.cache_key, self.cache_timeout, self.cache_tags = tup[4:]
+
+
+def _render_template(template_name_or_list, **context):
+    """
+    Render the template like :func:`flask.render_template`, but call only
+    the lazy context processors of the variables the template references.
+    """
+    app = current_app._get_current_object()
+    template = app.jinja_env.get_or_select_template(template_name_or_list)
+    app.update_template_context(context, template)
+    return flask_render(template, context, app)
+
+
+def find_template_variables(environment, template_name, _seen=None):
+    """
+    Returns a frozenset of the names of the variables the template, and the
+    templates it includes, imports or extends, look up in the context.
+
+    The templates are found by static analysis and if any of them cannot be
+    determined (like a template extending a variable) or loaded, None is
+    returned as the variables could be any.
+
+    .. versionadded:: 3.4.0.6
+    """
+    if _seen is None:
+        _seen = set()
+    _seen.add(template_name)
+
+    try:
+        source, filename, _ = environment.loader.get_source(
+            environment, template_name
+        )
+    except TemplateNotFound:
+        return None
+    ast = environment.parse(source, template_name, filename)
+
+    names = set(meta.find_undeclared_variables(ast))
+    for referenced in meta.find_referenced_templates(ast):
+        if referenced is None:
+            return None
+        if referenced in _seen:
+            continue
+        referenced_names = find_template_variables(
+            environment, referenced, _seen
+        )
+        if referenced_names is None:
+            return None
+        names.update(referenced_names)
+    return frozenset(names)
+
+
+def _get_template_names(template_name_or_list):
+    """
+    Prefix the name of the website to the template name if the application
+    is configured to do so.
+    """
+    if current_app.template_prefix_website_name and \
+            isinstance(template_name_or_list, basestring):
+        template_name_or_list = [
+            '/'.join([request.nereid_website.name, template_name_or_list]),
+            template_name_or_list
+        ]
+    return template_name_or_list
+
+
 def render_template(template_name_or_list, **context):
     """
     Returns a lazy renderer object which renders a template from the
@@ -133,19 +263,118 @@ def render_template(template_name_or_list, **context):
     :param context: the variables that should be available in the
                     context of the template.
     """
-    if current_app.template_prefix_website_name and \
-            isinstance(template_name_or_list, basestring):
-        template_name_or_list = [
-            '/'.join([request.nereid_website.name, template_name_or_list]),
-            template_name_or_list
-        ]
     return LazyRenderer(
-        template_name_or_list,
+        _get_template_names(template_name_or_list),
+        context,
+        eager=current_app.eager_template_render
+    )
+
+
+def render_cached_template(
+        cache_key, template_name_or_list, cache_timeout=None, cache_tags=None,
+        **context):
+    """
+    Like :func:`render_template`, but the rendered page is cached in the
+    application cache. Blocks which differ for every visitor (like the
+    cart or the name of the user) could be marked as dynamic in the
+    template::
+
+        {% dynamic 'cart-badge.jinja', currency=currency.code %}
+
+    The page is cached with placeholders for such blocks and only the
+    dynamic blocks are rendered when the page is served from the cache.
+
+    .. note::
+
+        The dynamic blocks are rendered with the context processors and the
+        given keyword arguments alone. The context of the page is not
+        available to them as it is not rendered on a cache hit. The keyword
+        arguments are evaluated when the page is cached, so values which
+        differ for every visitor must come from the context processors
+        (like `current_user`). They are stored in the cached page, signed
+        with the secret key of the application, so they must be JSON
+        serializable.
+
+    :param cache_key: key identifying the page. The language of the
+                      transaction, the website of the request and the
+                      template names are added to the key.
+    :param template_name_or_list: the name of the template to be rendered,
+                                  or an iterable with template names the
+                                  first one existing will be rendered
+    :param cache_timeout: time in seconds for which the page is cached
+    :param cache_tags: tags the page depends on. See
+                       :class:`~nereid.cache_tags.CacheTagStore`.
+    :param context: the variables that should be available in the
+                    context of the template.
+    """
+    return CachedLazyRenderer(
+        _get_template_names(template_name_or_list),
         context,
+        cache_key,
+        cache_timeout=cache_timeout,
+        cache_tags=cache_tags,
         eager=current_app.eager_template_render
     )
 
 
+#: Tracks the number of cached renders (pages or fragments) in progress in
+#: the current context. Dynamic blocks rendered within one are deferred.
+_dynamic_blocks = Local()
+
+_DYNAMIC_BLOCK_RE = re.compile(r'<!--nereid-dynamic:([A-Za-z0-9_.=-]+)-->')
+
+
+def _get_dynamic_block_serializer():
+    """
+    Returns the serializer which signs the template name and context of
+    the dynamic block placeholders with the secret key of the application.
+    Placeholders could end up in the output from anything rendered without
+    autoescaping, so only the signed ones are rendered.
+    """
+    return URLSafeSerializer(
+        current_app.secret_key, salt='nereid-dynamic-block'
+    )
+
+
+@contextlib.contextmanager
+def defer_dynamic_blocks():
+    """
+    A context manager within which dynamic blocks are rendered as
+    placeholders instead of being rendered.
+    """
+    _dynamic_blocks.depth = getattr(_dynamic_blocks, 'depth', 0) + 1
+    try:
+        yield
+    finally:
+        _dynamic_blocks.depth -= 1
+
+
+def render_dynamic_blocks(value):
+    """
+    Render the dynamic blocks for which the value has placeholders and
+    splice them in. The placeholders are left as such if this is called
+    when dynamic blocks are deferred. Placeholders without a valid signature
+    are removed.
+    """
+    if getattr(_dynamic_blocks, 'depth', 0) or \
+            '<!--nereid-dynamic:' not in value:
+        return value
+
+    serializer = _get_dynamic_block_serializer()
+
+    def render_block(match):
+        try:
+            template_name, context = serializer.loads(match.group(1))
+        except (BadSignature, TypeError, ValueError):
+            return u''
+        return _render_template(template_name, **context)
+
+    rv = _DYNAMIC_BLOCK_RE.sub(render_block, value)
+    if isinstance(value, Markup):
+        rv = Markup(rv)
+    return rv
+
+
 def nereid_default_template_ctx_processor():
     """Add Decimal and make_crumbs to template context"""
     return dict(
@@ -250,8 +479,27 @@ class ModuleTemplateLoader(ChoiceLoader):
 
 
 class FragmentCacheExtension(Extension):
+    """
+    Caches the rendered fragment of a template::
+
+        {% cache key, 3600 %}...{% endcache %}
+
+    The fragment could also declare the tags it depends on. Invalidating
+    any of the tags with :func:`nereid.cache_tags.invalidate_cache_tags`
+    makes the fragment a miss on the next render::
+
+        {% cache key, 3600, tags=['product.product:42'] %}...{% endcache %}
+
+    Blocks which differ for every visitor could be punched out of the
+    cached fragments and pages (see :func:`render_cached_template`) by
+    rendering them with the dynamic tag. The template is rendered with the
+    context processors and the given keyword arguments, which are evaluated
+    when the enclosing fragment is cached::
+
+        {% dynamic 'cart-badge.jinja', currency=currency.code %}
+    """
     # a set of names that trigger the extension.
-    tags = set(['cache'])
+    tags = set(['cache', 'dynamic'])
 
     def __init__(self, environment):
         super(FragmentCacheExtension, self).__init__(environment)
@@ -259,7 +507,8 @@ class FragmentCacheExtension(Extension):
         # add the defaults to the environment
         environment.extend(
             fragment_cache_prefix='',
-            fragment_cache=None
+            fragment_cache=None,
+            fragment_cache_tags=None,
         )
 
     def parse(self, parser):
@@ -267,17 +516,26 @@ class FragmentCacheExtension(Extension):
         # we only listen to ``'cache'`` so this will be a name token with
         # `cache` as value.  We get the line number so that we can give
         # that line number to the nodes we create by hand.
-        lineno = parser.stream.next().lineno
+        token = parser.stream.next()
+        lineno = token.lineno
+
+        if token.value == 'dynamic':
+            return self.parse_dynamic(parser, lineno)
 
         # now we parse a single expression that is used as cache key.
         args = [parser.parse_expression()]
 
-        # if there is a comma, the user provided a timeout.  If not use
-        # None as second parameter.
-        if parser.stream.skip_if('comma'):
-            args.append(parser.parse_expression())
-        else:
-            args.append(nodes.Const(None))
+        # if there is a comma, the user provided a timeout, the tags the
+        # fragment depends on or both.  Use None for the ones not given.
+        timeout, tags = nodes.Const(None), nodes.Const(None)
+        while parser.stream.skip_if('comma'):
+            if parser.stream.current.test('name:tags') and \
+                    parser.stream.look().test('assign'):
+                parser.stream.skip(2)
+                tags = parser.parse_expression()
+            else:
+                timeout = parser.parse_expression()
+        args.extend([timeout, tags])
 
         # now we parse the body of the cache block up to `endcache` and
         # drop the needle (which would always be `endcache` in that case)
@@ -288,19 +546,57 @@ class FragmentCacheExtension(Extension):
         return nodes.CallBlock(self.call_method('_cache_support', args),
                                [], [], body).set_lineno(lineno)
 
-    def _cache_support(self, name, timeout, caller):
+    def _cache_support(self, name, timeout, tags, caller):
         """Helper callback."""
         key = self.environment.fragment_cache_prefix + name
+        if tags and self.environment.fragment_cache_tags is not None:
+            # The key changes when any of the tags is invalidated
+            key = self.environment.fragment_cache_tags.versioned_key(
+                key, tags
+            )
 
         # try to load the block from the cache
         # if there is no fragment in the cache, render it and store
         # it in the cache.
         rv = self.environment.fragment_cache.get(key)
-        if rv is not None:
-            return rv
-        rv = caller()
-        self.environment.fragment_cache.add(key, rv, timeout)
-        return rv
+        if rv is None:
+            with defer_dynamic_blocks():
+                rv = caller()
+            self.environment.fragment_cache.add(key, rv, timeout)
+        return render_dynamic_blocks(rv)
+
+    def parse_dynamic(self, parser, lineno):
+        """
+        Parse the dynamic tag which takes the name of the template to be
+        rendered followed by keyword arguments for its context.
+        """
+        args = [parser.parse_expression()]
+        kwargs = []
+        while parser.stream.skip_if('comma'):
+            key = parser.stream.expect('name')
+            parser.stream.expect('assign')
+            kwargs.append(
+                nodes.Keyword(
+                    key.value, parser.parse_expression(), lineno=key.lineno
+                )
+            )
+        return nodes.Output([
+            self.call_method('_dynamic_support', args, kwargs)
+        ]).set_lineno(lineno)
+
+    def _dynamic_support(self, *args, **context):
+        """
+        Render the template of the dynamic block, or a placeholder for it
+        if the block is part of a page or fragment being cached. The
+        context of the placeholder is serialized as JSON, so the keyword
+        arguments must be JSON serializable.
+        """
+        template_name, = args
+        if not getattr(_dynamic_blocks, 'depth', 0):
+            return Markup(_render_template(template_name, **context))
+        return Markup('<!--nereid-dynamic:%s-->' % (
+            _get_dynamic_block_serializer().dumps([template_name, context])
+        ))
 
 
 def render_email(
@@ -326,20 +622,56 @@ def render_email(
     if not (text_template or html_template):
         raise Exception("Atleast HTML or TEXT template is required")
 
-    text_part = None
+    text = None
     if text_template:
         if isinstance(text_template, Template):
             text = text_template.render(**context)
         else:
             text = unicode(render_template(text_template, **context))
-        text_part = MIMEText(text.encode("utf-8"), 'plain', _charset="UTF-8")
 
-    html_part = None
+    html = None
     if html_template:
         if isinstance(html_template, Template):
             html = html_template.render(**context)
         else:
             html = unicode(render_template(html_template, **context))
+
+    return _make_email_message(
+        from_email, to, subject, text, html, cc,
+        _make_attachment_parts(attachments)
+    )
+
+
+def _make_attachment_parts(attachments):
+    """
+    Returns the MIME parts for the attachments, a dict of filename:string
+    """
+    parts = []
+    for filename, content in (attachments or {}).items():
+        part = MIMEBase('application', "octet-stream")
+        part.set_payload(content)
+        Encoders.encode_base64(part)
+        # XXX: Filename might have to be encoded with utf-8,
+        # i.e., part's encoding or with email's encoding
+        part.add_header(
+            'Content-Disposition', 'attachment; filename="%s"' % filename
+        )
+        parts.append(part)
+    return parts
+
+
+def _make_email_message(
+        from_email, to, subject, text, html, cc, attachment_parts):
+    """
+    Construct the email message from the rendered text and html, and the
+    MIME parts of the attachments
+    """
+    text_part = None
+    if text is not None:
+        text_part = MIMEText(text.encode("utf-8"), 'plain', _charset="UTF-8")
+
+    html_part = None
+    if html is not None:
         html_part = MIMEText(html.encode("utf-8"), 'html', _charset="UTF-8")
 
     if text_part and html_part:
@@ -352,7 +684,7 @@ def render_email(
         # only one part exists, so use that as the message body.
         message = text_part or html_part
 
-    if attachments:
+    if attachment_parts:
         # If an attachment exists, the MimeType should be mixed and the
         # message body should just be another part of it.
         message_with_attachments = MIMEMultipart('mixed')
@@ -363,15 +695,7 @@ def render_email(
         # Now the message _with_attachments itself becomes the message
         message = message_with_attachments
 
-        for filename, content in attachments.items():
-            part = MIMEBase('application', "octet-stream")
-            part.set_payload(content)
-            Encoders.encode_base64(part)
-            # XXX: Filename might have to be encoded with utf-8,
-            # i.e., part's encoding or with email's encoding
-            part.add_header(
-                'Content-Disposition', 'attachment; filename="%s"' % filename
-            )
+        for part in attachment_parts:
             message.attach(part)
 
     if isinstance(to, (list, tuple)):
@@ -386,3 +710,186 @@ def render_email(
         message['Cc'] = Header(unicode(cc), 'ISO-8859-1')
 
     return message
+
+
+class _BulkEmailRenderer(object):
+    """
+    Renders the email message of a recipient with the templates compiled
+    and the shared context evaluated only once for all the recipients.
+    """
+
+    def __init__(
+            self, from_email, subject, text_template, html_template, cc,
+            attachment_parts, context):
+        self.from_email = from_email
+        self.subject = unicode(subject)
+        self.text_template = text_template
+        self.html_template = html_template
+        self.cc = cc
+        self.attachment_parts = attachment_parts
+        self.context = context
+
+    def __call__(self, recipient):
+        to, recipient_context = recipient
+        context = dict(self.context, **recipient_context)
+
+        text = html = None
+        if self.text_template is not None:
+            text = self.text_template.render(context)
+        if self.html_template is not None:
+            html = self.html_template.render(context)
+
+        return to, _make_email_message(
+            self.from_email, to, self.subject, text, html, self.cc,
+            self.attachment_parts
+        ).as_string()
+
+
+#: The renderer used by the worker processes of :func:`render_emails`. The
+#: workers are forked and inherit it, so only the recipients are pickled.
+_bulk_email_renderer = None
+
+
+def _init_bulk_email_worker(database_name, user, context):
+    """
+    Forget the transaction and the database connections inherited from the
+    parent process, and start a read only transaction with a connection of
+    the worker.
+    """
+    forget_inherited_transaction()
+    if database_name is not None:
+        Transaction().start(
+            database_name, user, readonly=True, context=context
+        )
+
+
+def _render_bulk_email(recipient):
+    return _bulk_email_renderer(recipient)
+
+
+def render_emails(
+        from_email, recipients, subject, text_template=None,
+        html_template=None, cc=None, attachments=None, processes=None,
+        **context):
+    """
+    Render an email message for each of the recipients. Unlike calling
+    :func:`render_email` for each recipient, the templates are compiled,
+    the context processors are evaluated and the attachments are encoded
+    only once.
+
+    The templates are loaded when this is called, while the messages are
+    rendered as the returned generator is consumed.
+
+    :param from_email: Email From
+    :param recipients: An iterable of `(to, context)` pairs, where the
+                       context has the variables which vary for the
+                       recipient.
+    :param subject: Email subject
+    :param text_template: Text email template name or a template
+    :param html_template: HTML email template name or a template
+    :param cc: Email IDs of Cc recepients
+    :param attachments: A dict of filename:string as key value pair
+    :param processes: If given, the messages are rendered by a pool of as
+                      many worker processes. The recipient contexts must
+                      be picklable. Each worker starts a read only
+                      transaction of its own, so the templates do not see
+                      the changes not committed by the current transaction.
+    :param context: The variables shared by all the recipients
+
+    :return: A generator of `(to, message)` pairs, where the message is the
+             email as a string
+    """
+    if not (text_template or html_template):
+        raise Exception("Atleast HTML or TEXT template is required")
+
+    app = current_app._get_current_object()
+    templates = []
+    for template in (text_template, html_template):
+        if template is not None and not isinstance(template, Template):
+            template = app.jinja_env.get_or_select_template(
+                _get_template_names(template)
+            )
+        templates.append(template)
+
+    for template in templates:
+        if template is not None:
+            app.update_template_context(context, template)
+
+    renderer = _BulkEmailRenderer(
+        from_email, subject, templates[0], templates[1], cc,
+        _make_attachment_parts(attachments), context
+    )
+    return _render_emails(renderer, recipients, processes)
+
+
+def _render_emails(renderer, recipients, processes):
+    """
+    Returns a generator of the messages of the recipients rendered by the
+    renderer, in a pool of worker processes if `processes` is given.
+    """
+    global _bulk_email_renderer
+
+    if not processes:
+        for recipient in recipients:
+            yield renderer(recipient)
+        return
+
+    transaction = Transaction()
+    database_name = None
+    if transaction.database is not None:
+        database_name = transaction.database.database_name
+
+    # The workers inherit the renderer when they are forked
+    _bulk_email_renderer = renderer
+    pool = multiprocessing.Pool(
+        processes, _init_bulk_email_worker,
+        (database_name, transaction.user, transaction.context)
+    )
+    try:
+        for rv in pool.imap(_render_bulk_email, recipients, chunksize=50):
+            yield rv
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        _bulk_email_renderer = None
+
+
+def queue_emails(
+        from_email, recipients, subject, text_template=None,
+        html_template=None, cc=None, attachments=None, processes=None,
+        chunk_size=500, **context):
+    """
+    Render the email messages of the recipients with :func:`render_emails`
+    and add them to the email queue. The messages are created in the queue
+    in chunks of `chunk_size`. The messages are sent to the Cc recipients
+    too.
+
+    Returns the number of messages queued.
+    """
+    EmailQueue = Pool().get('email.queue')
+
+    def addresses(value):
+        if not value:
+            return []
+        if isinstance(value, (list, tuple)):
+            return list(value)
+        return [value]
+    cc_addrs = addresses(cc)
+
+    messages = render_emails(
+        from_email, recipients, subject, text_template, html_template, cc,
+        attachments, processes, **context
+    )
+    count = 0
+    while True:
+        chunk = list(islice(messages, chunk_size))
+        if not chunk:
+            break
+        EmailQueue.create([{
+            'from_addr': from_email,
+            'to_addrs': ','.join(addresses(to) + cc_addrs),
+            'msg': message,
+        } for to, message in chunk])
+        count += len(chunk)
+    return count
@@ -2,10 +2,17 @@
 # this repository contains the full copyright notices and license terms.
 import unittest
 
-from .test_templates import TestTemplateLoading, TestLazyRendering
+from .test_templates import TestTemplateLoading, TestLazyRendering, \
+    TestFragmentCache, TestLazyContextProcessors
 from .test_helpers import TestURLfor, TestHelperFunctions
 from .test_signals import SignalsTestCase
 from .test_pagination import TestPagination
+from .test_cache_backends import TestTwoTierCache, TestSharedMemoryCache, \
+    TestCodecCache
+from .test_memoize import TestMemoize
+from .test_request_cache import TestRequestCache
+from .test_cache_stats import TestCacheStats
+from .test_sessions import TestSessions, TestSQLiteSessionStore
 
 
 def suite():
@@ -14,9 +21,21 @@ def suite():
     test_suite.addTests([
         unittest.TestLoader().loadTestsFromTestCase(TestTemplateLoading),
         unittest.TestLoader().loadTestsFromTestCase(TestLazyRendering),
+        unittest.TestLoader().loadTestsFromTestCase(TestFragmentCache),
+        unittest.TestLoader().loadTestsFromTestCase(
+            TestLazyContextProcessors
+        ),
         unittest.TestLoader().loadTestsFromTestCase(TestURLfor),
         unittest.TestLoader().loadTestsFromTestCase(TestHelperFunctions),
         unittest.TestLoader().loadTestsFromTestCase(SignalsTestCase),
         unittest.TestLoader().loadTestsFromTestCase(TestPagination),
+        unittest.TestLoader().loadTestsFromTestCase(TestTwoTierCache),
+        unittest.TestLoader().loadTestsFromTestCase(TestSharedMemoryCache),
+        unittest.TestLoader().loadTestsFromTestCase(TestCodecCache),
+        unittest.TestLoader().loadTestsFromTestCase(TestMemoize),
+        unittest.TestLoader().loadTestsFromTestCase(TestRequestCache),
+        unittest.TestLoader().loadTestsFromTestCase(TestCacheStats),
+        unittest.TestLoader().loadTestsFromTestCase(TestSessions),
+        unittest.TestLoader().loadTestsFromTestCase(TestSQLiteSessionStore),
     ])
     return test_suite
@@ -0,0 +1,448 @@
+# -*- coding: utf-8 -*-
+# This file is part of Tryton & Nereid. The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import os
+import shutil
+import tempfile
+import unittest
+from decimal import Decimal
+from collections import OrderedDict
+from multiprocessing import Process
+
+from jinja2 import Markup
+from werkzeug.contrib.cache import SimpleCache
+from nereid import Nereid
+from nereid.cache_backends import TwoTierCache, SharedMemoryCache, \
+    CodecCache
+from nereid.cache_codecs import CacheCodec, CODECS
+
+
+class Text(unicode):
+    pass
+
+
+class Bytes(str):
+    pass
+
+
+class TestTwoTierCache(unittest.TestCase):
+    '''
+    Test the two tier cache backend
+    '''
+
+    def test_0010_local_tier(self):
+        '''
+        Values read from the remote cache are served from the local tier
+        '''
+        cache = TwoTierCache(
+            'werkzeug.contrib.cache.SimpleCache', key_prefix='site'
+        )
+        self.assertTrue(isinstance(cache.remote, SimpleCache))
+
+        cache.remote.set('site-page-1', 'value')
+        self.assertEqual(cache.get('site-page-1'), 'value')
+        self.assertEqual(
+            cache.get_many('site-page-1', 'site-page-2'), ['value', None]
+        )
+
+        # The remote value is not read again
+        cache.remote.set('site-page-1', 'changed')
+        self.assertEqual(cache.get('site-page-1'), 'value')
+
+        stats = cache.get_stats()
+        self.assertEqual(stats['local']['hits'], 2)
+        self.assertEqual(stats['local']['misses'], 2)
+        self.assertEqual(stats['remote']['hits'], 1)
+        self.assertEqual(stats['remote']['misses'], 1)
+        self.assertEqual(stats['local']['entries'], 1)
+
+    def test_0020_invalidation(self):
+        '''
+        Writes leave the local tier of the other processes alone, which
+        evict the keys of a prefix when it is invalidated
+        '''
+        remote = SimpleCache()
+        cache1 = TwoTierCache(remote, version_check_interval=0)
+        cache2 = TwoTierCache(remote, version_check_interval=0)
+
+        cache1.set_many({'-page-1': 'value', '-frag-1': 'fragment'})
+        cache2.get_many(*['-frag-%d' % i for i in range(1, 101)])
+        for i in range(2, 101):
+            cache1.set('-frag-%d' % i, 'fragment')
+        keys = ['-page-1'] + ['-frag-%d' % i for i in range(1, 101)]
+        cache2.get_many(*keys)
+        self.assertEqual(cache2.get_stats()['local']['entries'], 101)
+
+        # Writes in another process do not evict the local values
+        remote_sets = []
+        remote.set = lambda *args: remote_sets.append(args) or \
+            SimpleCache.set(remote, *args)
+        cache1.set('-frag-new', 'fragment')
+        cache1.delete('-frag-1')
+        self.assertEqual(len(remote_sets), 1)
+        del remote.set
+        local_hits = cache2.get_stats()['local']['hits']
+        self.assertEqual(cache2.get_many(*keys), ['value'] + ['fragment'] * 100)
+        self.assertEqual(
+            cache2.get_stats()['local']['hits'], local_hits + 101
+        )
+
+        # Invalidating a prefix evicts its keys in the other processes
+        cache1.invalidate_local('-frag-')
+        self.assertEqual(cache2.get('-frag-1'), None)
+        self.assertEqual(cache2.get('-frag-2'), 'fragment')
+        self.assertEqual(cache2.get('-page-1'), 'value')
+        self.assertEqual(
+            cache2.get_stats()['local']['hits'], local_hits + 102
+        )
+
+        cache1.clear()
+        self.assertEqual(cache2.get('-page-1'), None)
+
+    def test_0030_local_prefixes(self):
+        '''
+        Only the keys of the nereid namespaces, or of the given prefixes, use
+        the local tier
+        '''
+        cache = TwoTierCache(SimpleCache(), key_prefix='site')
+        sid = 'a3f5' * 10
+
+        cache.set('site-page-1', 'page')
+        cache.set(sid, 'session')
+        cache.set('site-tag-product', 'tag version')
+        self.assertEqual(
+            cache.get_many('site-page-1', sid, 'site-tag-product'),
+            ['page', 'session', 'tag version']
+        )
+        stats = cache.get_stats()
+        self.assertEqual(stats['local']['hits'], 1)
+        self.assertEqual(stats['remote']['hits'], 2)
+        self.assertEqual(cache._local.keys(), ['site-page-1'])
+
+        # Writes to sessions do not change the versions
+        versions = dict(cache._versions)
+        cache.set(sid, 'changed')
+        self.assertEqual(cache._versions, versions)
+
+        cache = TwoTierCache(SimpleCache(), local_prefixes=['my-'])
+        cache.set('my-key', 'value')
+        cache.set('site-page-1', 'page')
+        self.assertEqual(cache._local.keys(), ['my-key'])
+
+        # The application passes its key prefix
+        app = Nereid()
+        app.config.update({
+            'CACHE_TYPE': 'nereid.cache_backends.TwoTierCache',
+            'CACHE_KEY_PREFIX': 'site',
+            'CACHE_INIT_KWARGS': {
+                'remote': 'werkzeug.contrib.cache.SimpleCache',
+            },
+        })
+        app.load_cache()
+        self.assertTrue(isinstance(app.cache, TwoTierCache))
+        self.assertTrue('site-page-' in app.cache.local_prefixes)
+
+    def test_0040_size_limits(self):
+        '''
+        The least recently used values are evicted from the local tier
+        '''
+        cache = TwoTierCache(
+            SimpleCache(), local_threshold=2, local_prefixes=['']
+        )
+        cache.set_many({'a': 1, 'b': 2})
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(sorted(cache._local.keys()), ['a', 'c'])
+
+        cache = TwoTierCache(
+            SimpleCache(), local_max_bytes=100, local_prefixes=['']
+        )
+        cache.set('small', 'x')
+        cache.set('large', 'x' * 200)
+        self.assertEqual(cache._local.keys(), ['small'])
+        self.assertTrue(0 < cache.get_stats()['local']['bytes'] <= 100)
+        self.assertEqual(cache.get('large'), 'x' * 200)
+
+        cache.set('other', 'y' * 90)
+        self.assertEqual(cache._local.keys(), ['other'])
+
+
+def _stress_shared_memory_cache(path, worker, iterations):
+    """
+    Hammer the cache from a process. Exits with a non zero status if a
+    value read does not match the value written for the key.
+    """
+    # A small cache to evict values all the time
+    cache = SharedMemoryCache(path, slots=64, slot_size=256, ways=4)
+    counters = SharedMemoryCache(path + '-counters')
+    status = 0
+    for i in xrange(iterations):
+        counters.inc('counter')
+        key = 'key-%d' % (i % 200)
+        cache.set(key, (key, worker, i))
+        value = cache.get('key-%d' % ((i * 7) % 200))
+        if value is not None and value[0] != 'key-%d' % ((i * 7) % 200):
+            status = 1
+    cache.close()
+    counters.close()
+    os._exit(status)
+
+
+class TestSharedMemoryCache(unittest.TestCase):
+    '''
+    Test the shared memory cache backend
+    '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_0010_get_set(self):
+        '''
+        Values are shared by the caches opening the same file
+        '''
+        cache1 = SharedMemoryCache(self.path)
+        cache2 = SharedMemoryCache(self.path)
+
+        self.assertTrue(cache1.set('key', {'a': [1, 2]}))
+        self.assertEqual(cache2.get('key'), {'a': [1, 2]})
+        self.assertEqual(cache2.get(u'missing'), None)
+
+        self.assertFalse(cache2.add('key', 'other'))
+        self.assertTrue(cache2.add('new', 'other'))
+        self.assertEqual(cache1.get_many('key', 'new'), [
+            {'a': [1, 2]}, 'other'
+        ])
+
+        self.assertEqual(cache1.inc('counter'), 1)
+        self.assertEqual(cache2.inc('counter', 5), 6)
+        self.assertEqual(cache1.dec('counter'), 5)
+
+        self.assertTrue(cache2.delete('key'))
+        self.assertEqual(cache1.get('key'), None)
+
+        cache1.clear()
+        self.assertEqual(cache2.get('new'), None)
+
+        # Values larger than a slot are not stored
+        self.assertFalse(cache1.set('large', 'x' * 5000))
+        self.assertEqual(cache1.get('large'), None)
+
+    def test_0020_timeout(self):
+        '''
+        Expired values are not returned
+        '''
+        cache = SharedMemoryCache(self.path)
+        cache.set('expired', 'value', -1)
+        cache.set('forever', 'value', 0)
+        self.assertEqual(cache.get('expired'), None)
+        self.assertEqual(cache.get('forever'), 'value')
+
+    def test_0030_eviction(self):
+        '''
+        A full bucket evicts the values which were not read recently
+        '''
+        cache = SharedMemoryCache(self.path, slots=4, ways=4)
+        cache.set_many({'a': 1, 'b': 2, 'c': 3, 'd': 4})
+        self.assertEqual(cache.get_many('a', 'b', 'c', 'd'), [1, 2, 3, 4])
+
+        # Every value was read, the clock gives each a second chance and
+        # evicts the value under the hand
+        cache.set('e', 5)
+        self.assertEqual(cache.get('e'), 5)
+        self.assertEqual(
+            len(filter(None, cache.get_many('a', 'b', 'c', 'd'))), 3
+        )
+
+        # The new value was read, so another one is evicted
+        cache.set('f', 6)
+        self.assertEqual(cache.get('e'), 5)
+        self.assertEqual(cache.get('f'), 6)
+
+    def test_0040_recreate(self):
+        '''
+        The file is recreated if the dimensions change
+        '''
+        previous = SharedMemoryCache(self.path)
+        previous.set('key', 'value')
+        self.assertEqual(SharedMemoryCache(self.path).get('key'), 'value')
+        size = os.path.getsize(self.path)
+
+        cache = SharedMemoryCache(self.path, slots=16)
+        self.assertEqual(cache.get('key'), None)
+        self.assertTrue(os.path.getsize(self.path) < size)
+        self.assertEqual(os.listdir(self.directory), ['cache'])
+
+        # The file mapped by the previous cache is not resized
+        self.assertEqual(os.fstat(previous._fd).st_size, size)
+        self.assertTrue(previous.set('other', 'value'))
+        self.assertEqual(previous.get('key'), 'value')
+        self.assertEqual(cache.get('other'), None)
+
+    def test_0042_corrupt_values(self):
+        '''
+        Values which cannot be unpickled are misses
+        '''
+        cache = SharedMemoryCache(self.path)
+        for value in ('x' * 100, {'a': 1}, [1] * 50):
+            cache.set('key', value)
+            key_hash = cache._hash('key')
+            offset, header = cache._find(
+                key_hash % cache.buckets, 'key', key_hash
+            )
+            start = offset + cache._slot_header.size + len('key')
+            # Truncate the value
+            cache._slot_header.pack_into(
+                cache._map, offset, *(header[:-1] + (header[-1] // 2,))
+            )
+            self.assertEqual(cache.get('key'), None)
+
+            # Overwrite the value with garbage
+            cache._map[start:start + 4] = '\xff\x00\xfe\x01'
+            cache._slot_header.pack_into(cache._map, offset, *header)
+            self.assertEqual(cache.get('key'), None)
+
+    def test_0045_load_cache(self):
+        '''
+        The application loads the backend with the cache settings
+        '''
+        app = Nereid()
+        app.config.update({
+            'CACHE_TYPE': 'nereid.cache_backends.SharedMemoryCache',
+            'CACHE_DIR': self.directory,
+            'CACHE_DEFAULT_TIMEOUT': 10,
+            'CACHE_INIT_KWARGS': {'slots': 16},
+        })
+        app.load_cache()
+        self.assertTrue(isinstance(app.cache, SharedMemoryCache))
+        self.assertEqual(
+            app.cache.path, os.path.join(self.directory, 'nereid.cache')
+        )
+        self.assertEqual(app.cache.default_timeout, 10)
+        self.assertEqual(app.cache.buckets, 2)
+
+    def test_0050_concurrency(self):
+        '''
+        Processes reading and writing the same keys do not lose updates or
+        read corrupt values
+        '''
+        workers, iterations = 8, 500
+        counters = SharedMemoryCache(self.path + '-counters')
+
+        processes = [
+            Process(
+                target=_stress_shared_memory_cache,
+                args=(self.path, worker, iterations)
+            ) for worker in xrange(workers)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+            self.assertEqual(process.exitcode, 0)
+
+        self.assertEqual(counters.get('counter'), workers * iterations)
+
+
+class TestCodecCache(unittest.TestCase):
+    '''
+    Test the encoding of the cached values
+    '''
+
+    def test_0010_codecs(self):
+        '''
+        Values are encoded with a versioned header and decoded back
+        '''
+        data = {'a': [1, 2.5, None], 'b': (u'text', 'bytes'), 'c': set([1])}
+        for name in CODECS:
+            codec = CacheCodec(name)
+            self.assertEqual(codec.loads(codec.dumps(data)), data)
+            self.assertTrue(codec.is_encoded(codec.dumps(data)))
+
+        # Values which are not plain data are pickled by marshal
+        codec = CacheCodec('marshal')
+        value = {'price': Decimal('10.5')}
+        self.assertEqual(codec.loads(codec.dumps(value)), value)
+
+        # Subclasses of the plain types are pickled by marshal
+        for value in (
+                Markup(u'<b>x</b>'), [Markup(u'é')], {'html': Markup(u'x')},
+                Text(u'text'), Bytes('bytes'), (OrderedDict([('a', 1)]),)):
+            decoded = codec.loads(codec.dumps(value))
+            self.assertEqual(decoded, value)
+            self.assertEqual(type(decoded), type(value))
+        self.assertEqual(
+            type(codec.loads(codec.dumps([Markup(u'é')]))[0]), Markup
+        )
+
+        # Large values are compressed
+        html = '<div class="product">Product</div>' * 100
+        self.assertTrue(len(codec.dumps(html)) < len(html) / 10)
+        self.assertEqual(codec.loads(codec.dumps(html)), html)
+        self.assertTrue(
+            len(CacheCodec(compress_threshold=None).dumps(html)) > len(html)
+        )
+
+        # Other versions of the format are ignored
+        self.assertEqual(codec.loads('\x21' + codec.dumps(1)[1:]), None)
+        self.assertEqual(codec.loads(codec.dumps(1)[:1] + 'corrupt'), None)
+        self.assertFalse(codec.is_encoded('12'))
+
+        self.assertRaises(ValueError, CacheCodec, 'json')
+
+    def test_0020_codec_cache(self):
+        '''
+        The cache encodes the values stored in the backend
+        '''
+        cache = CodecCache(
+            'werkzeug.contrib.cache.SimpleCache', codec='marshal'
+        )
+        cache.set('key', {'a': 1})
+        cache.set_many({'b': [1], 'c': 'x' * 2000})
+        self.assertTrue(isinstance(cache.backend.get('key'), str))
+        self.assertEqual(cache.get('key'), {'a': 1})
+        self.assertEqual(
+            cache.get_many('b', 'c', 'missing'), [[1], 'x' * 2000, None]
+        )
+        self.assertFalse(cache.add('key', 2))
+
+        self.assertEqual(cache.inc('counter'), 1)
+        self.assertEqual(cache.inc('counter'), 2)
+        self.assertEqual(cache.get('counter'), 2)
+
+        cache.delete('key')
+        self.assertEqual(cache.get('key'), None)
+
+    def test_0030_load_cache(self):
+        '''
+        The application wraps the backend if a codec is set
+        '''
+        app = Nereid()
+        app.config.update({
+            'CACHE_TYPE': 'werkzeug.contrib.cache.SimpleCache',
+            'CACHE_CODEC': 'marshal',
+            'CACHE_COMPRESS_THRESHOLD': None,
+        })
+        app.load_cache()
+        self.assertTrue(isinstance(app.cache, CodecCache))
+        self.assertTrue(isinstance(app.cache.backend, SimpleCache))
+        self.assertEqual(app.cache.codec.codec, 'marshal')
+        self.assertEqual(app.cache.codec.compress_threshold, None)
+
+
+def suite():
+    "Cache backends test suite"
+    test_suite = unittest.TestSuite()
+    test_suite.addTests([
+        unittest.TestLoader().loadTestsFromTestCase(TestTwoTierCache),
+        unittest.TestLoader().loadTestsFromTestCase(TestSharedMemoryCache),
+        unittest.TestLoader().loadTestsFromTestCase(TestCodecCache),
+    ])
+    return test_suite
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
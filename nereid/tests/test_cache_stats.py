@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+# This file is part of Tryton & Nereid. The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import json
+import base64
+import unittest
+
+from werkzeug.contrib.cache import SimpleCache
+from trytond.transaction import Transaction
+from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
+from nereid import cache
+from nereid.cache_stats import InstrumentedCache
+from nereid.tests.test_templates import BaseTestCase
+
+
+class TestCacheStats(BaseTestCase):
+    '''
+    Test the stats of the cache
+    '''
+
+    def test_0010_namespaces(self):
+        '''
+        Keys are counted in the namespace of their prefix
+        '''
+        cache = InstrumentedCache(
+            SimpleCache(), 'site', namespaces={'site-frag-menu': 'menu'}
+        )
+        self.assertEqual(cache.get_namespace('site-page-abc'), 'page')
+        self.assertEqual(cache.get_namespace('site-frag-menu-1'), 'menu')
+        self.assertEqual(
+            cache.get_namespace('site-memo-product.get-1-abc'),
+            'memo:product.get'
+        )
+        self.assertEqual(
+            cache.get_namespace('jinja2/bytecode/abc'), 'bytecode'
+        )
+        self.assertEqual(cache.get_namespace('a1b2c3'), 'other')
+        self.assertEqual(cache.get_namespace('a1b2' * 10), 'session')
+        self.assertEqual(
+            InstrumentedCache(SimpleCache()).get_namespace('-page-abc'),
+            'page'
+        )
+
+    def test_0020_counters(self):
+        '''
+        Hits, misses, sets, deletes, bytes and latency are recorded
+        '''
+        cache = InstrumentedCache(SimpleCache(), 'site', max_namespaces=2)
+        cache.set('site-page-1', '<p>Page</p>')
+        cache.set_many({'site-page-2': 'x', 'site-rst-1': '<p>'})
+        cache.get('site-page-1')
+        cache.get_many('site-page-2', 'site-page-3')
+        cache.delete('site-rst-1')
+        cache.set('site-tag-1', 1)
+
+        stats = cache.get_stats()
+        self.assertEqual(sorted(stats), ['other', 'page', 'rst'])
+        page = stats['page']
+        self.assertEqual(page['hits'], 2)
+        self.assertEqual(page['misses'], 1)
+        self.assertEqual(page['hit_rate'], 2.0 / 3)
+        self.assertEqual(page['sets'], 2)
+        self.assertEqual(page['bytes_written'], 12)
+        self.assertEqual(page['bytes_read'], 12)
+        self.assertEqual(page['latency']['count'], 4)
+        self.assertEqual(sum(
+            count for bound, count in page['latency']['histogram']
+        ), 4)
+        self.assertEqual(stats['rst']['deletes'], 1)
+        # Beyond the maximum number of namespaces
+        self.assertEqual(stats['other']['sets'], 1)
+
+        cache.reset_stats()
+        self.assertEqual(cache.get_stats(), {})
+
+    def test_0030_stats_url(self):
+        '''
+        The stats of the application cache are served as JSON to the users
+        with the permission
+        '''
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app(
+                CACHE_TYPE='werkzeug.contrib.cache.SimpleCache',
+                CACHE_KEY_PREFIX='site',
+                CACHE_CODEC='pickle',
+                CACHE_STATS=True,
+                CACHE_STATS_URL='/_cache-stats',
+            )
+
+            @app.route('/cache-stats-view')
+            def view():
+                cache.set('site-frag-1', 'value')
+                cache.get('site-frag-1')
+                return 'ok'
+
+            permission, = POOL.get('nereid.permission').create([{
+                'name': 'Admin', 'value': 'admin',
+            }])
+            self.nereid_user_obj.create([{
+                'party': self.party,
+                'display_name': 'Admin',
+                'email': 'admin@example.com',
+                'password': 'password',
+                'company': self.company,
+                'permissions': [('add', [permission])],
+            }, {
+                'party': self.party,
+                'display_name': 'Guest',
+                'email': 'guest@example.com',
+                'password': 'password',
+                'company': self.company,
+            }])
+
+            def auth(email):
+                return {'Authorization': 'Basic ' + base64.b64encode(
+                    '%s:password' % email
+                )}
+
+            POOL.get('nereid.website').clear_url_adapter_cache()
+            with app.test_client() as c:
+                self.assertEqual(c.get('/cache-stats-view').data, 'ok')
+
+                # The users without the permission are forbidden
+                self.assertEqual(c.get('/_cache-stats').status_code, 403)
+                self.assertEqual(
+                    c.get(
+                        '/_cache-stats', headers=auth('guest@example.com')
+                    ).status_code,
+                    403
+                )
+
+                rv = c.get('/_cache-stats', headers=auth('admin@example.com'))
+                self.assertEqual(rv.status_code, 200)
+                stats = json.loads(rv.data)['namespaces']
+                self.assertEqual(stats['frag']['hits'], 1)
+                self.assertEqual(stats['frag']['sets'], 1)
+                # The encoded values are counted
+                self.assertTrue(stats['frag']['bytes_written'] > 5)
+
+
+def suite():
+    "Cache stats test suite"
+    test_suite = unittest.TestSuite()
+    test_suite.addTests([
+        unittest.TestLoader().loadTestsFromTestCase(TestCacheStats),
+    ])
+    return test_suite
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -9,7 +9,8 @@ from test_templates import BaseTestCase
 from trytond.pool import PoolMeta, Pool
 from trytond.tests.test_tryton import USER, DB_NAME, CONTEXT, POOL
 from trytond.transaction import Transaction
-from nereid import url_for, template_filter
+from mock import patch
+from nereid import url_for, template_filter, helpers
 
 
 class TestURLfor(BaseTestCase):
@@ -115,6 +116,70 @@ class TestHelperFunctions(BaseTestCase):
                 response = c.get('/')
                 self.assertEqual(response.data, 'cba')
 
+    def test_rst_filter(self):
+        '''
+        The rst filter renders the text once and memoises the HTML
+        '''
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app(
+                CACHE_TYPE='werkzeug.contrib.cache.SimpleCache',
+                RST_CACHE_TIMEOUT=3600,
+            )
+
+            with app.test_request_context('/'):
+                with patch.object(
+                        helpers.docutils_core, 'publish_parts',
+                        wraps=helpers.docutils_core.publish_parts) as publish:
+                    template = app.jinja_env.from_string(
+                        '{{ description|rst }}'
+                    )
+                    self.assertEqual(
+                        template.render(description='**nereid-rst**'),
+                        '<p><strong>nereid-rst</strong></p>\n'
+                    )
+                    self.assertEqual(publish.call_count, 1)
+                    template.render(description='**nereid-rst**')
+                    self.assertEqual(publish.call_count, 1)
+
+                    # The application cache is used if the process cache
+                    # does not have the HTML anymore
+                    helpers._rst_cache.clear()
+                    template.render(description='**nereid-rst**')
+                    self.assertEqual(publish.call_count, 1)
+
+                    # Values other than text are returned as such
+                    self.assertEqual(
+                        helpers.rst_to_html_many([None, '', 1]),
+                        [None, '', 1]
+                    )
+                    self.assertEqual(publish.call_count, 1)
+
+    def test_rst_many(self):
+        '''
+        Render many rst texts at once
+        '''
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            with app.test_request_context('/'):
+                with patch.object(
+                        helpers.docutils_core, 'publish_parts',
+                        wraps=helpers.docutils_core.publish_parts) as publish:
+                    self.assertEqual(
+                        helpers.rst_to_html_many([
+                            '*nereid-many-1*', '*nereid-many-2*',
+                            '*nereid-many-1*',
+                        ]), [
+                            '<p><em>nereid-many-1</em></p>\n',
+                            '<p><em>nereid-many-2</em></p>\n',
+                            '<p><em>nereid-many-1</em></p>\n',
+                        ]
+                    )
+                    # Duplicates are rendered only once
+                    self.assertEqual(publish.call_count, 2)
+
 
 def suite():
     "Nereid Helpers test suite"
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+# This file is part of Tryton & Nereid. The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import unittest
+from decimal import Decimal
+
+from trytond.transaction import Transaction
+from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
+from nereid.memoize import memoize, invalidate_memoized, default_key_builder
+from nereid.tests.test_templates import BaseTestCase
+
+
+class TestMemoize(BaseTestCase):
+    '''
+    Test the memoisation of functions
+    '''
+
+    def get_app(self, **options):
+        options.setdefault('CACHE_TYPE', 'werkzeug.contrib.cache.SimpleCache')
+        return super(TestMemoize, self).get_app(**options)
+
+    def test_0010_memoize(self):
+        '''
+        Calls with the same argument values are memoized
+        '''
+        calls = []
+
+        @memoize('tests.add')
+        def add(a, b=1, *args, **kwargs):
+            calls.append((a, b))
+            return a + b
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            with app.test_request_context('/'):
+                self.assertEqual(add(1), 2)
+                self.assertEqual(add(1, 1), 2)
+                self.assertEqual(add(1, b=1), 2)
+                self.assertEqual(add(a=1), 2)
+                self.assertEqual(len(calls), 1)
+
+                self.assertEqual(add(1, 2), 3)
+                self.assertEqual(add(1, 2, 3), 3)
+                self.assertEqual(add(1, 2, c=3), 3)
+                self.assertEqual(len(calls), 4)
+
+    def test_0020_invalidate(self):
+        '''
+        Invalidate all the values memoized in a namespace
+        '''
+        calls = []
+
+        @memoize('tests.double')
+        def double(value):
+            calls.append(value)
+            return value * 2
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            with app.test_request_context('/'):
+                double(1)
+                double(2)
+                double.invalidate()
+                double(1)
+                double(2)
+                self.assertEqual(calls, [1, 2, 1, 2])
+
+            with app.test_request_context('/'):
+                double(1)
+                self.assertEqual(len(calls), 4)
+                invalidate_memoized('tests.double')
+
+            with app.test_request_context('/'):
+                double(1)
+                self.assertEqual(len(calls), 5)
+
+    def test_0030_unless(self):
+        '''
+        The cache is not used if unless returns true
+        '''
+        calls = []
+
+        @memoize('tests.identity', unless=lambda: True)
+        def identity(value):
+            calls.append(value)
+            return value
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            with app.test_request_context('/'):
+                identity(1)
+                identity(1)
+                self.assertEqual(len(calls), 2)
+
+    def test_0040_key_builder(self):
+        '''
+        Keys of active records and decimals are stable
+        '''
+        Party = POOL.get('party.party')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.assertEqual(
+                default_key_builder((Party(1), Decimal('1.0'), {'a': [1]})),
+                default_key_builder((Party(1), Decimal('1.0'), {'a': (1,)})),
+            )
+            self.assertNotEqual(
+                default_key_builder((Party(1),)),
+                default_key_builder((Party(2),)),
+            )
+            # Models, records and decimals do not share the key of plain
+            # values
+            for value, plain in [
+                    (Party, 'party.party'),
+                    (Party, ('model', 'party.party')),
+                    (Party(1), ('party.party', 1)),
+                    (Decimal('1.0'), '1.0'),
+                    ({'a': 1}, (('a', 1),))]:
+                self.assertNotEqual(
+                    default_key_builder((value,)),
+                    default_key_builder((plain,))
+                )
+
+            # Unsaved records have no key
+            self.assertRaises(ValueError, default_key_builder, (Party(),))
+
+
+def suite():
+    "Memoize test suite"
+    test_suite = unittest.TestSuite()
+    test_suite.addTests([
+        unittest.TestLoader().loadTestsFromTestCase(TestMemoize),
+    ])
+    return test_suite
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
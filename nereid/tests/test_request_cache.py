@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+# This file is part of Tryton & Nereid. The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import unittest
+from collections import defaultdict
+
+from werkzeug.contrib.cache import SimpleCache
+from trytond.transaction import Transaction
+from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
+from nereid import cache
+from nereid.request_cache import RequestCache
+from nereid.tests.test_templates import BaseTestCase
+
+
+class CountingCache(SimpleCache):
+    """
+    A cache which counts the calls made to it
+    """
+    calls = defaultdict(int)
+
+    def get_many(self, *keys):
+        self.calls['get_many'] += 1
+        return [super(CountingCache, self).get(key) for key in keys]
+
+    def get(self, key):
+        self.calls['get'] += 1
+        return super(CountingCache, self).get(key)
+
+    def set_many(self, mapping, timeout=None):
+        self.calls['set_many'] += 1
+        for key, value in mapping.items():
+            super(CountingCache, self).set(key, value, timeout)
+        return True
+
+    def set(self, key, value, timeout=None):
+        self.calls['set'] += 1
+        return super(CountingCache, self).set(key, value, timeout)
+
+
+class TestRequestCache(BaseTestCase):
+    '''
+    Test the request cache
+    '''
+
+    def test_0010_batching(self):
+        '''
+        Lookups are batched with the prefetched keys and writes buffered
+        '''
+        backend = SimpleCache()
+        backend.set_many({'a': 1, 'b': 2})
+        request_cache = RequestCache(backend, ['a', 'b'])
+
+        self.assertEqual(request_cache.get('c'), None)
+        self.assertEqual(request_cache.get('a'), 1)
+        self.assertEqual(request_cache.get_many('a', 'b'), [1, 2])
+        self.assertEqual(request_cache.round_trips, 1)
+
+        request_cache.set('c', 3)
+        request_cache.set_many({'d': 4, 'e': 5})
+        self.assertEqual(request_cache.get('c'), 3)
+        self.assertEqual(backend.get('c'), None)
+        self.assertEqual(request_cache.round_trips, 1)
+
+        request_cache.flush()
+        self.assertEqual(backend.get_many('c', 'd', 'e'), [3, 4, 5])
+        self.assertEqual(request_cache.round_trips, 2)
+
+        request_cache.delete('a')
+        self.assertEqual(request_cache.get('a'), None)
+        self.assertEqual(backend.get('a'), None)
+        self.assertEqual(request_cache.round_trips, 3)
+
+    def test_0020_round_trips_per_request(self):
+        '''
+        Measure the round trips of a request with and without the buffer
+        '''
+        def get_round_trips(**options):
+            app = self.get_app(
+                CACHE_TYPE='nereid.tests.test_request_cache.CountingCache',
+                **options
+            )
+
+            @app.cache_prefetcher
+            def prefetch(request):
+                return ['a', 'b']
+
+            @app.route('/cache-round-trips')
+            def view():
+                cache.get('a')
+                cache.get('b')
+                cache.set('c', 3)
+                cache.set('d', 4)
+                return 'ok'
+
+            POOL.get('nereid.website').clear_url_adapter_cache()
+            CountingCache.calls.clear()
+            with app.test_client() as c:
+                self.assertEqual(c.get('/cache-round-trips').data, 'ok')
+            calls = dict(CountingCache.calls)
+            self.assertEqual(app.cache.get_many('c', 'd'), [3, 4])
+            return calls
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            self.assertEqual(get_round_trips(), {'get': 2, 'set': 2})
+            self.assertEqual(
+                get_round_trips(CACHE_REQUEST_BUFFER=True),
+                {'get_many': 1, 'set_many': 1}
+            )
+
+
+def suite():
+    "Request cache test suite"
+    test_suite = unittest.TestSuite()
+    test_suite.addTests([
+        unittest.TestLoader().loadTestsFromTestCase(TestRequestCache),
+    ])
+    return test_suite
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
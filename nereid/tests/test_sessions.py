@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+# This file is part of Tryton & Nereid. The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import os
+import shutil
+import binascii
+import tempfile
+import unittest
+from time import sleep
+
+from flask import session
+from werkzeug.contrib.sessions import FilesystemSessionStore
+from trytond.transaction import Transaction
+from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
+from nereid.sessions import Session, SQLiteSessionStore, \
+    HybridSessionInterface, TOUCHED_KEY
+from nereid.tests.test_templates import BaseTestCase
+
+
+class CountingSessionStore(FilesystemSessionStore):
+    """
+    A session store which counts the sessions saved and deleted
+    """
+
+    def __init__(self, *args, **kwargs):
+        FilesystemSessionStore.__init__(self, *args, **kwargs)
+        self.loaded = 0
+        self.saved = 0
+        self.deleted = 0
+
+    def get(self, sid):
+        self.loaded += 1
+        return FilesystemSessionStore.get(self, sid)
+
+    def save(self, session):
+        self.saved += 1
+        return FilesystemSessionStore.save(self, session)
+
+    def delete(self, session):
+        self.deleted += 1
+        return FilesystemSessionStore.delete(self, session)
+
+
+class TestSessions(BaseTestCase):
+    '''
+    Test the saving of sessions
+    '''
+
+    def get_app(self, **options):
+        app = super(TestSessions, self).get_app(**options)
+        self.store = app.session_interface.session_store = \
+            CountingSessionStore('/tmp', session_class=Session)
+
+        @app.route('/session-set/<value>')
+        def set_value(value):
+            session['value'] = value
+            return 'ok'
+
+        @app.route('/session-append')
+        def append():
+            # Mutating a value in place does not mark the session modified
+            session.setdefault('items', []).append(1)
+            return 'ok'
+
+        @app.route('/session-read')
+        def read():
+            return session.get('value', '')
+
+        @app.route('/session-set-large')
+        def set_large_value():
+            session['value'] = binascii.hexlify(os.urandom(3000))
+            return 'ok'
+
+        @app.route('/session-unused')
+        def unused():
+            return 'ok'
+
+        @app.route('/session-clear')
+        def clear():
+            session.clear()
+            return 'ok'
+
+        POOL.get('nereid.website').clear_url_adapter_cache()
+        return app
+
+    def test_0010_dirty_keys(self):
+        '''
+        The keys changed since the session was opened are known
+        '''
+        s = Session({'a': 1, 'b': [1]}, 'sid')
+        self.assertEqual(s.dirty_keys, set())
+        s['a'] = 1
+        s['b'].append(2)
+        s['c'] = 3
+        s.pop('a')
+        self.assertEqual(s.dirty_keys, set(['a', 'b', 'c']))
+        s.snapshot()
+        self.assertEqual(s.dirty_keys, set())
+
+    def test_0020_unchanged_sessions(self):
+        '''
+        Sessions are written only when a value changes
+        '''
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app(SESSION_TOUCH_INTERVAL=None)
+
+            with app.test_client() as c:
+                # Anonymous visitors with empty sessions get none
+                self.assertEqual(c.get('/session-read').data, '')
+                self.assertEqual(self.store.saved, 0)
+                self.assertFalse(list(c.cookie_jar))
+
+                c.get('/session-set/a')
+                self.assertEqual(self.store.saved, 1)
+                self.assertEqual(len(list(c.cookie_jar)), 1)
+
+                # Setting the same value does not write the session
+                c.get('/session-set/a')
+                self.assertEqual(c.get('/session-read').data, 'a')
+                self.assertEqual(self.store.saved, 1)
+
+                c.get('/session-set/b')
+                c.get('/session-append')
+                c.get('/session-append')
+                self.assertEqual(self.store.saved, 4)
+
+                # The value changed in place is saved
+                sid = list(c.cookie_jar)[0].value
+                self.assertEqual(self.store.get(sid)['items'], [1, 1])
+
+                # An emptied session is removed from the store
+                c.get('/session-clear')
+                self.assertEqual(self.store.saved, 4)
+                self.assertEqual(self.store.deleted, 1)
+                self.assertEqual(c.get('/session-read').data, '')
+
+    def test_0030_touch(self):
+        '''
+        Unchanged sessions are written once in the touch interval
+        '''
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app(SESSION_TOUCH_INTERVAL=3600)
+
+            with app.test_client() as c:
+                c.get('/session-set/a')
+                self.assertEqual(self.store.saved, 1)
+                c.get('/session-read')
+                c.get('/session-read')
+                self.assertEqual(self.store.saved, 1)
+
+                # The session was last touched long ago
+                sid = list(c.cookie_jar)[0].value
+                stored = self.store.get(sid)
+                stored[TOUCHED_KEY] -= 3600
+                FilesystemSessionStore.save(self.store, stored)
+
+                c.get('/session-read')
+                self.assertEqual(self.store.saved, 2)
+                c.get('/session-read')
+                self.assertEqual(self.store.saved, 2)
+
+    def test_0040_lazy_loading(self):
+        '''
+        Sessions are loaded from the store only when they are used
+        '''
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            with app.test_client() as c:
+                c.get('/session-set/a')
+                self.assertEqual(self.store.loaded, 0)
+
+                self.assertEqual(c.get('/session-unused').data, 'ok')
+                self.assertEqual(self.store.loaded, 0)
+
+                self.assertEqual(c.get('/session-read').data, 'a')
+                self.assertEqual(self.store.loaded, 1)
+
+                c.get('/session-set/b')
+                self.assertEqual(self.store.loaded, 2)
+                self.assertEqual(c.get('/session-read').data, 'b')
+
+            # An invalid session id starts a new session
+            with app.test_client() as c:
+                c.set_cookie('localhost', app.session_cookie_name, 'invalid')
+                c.get('/session-set/c')
+                sid = [
+                    cookie.value for cookie in c.cookie_jar
+                    if cookie.name == app.session_cookie_name
+                ]
+                self.assertEqual(len(sid), 1)
+                self.assertNotEqual(sid[0], 'invalid')
+                self.assertEqual(c.get('/session-read').data, 'c')
+
+    def test_0050_hybrid(self):
+        '''
+        Small sessions are kept in the cookie and large ones in the store
+        '''
+        def get_cookie(client):
+            values = [
+                cookie.value for cookie in client.cookie_jar
+                if cookie.name == app.session_cookie_name
+            ]
+            return values and values[0] or None
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app(SESSION_TOUCH_INTERVAL=None)
+            app.session_interface = HybridSessionInterface()
+            app.session_interface.session_store = self.store
+
+            with app.test_client() as c:
+                c.get('/session-unused')
+                self.assertEqual(get_cookie(c), None)
+
+                c.get('/session-set/a')
+                self.assertTrue('.' in get_cookie(c))
+                self.assertEqual(c.get('/session-read').data, 'a')
+                self.assertEqual(
+                    (self.store.saved, self.store.loaded), (0, 0)
+                )
+
+                # The session spills to the store
+                c.get('/session-set-large')
+                self.assertEqual(self.store.saved, 1)
+                sid = get_cookie(c)
+                self.assertFalse('.' in sid)
+                self.assertEqual(len(c.get('/session-read').data), 6000)
+                self.assertEqual(self.store.loaded, 1)
+
+                # And moves back to the cookie
+                c.get('/session-set/b')
+                self.assertEqual(self.store.deleted, 1)
+                self.assertTrue('.' in get_cookie(c))
+                self.assertEqual(c.get('/session-read').data, 'b')
+                self.assertEqual(dict(self.store.get(sid)), {})
+
+                c.get('/session-clear')
+                self.assertEqual(get_cookie(c), None)
+
+                # Cookies which are not signed are ignored
+                c.set_cookie(
+                    'localhost', app.session_cookie_name,
+                    'eyJ2YWx1ZSI6ImEifQ.x.y'
+                )
+                self.assertEqual(c.get('/session-read').data, '')
+
+
+class TestSQLiteSessionStore(unittest.TestCase):
+    '''
+    Test the SQLite session store
+    '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'sessions.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_0010_store(self):
+        '''
+        Save, get, list and delete sessions
+        '''
+        store = SQLiteSessionStore(self.path, sweep_interval=None)
+        session1 = store.new()
+        session1.update({'user_id': 1, 'cart': [1, 2]})
+        store.save(session1)
+        session2 = store.new()
+        session2['user_id'] = 2
+        store.save(session2)
+
+        # Another store on the same database
+        other = SQLiteSessionStore(self.path, sweep_interval=None)
+        self.assertEqual(dict(other.get(session1.sid)), dict(session1))
+        self.assertFalse(other.get(session1.sid).new)
+        self.assertEqual(
+            sorted(other.list()), sorted([session1.sid, session2.sid])
+        )
+        self.assertTrue(store.get('invalid').new)
+
+        store.delete(session1)
+        self.assertEqual(dict(other.get(session1.sid)), {})
+        self.assertEqual(other.list(), [session2.sid])
+
+    def test_0020_revoke_user(self):
+        '''
+        All the sessions of a user are revoked at once
+        '''
+        store = SQLiteSessionStore(self.path, sweep_interval=None)
+        sids = []
+        for user_id in (1, 1, 2, None):
+            session = store.new()
+            if user_id:
+                session['user_id'] = user_id
+            store.save(session)
+            sids.append(session.sid)
+
+        self.assertEqual(store.revoke_user(1), 2)
+        self.assertEqual(sorted(store.list()), sorted(sids[2:]))
+
+    def test_0030_expiry(self):
+        '''
+        Expired sessions are not returned and are swept
+        '''
+        store = SQLiteSessionStore(
+            self.path, timeout=-1, sweep_interval=None, sweep_batch_size=2
+        )
+        for i in xrange(5):
+            session = store.new()
+            session['value'] = i
+            store.save(session)
+        self.assertEqual(dict(store.get(session.sid)), {})
+        self.assertEqual(store.list(), [])
+        self.assertEqual(store.sweep(), 5)
+        self.assertEqual(store.sweep(), 0)
+
+        # In the background
+        store = SQLiteSessionStore(
+            self.path, timeout=-1, sweep_interval=0.01
+        )
+        store.save(store.new())
+        for i in xrange(200):
+            count, = store.connection.execute(
+                'SELECT count(*) FROM session'
+            ).fetchone()
+            if not count:
+                break
+            sleep(0.01)
+        self.assertEqual(count, 0)
+        store._sweeper_pid = None
+
+
+def suite():
+    "Sessions test suite"
+    test_suite = unittest.TestSuite()
+    test_suite.addTests([
+        unittest.TestLoader().loadTestsFromTestCase(TestSessions),
+        unittest.TestLoader().loadTestsFromTestCase(TestSQLiteSessionStore),
+    ])
+    return test_suite
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
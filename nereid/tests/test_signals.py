@@ -14,9 +14,12 @@ import unittest
 from test_templates import BaseTestCase
 from trytond.tests.test_tryton import USER, DB_NAME, CONTEXT, POOL
 from trytond.transaction import Transaction
+from trytond.model.modelstorage import ModelStorage
 
 import flask
+import jinja2
 import nereid
+import nereid.signals
 from nereid import route
 
 
@@ -186,6 +189,86 @@ class SignalsTestCase(BaseTestCase):
             finally:
                 flask.message_flashed.disconnect(record, app)
 
+    def test_template_profiled_signal(self):
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app(
+                TEMPLATE_PROFILE_RATE=1, TEMPLATE_PROFILE_HEADER=True
+            )
+            # loaders is usually lazy loaded
+            app.jinja_loader.loaders
+            app.jinja_loader._loaders.insert(0, jinja2.DictLoader({
+                'profiled.jinja':
+                    "{{ request.nereid_website.name }}|"
+                    "{% include 'profiled-include.jinja' %}",
+                'profiled-include.jinja':
+                    "{{ request.nereid_website.company.party.name }}",
+            }))
+
+            # Patch the home page method
+            @route('/')
+            def home_func():
+                return nereid.render_template('profiled.jinja')
+            app.view_functions['nereid.website.home'] = home_func
+
+            recorded = []
+
+            def record(sender, template, stats):
+                recorded.append((template, stats))
+
+            getattr_ = ModelStorage.__dict__['__getattr__']
+            nereid.signals.template_profiled.connect(record, app)
+            try:
+                rv = app.test_client().get('/')
+                self.assertEqual(rv.data, b'localhost|Openlabs')
+                self.assertEqual(len(recorded), 1)
+
+                # The instrumentation is removed after the render
+                self.assertTrue(
+                    ModelStorage.__dict__['__getattr__'] is getattr_
+                )
+                self.assertFalse('execute' in vars(Transaction().cursor))
+
+                template, stats = recorded[0]
+                self.assertEqual(template, 'profiled.jinja')
+                stats = dict((s['template'], s) for s in stats)
+                self.assertEqual(
+                    set(stats),
+                    set(['profiled.jinja', 'profiled-include.jinja'])
+                )
+                # The stats of the page include the stats of the include
+                page_queries = stats['profiled.jinja']['queries']
+                include_queries = stats['profiled-include.jinja']['queries']
+                self.assertTrue(page_queries >= include_queries > 0)
+                self.assertTrue(
+                    stats['profiled-include.jinja']['field_loads'] >= 2
+                )
+                self.assertTrue(
+                    rv.headers['X-Nereid-Template-Profile'].startswith(
+                        'profiled-include.jinja;count=1;'
+                    )
+                )
+            finally:
+                nereid.signals.template_profiled.disconnect(record, app)
+
+    def test_template_profile_disabled(self):
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+            recorded = []
+
+            def record(sender, template, stats):
+                recorded.append((template, stats))
+
+            nereid.signals.template_profiled.connect(record, app)
+            try:
+                rv = app.test_client().get('/')
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(recorded, [])
+                self.assertFalse('X-Nereid-Template-Profile' in rv.headers)
+            finally:
+                nereid.signals.template_profiled.disconnect(record, app)
+
     @classmethod
     def tearDownClass(cls):
         POOL.init(update=['nereid'])
@@ -2,19 +2,28 @@
 # This file is part of Tryton & Nereid. The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
 import os
+import base64
 import unittest
 import pickle
+import tempfile
+from email import message_from_string
 from email.header import decode_header
 
+import flask
+import jinja2
 import pycountry
+from itsdangerous import URLSafeSerializer
 import trytond.tests.test_tryton
 from trytond.transaction import Transaction
 from trytond.backend.sqlite.database import Database as SQLiteDatabase  # noqa
 from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
 from nereid import render_template, LazyRenderer, render_email
+from nereid.templating import render_cached_template, render_emails, \
+    queue_emails
 from nereid.testing import NereidTestCase, NereidTestApp
 from nereid.sessions import Session
 from nereid.contrib.locale import Babel
+from nereid.cache_tags import invalidate_cache_tags
 from werkzeug.contrib.sessions import FilesystemSessionStore
 
 
@@ -435,6 +444,121 @@ class TestTemplateLoading(BaseTestCase):
                 else:
                     self.fail('Alternative part not found')
 
+    def test_0120_render_emails(self):
+        '''
+        Render and queue emails in bulk
+        '''
+        EmailQueue = POOL.get('email.queue')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            sender = u'Sender <sender@openlabs.co.in>'
+            recipients = [
+                (u'a@openlabs.co.in', {'name': 'A'}),
+                (u'b@openlabs.co.in', {'name': 'B'}),
+            ]
+
+            with app.test_request_context('/'):
+                messages = list(render_emails(
+                    sender, recipients, u'Newsletter',
+                    text_template='tests/bulk-email.html',
+                    html_template='tests/bulk-email.html',
+                    attachments={'filename.pdf': 'PDF content'},
+                    greeting='Hi',
+                ))
+
+                # Missing templates are reported before the messages are
+                # rendered
+                self.assertRaises(
+                    jinja2.TemplateNotFound, render_emails, sender,
+                    recipients, u'Newsletter',
+                    text_template='tests/missing-email.html',
+                )
+
+                self.assertEqual(
+                    [to for to, _ in messages],
+                    [u'a@openlabs.co.in', u'b@openlabs.co.in']
+                )
+                for (to, message), name in zip(messages, ['A', 'B']):
+                    message = message_from_string(message)
+                    self.assertEqual(
+                        message.get_content_type(), 'multipart/mixed'
+                    )
+                    self.assertEqual(decode_header(message['To'])[0][0], to)
+                    alternative, attachment = message.get_payload()
+                    for part in alternative.get_payload():
+                        self.assertEqual(
+                            part.get_payload(decode=True), 'Hi %s' % name
+                        )
+                    self.assertEqual(
+                        attachment.get_payload(decode=True), 'PDF content'
+                    )
+
+                self.assertEqual(
+                    queue_emails(
+                        sender, recipients, u'Newsletter',
+                        text_template='tests/bulk-email.html', chunk_size=1,
+                        greeting='Hi',
+                    ), 2
+                )
+                self.assertEqual(
+                    sorted(e.to_addrs for e in EmailQueue.search([])),
+                    [u'a@openlabs.co.in', u'b@openlabs.co.in']
+                )
+
+                # The Cc recipients are sent the messages too
+                EmailQueue.delete(EmailQueue.search([]))
+                queue_emails(
+                    sender, recipients, u'Newsletter',
+                    text_template='tests/bulk-email.html',
+                    cc=u'c@openlabs.co.in', greeting='Hi',
+                )
+                self.assertEqual(
+                    sorted(e.to_addrs for e in EmailQueue.search([])), [
+                        u'a@openlabs.co.in,c@openlabs.co.in',
+                        u'b@openlabs.co.in,c@openlabs.co.in',
+                    ]
+                )
+
+    def test_0130_render_emails_processes(self):
+        '''
+        Render emails in bulk with worker processes
+        '''
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            recipients = [
+                (u'%d@openlabs.co.in' % i, {'name': str(i)})
+                for i in range(10)
+            ]
+
+            Lang = POOL.get('ir.lang')
+            languages = Lang.search([], count=True)
+
+            with app.test_request_context('/'):
+                # The workers access the database in a transaction of their
+                # own
+                template = app.jinja_env.from_string(
+                    '{{ greeting }} {{ name }} {{ languages() }}'
+                )
+                messages = list(render_emails(
+                    u'sender@openlabs.co.in', recipients, u'Newsletter',
+                    text_template=template, processes=2, greeting='Hi',
+                    languages=lambda: Lang.search([], count=True),
+                ))
+
+            self.assertEqual(
+                [to for to, _ in messages], [to for to, _ in recipients]
+            )
+            for i, (to, message) in enumerate(messages):
+                self.assertEqual(
+                    message_from_string(message).get_payload(decode=True),
+                    'Hi %d %d' % (i, languages)
+                )
+
 
 class TestLazyRendering(BaseTestCase):
     '''
@@ -529,12 +653,334 @@ class TestLazyRendering(BaseTestCase):
                 self.assertEqual(response.status_code, 201)
 
 
+class TestFragmentCache(BaseTestCase):
+    '''
+    Test the caching of template fragments
+    '''
+
+    def test_0010_cache_timeout(self):
+        '''
+        A cached fragment is rendered only once
+        '''
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app(
+                CACHE_TYPE='werkzeug.contrib.cache.SimpleCache'
+            )
+            template = app.jinja_env.from_string(
+                "{% cache 'fragment', 3600 %}{{ value }}{% endcache %}"
+            )
+
+            with app.test_request_context('/'):
+                self.assertEqual(template.render(value=1), '1')
+                self.assertEqual(template.render(value=2), '1')
+
+    def test_0020_cache_tags(self):
+        '''
+        Invalidating a tag expires the fragments depending on it
+        '''
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app(
+                CACHE_TYPE='werkzeug.contrib.cache.SimpleCache'
+            )
+            tagged = app.jinja_env.from_string(
+                "{% cache 'tagged', 3600, tags=['product.product:1'] %}"
+                "{{ value }}{% endcache %}"
+            )
+            untagged = app.jinja_env.from_string(
+                "{% cache 'untagged', tags=['product.product:2'] %}"
+                "{{ value }}{% endcache %}"
+            )
+
+            with app.test_request_context('/'):
+                self.assertEqual(tagged.render(value=1), '1')
+                self.assertEqual(untagged.render(value=1), '1')
+                self.assertEqual(tagged.render(value=2), '1')
+
+                invalidate_cache_tags('product.product:1')
+
+                self.assertEqual(tagged.render(value=2), '2')
+                self.assertEqual(untagged.render(value=2), '1')
+
+    def test_0030_dynamic_block_in_fragment(self):
+        '''
+        Dynamic blocks within a cached fragment are rendered every time
+        '''
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app(
+                CACHE_TYPE='werkzeug.contrib.cache.SimpleCache'
+            )
+            template = app.jinja_env.from_string(
+                "{% cache 'fragment' %}{{ value }}|"
+                "{% dynamic 'tests/dynamic-block.html', greeting=greeting %}"
+                "{% endcache %}"
+            )
+
+            with app.test_request_context('/?name=a'):
+                self.assertEqual(
+                    template.render(value=1, greeting='Hi'), '1|<b>Hi a</b>'
+                )
+            with app.test_request_context('/?name=b'):
+                # The keyword arguments are evaluated when cached
+                self.assertEqual(
+                    template.render(value=2, greeting='Bye'), '1|<b>Hi b</b>'
+                )
+
+    def test_0040_cached_page(self):
+        '''
+        Render a cached page with a dynamic block
+        '''
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app(
+                CACHE_TYPE='werkzeug.contrib.cache.SimpleCache'
+            )
+
+            with app.test_request_context('/?name=a'):
+                # Without a cache hit the page and block are rendered
+                self.assertEqual(
+                    render_cached_template(
+                        'page', 'tests/cached-page.html', value=1,
+                        greeting='Hi'
+                    ),
+                    '1|<b>Hi a</b>'
+                )
+            with app.test_request_context('/?name=<b>'):
+                # The dynamic block alone is rendered on a hit
+                self.assertEqual(
+                    render_cached_template(
+                        'page', 'tests/cached-page.html', value=2,
+                        greeting='Hi'
+                    ),
+                    '1|<b>Hi &lt;b&gt;</b>'
+                )
+                # The dynamic tag renders inline outside cached pages
+                self.assertEqual(
+                    render_template(
+                        'tests/cached-page.html', value=3, greeting='Hi'
+                    ),
+                    '3|<b>Hi &lt;b&gt;</b>'
+                )
+
+    def test_0042_cached_page_key(self):
+        '''
+        Cached pages with the same key are not shared between websites and
+        templates
+        '''
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            website, = self.nereid_website_obj.search([])
+            self.nereid_website_obj.copy([website], {'name': 'otherhost'})
+            app = self.get_app(
+                CACHE_TYPE='werkzeug.contrib.cache.SimpleCache'
+            )
+
+            with app.test_request_context('/'):
+                self.assertEqual(
+                    render_cached_template(
+                        'page', 'tests/cached-page.html', value=1,
+                        greeting='Hi'
+                    ),
+                    '1|<b>Hi </b>'
+                )
+                self.assertEqual(
+                    render_cached_template('page', 'from-local.html'),
+                    'from-local-folder'
+                )
+            with app.test_request_context(
+                    '/', base_url='http://otherhost/'):
+                self.assertEqual(
+                    render_cached_template(
+                        'page', 'tests/cached-page.html', value=2,
+                        greeting='Hi'
+                    ),
+                    '2|<b>Hi </b>'
+                )
+            with app.test_request_context('/'):
+                self.assertEqual(
+                    render_cached_template(
+                        'page', 'tests/cached-page.html', value=3,
+                        greeting='Hi'
+                    ),
+                    '1|<b>Hi </b>'
+                )
+
+    def test_0045_injected_dynamic_block(self):
+        '''
+        Dynamic block placeholders injected in the output are not rendered
+        '''
+        path = os.path.join(tempfile.mkdtemp(), 'exploited')
+
+        class Exploit(object):
+            def __reduce__(self):
+                return (os.mkdir, (path,))
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app(
+                CACHE_TYPE='werkzeug.contrib.cache.SimpleCache'
+            )
+            template = app.jinja_env.from_string(
+                "{% cache 'injected' %}{{ value|safe }}{% endcache %}"
+            )
+            forged = URLSafeSerializer(
+                'not-the-secret', salt='nereid-dynamic-block'
+            ).dumps(['tests/dynamic-block.html', {'greeting': 'Hi'}])
+            pickled = base64.urlsafe_b64encode(pickle.dumps(Exploit(), 2))
+
+            with app.test_request_context('/?name=a'):
+                self.assertEqual(
+                    template.render(value=(
+                        '<!--nereid-dynamic:%s-->|'
+                        '<!--nereid-dynamic:%s-->' % (forged, pickled)
+                    )),
+                    '|'
+                )
+            self.assertFalse(os.path.exists(path))
+
+    def test_0050_cached_page_tags(self):
+        '''
+        Invalidate a cached page using its tags
+        '''
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app(
+                CACHE_TYPE='werkzeug.contrib.cache.SimpleCache'
+            )
+
+            with app.test_request_context('/'):
+                self.assertEqual(
+                    render_cached_template(
+                        'page', 'tests/cached-page.html', cache_tags=['page'],
+                        value=1, greeting='Hi'
+                    ),
+                    '1|<b>Hi </b>'
+                )
+                invalidate_cache_tags('page')
+                self.assertEqual(
+                    render_cached_template(
+                        'page', 'tests/cached-page.html', cache_tags=['page'],
+                        value=2, greeting='Hi'
+                    ),
+                    '2|<b>Hi </b>'
+                )
+
+
+class TestLazyContextProcessors(BaseTestCase):
+    '''
+    Test the lazy context processors
+    '''
+
+    def get_lazy_app(self, calls):
+        app = self.get_app()
+
+        @app.lazy_context_processor('expensive')
+        def expensive():
+            calls.append(1)
+            return 'value'
+
+        app.jinja_loader.loaders
+        app.jinja_loader._loaders.insert(0, jinja2.DictLoader({
+            'uses.html': '{{ expensive }}',
+            'plain.html': 'plain',
+            'includes.html': "{% include 'uses.html' %}",
+            'extends-variable.html': '{% extends layout %}',
+        }))
+        return app
+
+    def test_0010_referenced_only(self):
+        '''
+        Lazy context processors are called only if the template uses them
+        '''
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            calls = []
+            app = self.get_lazy_app(calls)
+
+            with app.test_request_context('/'):
+                self.assertEqual(
+                    unicode(render_template('plain.html')), 'plain'
+                )
+                self.assertEqual(len(calls), 0)
+
+                self.assertEqual(
+                    unicode(render_template('uses.html')), 'value'
+                )
+                self.assertEqual(len(calls), 1)
+
+                # Variables of the included templates are found too
+                self.assertEqual(
+                    unicode(render_template('includes.html')), 'value'
+                )
+                self.assertEqual(len(calls), 2)
+
+                # Values in the context are not overwritten
+                self.assertEqual(
+                    unicode(render_template('uses.html', expensive='given')),
+                    'given'
+                )
+                self.assertEqual(len(calls), 2)
+
+    def test_0020_undetermined_templates(self):
+        '''
+        Every lazy context processor is called if the templates cannot be
+        determined statically
+        '''
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            calls = []
+            app = self.get_lazy_app(calls)
+
+            with app.test_request_context('/'):
+                self.assertEqual(
+                    unicode(render_template(
+                        'extends-variable.html', layout='plain.html'
+                    )),
+                    'plain'
+                )
+                self.assertEqual(len(calls), 1)
+
+                # Flask's render_template calls every one of them
+                self.assertEqual(
+                    flask.render_template('plain.html'), 'plain'
+                )
+                self.assertEqual(len(calls), 2)
+
+    def test_0030_current_user(self):
+        '''
+        The current user and csrf token are available lazily
+        '''
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+            app.jinja_loader.loaders
+            app.jinja_loader._loaders.insert(0, jinja2.DictLoader({
+                'user.html': '{{ current_user.is_anonymous() }}',
+            }))
+
+            with app.test_request_context('/'):
+                self.assertEqual(
+                    unicode(render_template('user.html')), 'True'
+                )
+                self.assertTrue(
+                    'current_user' in app.get_template_variables(
+                        app.jinja_env.get_template('user.html')
+                    )
+                )
+
+
 def suite():
     "Nereid Template Loading test suite"
     test_suite = unittest.TestSuite()
     test_suite.addTests([
         unittest.TestLoader().loadTestsFromTestCase(TestTemplateLoading),
         unittest.TestLoader().loadTestsFromTestCase(TestLazyRendering),
+        unittest.TestLoader().loadTestsFromTestCase(TestFragmentCache),
+        unittest.TestLoader().loadTestsFromTestCase(
+            TestLazyContextProcessors
+        ),
     ])
     return test_suite
 
@@ -266,6 +266,17 @@ class Party(ModelSQL, ModelView):
 
     nereid_users = fields.One2Many('nereid.user', 'party', 'Web Users')
 
+    @classmethod
+    def write(cls, parties, values, *args):
+        # The names of the parties are cached with the loaded users
+        Pool().get('nereid.user').clear_load_cache()
+        return super(Party, cls).write(parties, values, *args)
+
+    @classmethod
+    def delete(cls, parties):
+        Pool().get('nereid.user').clear_load_cache()
+        return super(Party, cls).delete(parties)
+
     def add_contact_mechanism_if_not_exists(self, type, value):
         """
         Adds a contact mechanism to the party if it does not exist
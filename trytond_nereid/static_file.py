@@ -5,6 +5,7 @@ import mimetypes
 
 from nereid import route
 from nereid.helpers import send_file, url_for
+from nereid.cache_tags import CacheTagMixin
 from nereid.globals import _request_ctx_stack
 from werkzeug import abort
 
@@ -86,8 +87,10 @@ class NereidStaticFolder(ModelSQL, ModelView):
             self.raise_user_error('invalid_name')
 
 
-class NereidStaticFile(ModelSQL, ModelView):
+class NereidStaticFile(CacheTagMixin, ModelSQL, ModelView):
     "Static files for Nereid"
+    # The cache tags of the files, nereid.static.file and
+    # nereid.static.file:<id>, are invalidated when the files change
     __name__ = "nereid.static.file"
 
     name = fields.Char('File Name', select=True, required=True)
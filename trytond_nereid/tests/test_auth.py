@@ -9,6 +9,7 @@ import json
 import trytond.tests.test_tryton
 from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
 from trytond.transaction import Transaction
+from trytond.exceptions import UserError
 from trytond.config import config
 from nereid.testing import NereidTestCase
 from nereid import permissions_required
@@ -814,6 +815,234 @@ class TestAuth(NereidTestCase):
                 perm_any=[p3.value, p4.value]
             ))
 
+    def test_0105_permissions_cache(self):
+        '''
+        Permissions are cached and the cache is cleared on changes
+        '''
+        UserPermission = POOL.get('nereid.permission-nereid.user')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            user1, user2, user3 = self.nereid_user_obj.create([{
+                'party': self.party,
+                'display_name': 'User %d' % i,
+                'email': 'user%d@example.com' % i,
+                'password': 'password',
+                'company': self.company,
+            } for i in xrange(3)])
+            p1, p2 = self.nereid_permission_obj.create([
+                {'name': 'p1', 'value': 'nereid.perm1'},
+                {'name': 'p2', 'value': 'nereid.perm2'},
+            ])
+            self.nereid_user_obj.write([user1], {
+                'permissions': [('add', [p1, p2])]
+            }, [user2], {
+                'permissions': [('add', [p2])]
+            })
+
+            self.assertEqual(
+                self.nereid_user_obj.get_permissions_for(
+                    [user1.id, user2.id, user3.id]
+                ), {
+                    user1.id: frozenset(['nereid.perm1', 'nereid.perm2']),
+                    user2.id: frozenset(['nereid.perm2']),
+                    user3.id: frozenset(),
+                }
+            )
+            cache = self.nereid_user_obj._permissions_cache
+            self.assertEqual(cache.get(user3.id), frozenset())
+            self.assertTrue(user2.has_permissions(['nereid.perm2']))
+
+            # Changes to the permissions of a user
+            UserPermission.create([{
+                'nereid_user': user3.id, 'permission': p1.id,
+            }])
+            self.assertEqual(cache.get(user3.id), None)
+            self.assertEqual(user3.get_permissions(), set(['nereid.perm1']))
+
+            # Changes to permissions
+            self.nereid_permission_obj.write([p1], {'value': 'nereid.new'})
+            self.assertEqual(user3.get_permissions(), set(['nereid.new']))
+            self.nereid_permission_obj.delete([p2])
+            self.assertEqual(user1.get_permissions(), set(['nereid.new']))
+            self.assertFalse(user2.has_permissions(['nereid.perm2']))
+
+    def test_0106_load_users(self):
+        '''
+        Users are loaded with their party and permissions in batched
+        queries and the cache is cleared on changes
+        '''
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            user1, user2 = self.nereid_user_obj.create([{
+                'party': self.party,
+                'display_name': 'User %d' % i,
+                'email': 'user%d@example.com' % i,
+                'password': 'password',
+                'company': self.company,
+                'active': bool(i),
+            } for i in xrange(2)])
+            Transaction().cursor.cache.clear()
+
+            cursor = Transaction().cursor
+            queries = []
+            execute = cursor.execute
+
+            def counting_execute(*args, **kwargs):
+                queries.append(args[0])
+                return execute(*args, **kwargs)
+
+            cursor.execute = counting_execute
+            try:
+                users = self.nereid_user_obj.load_users(
+                    [user2.id, -1, user1.id]
+                )
+                self.assertEqual(len(queries), 2)
+                self.assertEqual(users, [user2, user1])
+                self.assertEqual(
+                    [(u.display_name, u.active, u.party.name) for u in users],
+                    [('User 1', True, 'Openlabs'),
+                     ('User 0', False, 'Openlabs')]
+                )
+                self.assertEqual(users[1].company, self.company)
+                self.assertTrue(users[0].has_permissions([]))
+                self.assertEqual(len(queries), 2)
+
+                # The next loads are served from the cache
+                user, = self.nereid_user_obj.load_users([user1.id])
+                self.assertEqual(user.email, 'user0@example.com')
+                self.assertEqual(len(queries), 2)
+            finally:
+                del cursor.execute
+
+            self.assertEqual(self.nereid_user_obj.load_user('a'), None)
+            self.assertEqual(self.nereid_user_obj.load_user(-1), None)
+
+            # Changes to users and parties clear the cache
+            cache = self.nereid_user_obj._load_cache
+            self.nereid_user_obj.write([user1], {'display_name': 'New'})
+            self.assertEqual(cache.get(user1.id), None)
+            self.assertEqual(
+                self.nereid_user_obj.load_user(user1.id).display_name, 'New'
+            )
+            self.party_obj.write([self.party], {'name': 'New Party'})
+            self.assertEqual(cache.get(user1.id), None)
+            self.assertEqual(
+                self.nereid_user_obj.load_user(user1.id).party.name,
+                'New Party'
+            )
+
+    def test_0107_import_users(self):
+        '''
+        Users are imported in chunks and the invalid records reported
+        '''
+        ContactMechanism = POOL.get('party.contact_mechanism')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            self.nereid_user_obj.create([{
+                'party': self.party,
+                'display_name': 'Existing',
+                'email': 'existing@example.com',
+                'company': self.company,
+            }])
+            records = [
+                {'name': 'User 1', 'email': 'user1@example.com',
+                    'password': 'password'},
+                {'name': 'Invalid', 'email': 'invalid'},
+                {'name': 'Existing', 'email': 'existing@example.com'},
+                {'display_name': 'User 2', 'email': 'user2@example.com',
+                    'party': self.party.id, 'active': False},
+                {'name': 'Duplicate', 'email': 'user1@example.com'},
+                {'name': 'User 3', 'email': 'user3@example.com',
+                    'timezone': 'Nowhere'},
+                {'name': 'User 4', 'email': 'user4@example.com',
+                    'timezone': 'Asia/Kolkata'},
+            ]
+            progress = []
+
+            user_ids, errors = self.nereid_user_obj.import_users(
+                iter(records), self.company.id, chunk_size=3,
+                progress=lambda *args: progress.append(args)
+            )
+            self.assertEqual([index for index, message in errors], [1, 2, 4, 5])
+            self.assertEqual(progress, [(3, 1, 2), (6, 2, 4), (7, 3, 4)])
+
+            user1, user2, user4 = self.nereid_user_obj.browse(user_ids)
+            self.assertTrue(user1.match_password('password'))
+            self.assertEqual(user1.party.name, 'User 1')
+            self.assertEqual(user1.display_name, 'User 1')
+            self.assertEqual(
+                ContactMechanism.search([
+                    ('party', '=', user1.party.id),
+                ])[0].value, 'user1@example.com'
+            )
+            self.assertEqual(user2.party, self.party)
+            self.assertFalse(user2.active)
+            self.assertEqual(user4.timezone, 'Asia/Kolkata')
+            self.assertEqual(user4.company, self.company)
+
+    def test_0108_import_users_failures(self):
+        '''
+        Emails are normalised and the records failing on creation are
+        reported without aborting the import
+        '''
+        User = self.nereid_user_obj
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            User.create([{
+                'party': self.party,
+                'display_name': 'Existing',
+                'email': 'existing@example.com',
+                'company': self.company,
+            }])
+            records = [
+                {'name': 'User 1', 'email': ' User1@Example.com'},
+                {'name': 'Existing', 'email': 'EXISTING@example.com '},
+                {'name': 'Broken', 'email': 'broken@example.com'},
+                {'name': 'Duplicate', 'email': 'user1@EXAMPLE.com'},
+                {'name': 'User 2', 'email': 'user2@example.com'},
+            ]
+
+            original = vars(User).get('validate')
+
+            def validate(users):
+                super(User, User).validate(users)
+                if any(u.display_name == 'Broken' for u in users):
+                    raise UserError('Broken user')
+            User.validate = staticmethod(validate)
+            try:
+                user_ids, errors = User.import_users(
+                    records, self.company.id
+                )
+            finally:
+                if original is None:
+                    del User.validate
+                else:
+                    User.validate = original
+
+            self.assertEqual([index for index, message in errors], [1, 2, 3])
+            self.assertTrue('Broken user' in errors[1][1])
+            self.assertEqual(
+                [user.email for user in User.browse(user_ids)],
+                ['user1@example.com', 'user2@example.com']
+            )
+            # The records of the failed chunk are undone
+            self.assertEqual(User.search([
+                ('email', '=', 'broken@example.com'),
+            ]), [])
+            self.assertEqual(len(User.search([
+                ('email', '=', 'user1@example.com'),
+            ])), 1)
+            self.assertEqual(self.party_obj.search([
+                ('name', '=', 'Broken'),
+            ]), [])
+
     def test_0110_user_management(self):
         """
         ensure that the cookie gets cleared if the user in session
@@ -1030,6 +1259,90 @@ class TestAuth(NereidTestCase):
                 )
                 self.assertEqual(response.status_code, 302)
 
+    def test_215_credentials_cache(self):
+        """
+        Users authenticated by the Authorization header are cached until
+        the users change
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            party, = self.party_obj.create([{'name': 'Registered user'}])
+            nereid_user, = self.nereid_user_obj.create([{
+                'party': party,
+                'display_name': 'Registered User',
+                'email': 'email@example.com',
+                'password': 'password',
+                'company': self.company,
+            }])
+
+            original = vars(self.nereid_user_obj).get('authenticate')
+            authenticate = self.nereid_user_obj.authenticate.im_func
+            calls = []
+
+            def counting_authenticate(cls, email, password):
+                calls.append(email)
+                return authenticate(cls, email, password)
+
+            def basic_auth(password):
+                return {
+                    'Authorization': 'Basic ' + base64.b64encode(
+                        'email@example.com:' + password
+                    )
+                }
+
+            self.nereid_user_obj.authenticate = classmethod(
+                counting_authenticate
+            )
+            try:
+                with app.test_client() as c:
+                    for i in xrange(3):
+                        response = c.get('/me', headers=basic_auth('password'))
+                        self.assertEqual(response.status_code, 200)
+                    self.assertEqual(len(calls), 1)
+
+                    token = nereid_user.get_auth_token()
+                    for i in xrange(2):
+                        response = c.get('/me', headers={
+                            'Authorization': 'token ' + token
+                        })
+                        self.assertEqual(response.status_code, 200)
+
+                    # A change of password invalidates the credentials
+                    self.nereid_user_obj.write(
+                        [nereid_user], {'password': 'new'}
+                    )
+                    response = c.get('/me', headers=basic_auth('password'))
+                    self.assertEqual(response.status_code, 302)
+                    response = c.get('/me', headers={
+                        'Authorization': 'token ' + token
+                    })
+                    self.assertEqual(response.status_code, 302)
+                    response = c.get('/me', headers=basic_auth('new'))
+                    self.assertEqual(response.status_code, 200)
+                    self.assertEqual(len(calls), 3)
+
+                    # And so does the deactivation of the user
+                    self.nereid_user_obj.write([nereid_user], {'active': False})
+                    response = c.get('/me', headers=basic_auth('new'))
+                    self.assertEqual(response.status_code, 302)
+                    self.assertEqual(len(calls), 4)
+
+                # The cache is disabled with a timeout of 0
+                self.nereid_user_obj.write([nereid_user], {'active': True})
+                app.config['AUTH_CACHE_TIMEOUT'] = 0
+                with app.test_client() as c:
+                    for i in xrange(2):
+                        response = c.get('/me', headers=basic_auth('new'))
+                        self.assertEqual(response.status_code, 200)
+                    self.assertEqual(len(calls), 6)
+            finally:
+                if original is None:
+                    del self.nereid_user_obj.authenticate
+                else:
+                    self.nereid_user_obj.authenticate = original
+
     def test_0400_auth_xhr_wrong(self):
         """
         Ensure that auth in XHR sends the right results
@@ -8,6 +8,8 @@
     :copyright: (c) 2012-2015 by Openlabs Technologies & Consulting (P) LTD
     :license: GPLv3, see LICENSE for more details.
 """
+import shutil
+import tempfile
 import unittest
 
 import trytond.tests.test_tryton
@@ -16,7 +18,7 @@ from trytond.transaction import Transaction
 from trytond.pool import PoolMeta, Pool
 from trytond.config import config
 from nereid.testing import NereidTestCase
-from nereid import render_template, route
+from nereid import render_template, route, cache_tags
 
 config.set('email', 'from', 'from@xyz.com')
 config.set('database', 'path', '/tmp/temp_tryton_data/')
@@ -161,6 +163,110 @@ class TestStaticFile(NereidTestCase):
                 self.assertEqual(rv.status_code, 200)
                 self.assertTrue('/en_US/static-file/test/test.png' in rv.data)
 
+    def test_0030_cache_tags(self):
+        """
+        Changes to static files invalidate their cache tags, outside of an
+        application too with the cache configured in tryton
+        """
+        cache_dir = tempfile.mkdtemp()
+        if not config.has_section('nereid'):
+            config.add_section('nereid')
+        config.set(
+            'nereid', 'cache_type', 'werkzeug.contrib.cache.FileSystemCache'
+        )
+        config.set('nereid', 'cache_dir', cache_dir)
+        try:
+            with Transaction().start(DB_NAME, USER, CONTEXT):
+                self.setup_defaults()
+                static_file = self.create_static_file(buffer('test-content'))
+                tag = 'nereid.static.file:%d' % static_file.id
+
+                app = self.get_app(
+                    CACHE_TYPE='werkzeug.contrib.cache.FileSystemCache',
+                    CACHE_DIR=cache_dir,
+                )
+                with app.app_context():
+                    version, = app.cache_tags.get_versions([tag])
+
+                # A change from the tryton client
+                self.static_file_obj.write([static_file], {'sequence': 20})
+                with app.app_context():
+                    self.assertNotEqual(
+                        app.cache_tags.get_versions([tag]), [version]
+                    )
+                    version, = app.cache_tags.get_versions([tag])
+
+                    self.static_file_obj.write(
+                        [static_file], {'sequence': 30}
+                    )
+                    self.assertNotEqual(
+                        app.cache_tags.get_versions([tag]), [version]
+                    )
+        finally:
+            config.remove_option('nereid', 'cache_type')
+            config.remove_option('nereid', 'cache_dir')
+            cache_tags._configured_tag_store = None
+            shutil.rmtree(cache_dir)
+
+    def test_0035_cache_tags_after_commit(self):
+        """
+        Tags invalidated during a request are bumped again once the
+        transaction of the request is committed
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            static_file = self.create_static_file(buffer('test-content'))
+            tag = 'nereid.static.file:%d' % static_file.id
+
+            app = self.get_app(
+                CACHE_TYPE='werkzeug.contrib.cache.SimpleCache'
+            )
+            with app.test_request_context('/'):
+                self.static_file_obj.write([static_file], {'sequence': 20})
+                # A render before the commit caches the old records
+                # against this version
+                version, = app.cache_tags.get_versions([tag])
+
+                cache_tags.bump_pending_cache_tags()
+                self.assertNotEqual(
+                    app.cache_tags.get_versions([tag]), [version]
+                )
+                version, = app.cache_tags.get_versions([tag])
+
+                # The pending tags are bumped only once
+                cache_tags.bump_pending_cache_tags()
+                self.assertEqual(
+                    app.cache_tags.get_versions([tag]), [version]
+                )
+
+    def test_0037_cache_tags_misconfigured(self):
+        """
+        A cache which cannot be created from the tryton configuration does
+        not prevent changing the records
+        """
+        if not config.has_section('nereid'):
+            config.add_section('nereid')
+        try:
+            for cache_type in (
+                    'nereid.cache_backends.SharedMemoryCache',
+                    'nereid.cache_backends.TwoTierCache'):
+                config.set('nereid', 'cache_type', cache_type)
+                cache_tags._configured_tag_store = None
+                self.assertIsNone(cache_tags.get_configured_tag_store())
+
+                with Transaction().start(DB_NAME, USER, CONTEXT):
+                    self.setup_defaults()
+                    static_file = self.create_static_file(
+                        buffer('test-content')
+                    )
+                    self.static_file_obj.write(
+                        [static_file], {'sequence': 20}
+                    )
+                    self.assertEqual(static_file.sequence, 20)
+        finally:
+            config.remove_option('nereid', 'cache_type')
+            cache_tags._configured_tag_store = None
+
 
 def suite():
     "Nereid test suite"
@@ -1,9 +1,12 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import os
 import unittest
 import trytond.tests.test_tryton
 from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
 from trytond.transaction import Transaction
+from trytond.config import config
+from babel.messages.extract import extract_from_dir
 from nereid.testing import NereidTestCase
 
 
@@ -90,6 +93,124 @@ class TestTranslation(NereidTestCase):
 
             self.assertTrue(count_after > count_before)
 
+    def test_0035_extraction_creates_missing(self):
+        """
+        Running the extraction again only creates the missing translations
+        """
+        TranslationSet = POOL.get('ir.translation.set', type='wizard')
+        IRTranslation = POOL.get('ir.translation')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            session_id, _, _ = TranslationSet.create()
+            set_wizard = TranslationSet(session_id)
+
+            set_wizard.set_nereid_template()
+            set_wizard.set_wtforms()
+            set_wizard.set_nereid()
+            count = IRTranslation.search([], count=True)
+
+            set_wizard.set_nereid_template()
+            set_wizard.set_wtforms()
+            set_wizard.set_nereid()
+            self.assertEqual(IRTranslation.search([], count=True), count)
+
+            for ttype in ('nereid_template', 'wtforms', 'nereid'):
+                translation, = IRTranslation.search([
+                    ('type', '=', ttype),
+                ], limit=1)
+                key = (translation.name, translation.src, translation.module)
+                IRTranslation.delete([translation])
+
+                getattr(set_wizard, 'set_%s' % ttype)()
+                self.assertEqual(
+                    IRTranslation.search([], count=True), count
+                )
+                self.assertEqual(IRTranslation.search([
+                    ('type', '=', ttype),
+                    ('name', '=', key[0]),
+                    ('src', '=', key[1]),
+                    ('module', '=', key[2]),
+                ], count=True), 1)
+
+    def test_0037_extraction_cache_and_processes(self):
+        """
+        Messages are extracted once per file, in a pool of processes if
+        configured, with the same results
+        """
+        from trytond.modules.nereid import translation
+
+        TranslationSet = POOL.get('ir.translation.set', type='wizard')
+
+        extract_file = translation._extract_file
+        calls = []
+
+        def counting_extract_file(job):
+            calls.append(job[1])
+            return extract_file(job)
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            translation._extraction_cache.clear()
+            translation._extract_file = counting_extract_file
+            try:
+                messages = list(TranslationSet._get_nereid_template_messages())
+                self.assertTrue(messages)
+                self.assertEqual(len(calls), len(set(calls)))
+                count = len(calls)
+
+                # The files are parsed again only if they changed
+                self.assertEqual(
+                    list(TranslationSet._get_nereid_template_messages()),
+                    messages
+                )
+                self.assertEqual(len(calls), count)
+                os.utime(calls[0], None)
+                self.assertEqual(
+                    list(TranslationSet._get_nereid_template_messages()),
+                    messages
+                )
+                self.assertEqual(len(calls), count)
+            finally:
+                translation._extract_file = extract_file
+
+            translation._extraction_cache.clear()
+            if not config.has_section('nereid'):
+                config.add_section('nereid')
+            config.set('nereid', 'extract_processes', '2')
+            try:
+                self.assertEqual(
+                    list(TranslationSet._get_nereid_template_messages()),
+                    messages
+                )
+            finally:
+                config.remove_option('nereid', 'extract_processes')
+
+            # The cache is bounded
+            size_limit = translation._extraction_cache.size_limit
+            translation._extraction_cache.size_limit = 2
+            try:
+                self.assertEqual(
+                    list(TranslationSet._get_nereid_template_messages()),
+                    messages
+                )
+                self.assertEqual(len(translation._extraction_cache), 2)
+            finally:
+                translation._extraction_cache.size_limit = size_limit
+
+            # The python files are those babel would extract from
+            for module, directory in \
+                    TranslationSet._get_installed_module_directories():
+                self.assertEqual(
+                    sorted(set(
+                        filename for filename, _, _, _, _ in
+                        extract_from_dir(directory)
+                    )),
+                    sorted(set(
+                        filename for filename, path in
+                        TranslationSet._get_python_files(directory)
+                        if translation._extract_file(('python', path, {}))
+                    ))
+                )
+
     def test_0040_template_gettext_using_(self):
         """
         Test for gettext without comment using _
@@ -402,6 +523,123 @@ class TestTranslation(NereidTestCase):
             IRTranslation.translation_export(new_lang.code, 'nereid_test')
             IRTranslation.translation_export(new_lang.code, 'nereid')
 
+    def test_0500_nereid_catalog(self):
+        """
+        The translations are looked up in catalogs loaded in a single query
+        and reloaded on changes
+        """
+        IRTranslation = POOL.get('ir.translation')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            hello, = IRTranslation.create([{
+                'name': 'nereid_test', 'res_id': -1, 'lang': 'en_US',
+                'type': 'nereid', 'module': 'nereid_test',
+                'src': 'Hello', 'value': 'Howdy',
+            }, {
+                'name': 'nereid_test', 'res_id': -1, 'lang': 'en_US',
+                'type': 'nereid', 'module': 'nereid_test',
+                'src': 'Bye', 'value': '',
+            }])[:1]
+
+            cursor = Transaction().cursor
+            queries = []
+            execute = cursor.execute
+
+            def counting_execute(*args, **kwargs):
+                queries.append(args[0])
+                return execute(*args, **kwargs)
+
+            cursor.execute = counting_execute
+            try:
+                for module in ('nereid_test', None, 'nereid_test', None):
+                    self.assertEqual(
+                        IRTranslation.get_translation_4_nereid(
+                            module, 'nereid', 'en_US', 'Hello'
+                        ), 'Howdy'
+                    )
+                    self.assertEqual(
+                        IRTranslation.get_translation_4_nereid(
+                            module, 'nereid', 'en_US', 'Bye'
+                        ), None
+                    )
+                # The catalogs of the module and of all modules
+                self.assertEqual(len(queries), 2)
+                self.assertEqual(
+                    IRTranslation.get_translation_4_nereid(
+                        'nereid', 'nereid', 'en_US', 'Hello'
+                    ), None
+                )
+                self.assertEqual(len(queries), 3)
+            finally:
+                del cursor.execute
+
+            # The catalog is reloaded after a change
+            IRTranslation.write([hello], {'value': 'Hi'})
+            self.assertEqual(
+                IRTranslation.get_translation_4_nereid(
+                    None, 'nereid', 'en_US', 'Hello'
+                ), 'Hi'
+            )
+
+    def test_0510_nereid_catalog_partitions(self):
+        """
+        Changes to translations clear the catalogs of their language, type
+        and module alone
+        """
+        IRTranslation = POOL.get('ir.translation')
+
+        def is_cached(lang, ttype, module=None):
+            partition = (lang, ttype, module)
+            return IRTranslation._get_nereid_catalog_cache(
+                partition
+            ).get(partition) is not None
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            hello_en, hello_fr = IRTranslation.create([{
+                'name': 'nereid_test', 'res_id': -1, 'lang': lang,
+                'type': 'nereid', 'module': 'nereid_test',
+                'src': 'Hello', 'value': value,
+            } for lang, value in [('en_US', 'Howdy'), ('fr_FR', 'Salut')]])
+
+            IRTranslation.load_translations_4_nereid(['en_US', 'fr_FR'])
+            for lang in ('en_US', 'fr_FR'):
+                for ttype in ('nereid', 'nereid_template', 'wtforms'):
+                    self.assertTrue(is_cached(lang, ttype))
+                self.assertTrue(is_cached(lang, 'nereid', 'nereid_test'))
+
+            IRTranslation.write([hello_en], {'value': 'Hi'})
+            self.assertFalse(is_cached('en_US', 'nereid'))
+            self.assertFalse(is_cached('en_US', 'nereid', 'nereid_test'))
+            self.assertTrue(is_cached('en_US', 'wtforms'))
+            self.assertTrue(is_cached('fr_FR', 'nereid'))
+            self.assertTrue(is_cached('fr_FR', 'nereid', 'nereid_test'))
+            self.assertEqual(
+                IRTranslation.get_translation_4_nereid(
+                    'nereid_test', 'nereid', 'en_US', 'Hello'
+                ), 'Hi'
+            )
+
+            # Moving a translation clears both partitions
+            IRTranslation.write([hello_fr], {'lang': 'en_US', 'src': 'Bye'})
+            self.assertFalse(is_cached('fr_FR', 'nereid'))
+            self.assertFalse(is_cached('en_US', 'nereid', 'nereid_test'))
+            self.assertEqual(
+                IRTranslation.get_translation_4_nereid(
+                    None, 'nereid', 'en_US', 'Bye'
+                ), 'Salut'
+            )
+
+            # Translations of other types do not clear any catalog
+            IRTranslation.load_translations_4_nereid(['en_US', 'fr_FR'])
+            IRTranslation.create([{
+                'name': 'ir.lang,name', 'res_id': -1, 'lang': 'fr_FR',
+                'type': 'field', 'src': 'Name', 'value': 'Nom',
+            }])
+            self.assertTrue(is_cached('fr_FR', 'nereid'))
+            IRTranslation.delete([hello_en])
+            self.assertFalse(is_cached('en_US', 'nereid'))
+            self.assertTrue(is_cached('fr_FR', 'nereid'))
+
 
 def suite():
     "Nereid test suite"
@@ -74,6 +74,53 @@ class TestWebsite(NereidTestCase):
                 self.assertEqual(data['status']['logged_id'], False)
                 self.assertEqual(data['status']['messages'], [])
 
+    def test_0020_warmup(self):
+        """
+        Warm up the url maps, templates, translations and urls
+        """
+        IRTranslation = POOL.get('ir.translation')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            IRTranslation.create([{
+                'name': 'tests/warmup.html',
+                'res_id': -1,
+                'lang': 'en_US',
+                'type': 'nereid_template',
+                'module': 'nereid',
+                'src': 'Hello',
+                'value': 'Howdy',
+            }])
+            self.templates = {
+                'tests/warmup.html': "{{ _('Hello') }}",
+            }
+            app = self.get_app(
+                WARMUP_TEMPLATES=['tests/warmup.html', 'tests/missing.html'],
+                WARMUP_URLS=['/user_status'],
+            )
+            website, = self.NereidWebsite.search([])
+            self.NereidWebsite.clear_url_adapter_cache()
+
+            report = app.warmup()
+
+            self.assertEqual(
+                report.keys(), ['url_maps', 'templates', 'translations', 'urls']
+            )
+            self.assertEqual(report['url_maps']['count'], 1)
+            self.assertTrue(
+                self.NereidWebsite._url_adapter_cache.get(website.id)
+            )
+            # The missing template is skipped
+            self.assertEqual(report['templates']['count'], 1)
+            self.assertEqual(report['translations']['count'], 1)
+            self.assertEqual(
+                IRTranslation._get_nereid_catalog_cache(
+                    ('en_US', 'nereid_template', None)
+                ).get(('en_US', 'nereid_template', None))['Hello'],
+                'Howdy'
+            )
+            self.assertEqual(report['urls']['count'], 1)
+
 
 def suite():
     "Nereid test suite"
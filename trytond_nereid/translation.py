@@ -14,21 +14,29 @@
 '''
 import os
 import polib
+import hashlib
 import logging
+import multiprocessing
+from threading import Lock
 
 import wtforms
 from jinja2 import FileSystemLoader, Environment
 from jinja2.ext import babel_extract, GETTEXT_FUNCTIONS
-from babel.messages.extract import extract_from_dir
+from babel.messages.extract import extract_from_dir, DEFAULT_MAPPING
 from babel.messages.extract import extract_from_file
+from babel.util import pathmatch
 from trytond.model import fields
 from trytond.wizard import Wizard
 from trytond.transaction import Transaction
 from trytond.pool import Pool, PoolMeta
-from trytond.cache import Cache
-from trytond.tools import file_open
+from trytond.cache import Cache, LRUDict
+from trytond.config import config
+from trytond.tools import file_open, grouped_slice
 from trytond.const import RECORD_CACHE_SIZE
 from trytond.ir.translation import TrytonPOFile
+from sql import Column
+
+from nereid.helpers import forget_inherited_transaction
 
 __all__ = [
     'Translation',
@@ -45,6 +53,45 @@ NEREID_TRANSLATION_TYPES = [
 
 _nereid_types = [type[0] for type in NEREID_TRANSLATION_TYPES]
 
+#: The number of translations created at once by the TranslationSet wizard
+TRANSLATION_CREATE_CHUNK = 1000
+
+#: The number of files whose extracted messages are cached in the process
+EXTRACTION_CACHE_SIZE = 2000
+
+#: The messages extracted from files, by extraction method, path and
+#: options, with the modification time, size and SHA-1 hash of the file.
+#: The least recently used files are evicted.
+_extraction_cache = LRUDict(EXTRACTION_CACHE_SIZE)
+_extraction_cache_lock = Lock()
+
+
+def _init_extract_worker():
+    """
+    Forget the transaction and the database connections inherited from the
+    process of the wizard. The workers only read files.
+    """
+    forget_inherited_transaction()
+
+
+def _extract_file(job):
+    """
+    Returns the list of the messages extracted from a file, for a job which
+    is a tuple of the extraction method (`jinja2` or `python`), the path of
+    the file and the extract options.
+
+    This is a function of the module, so that it can be run by the
+    processes of a pool.
+    """
+    method, path, options = job
+    if method == 'jinja2':
+        with open(path) as file_obj:
+            return list(babel_extract(
+                file_obj, GETTEXT_FUNCTIONS, ['trans:'], options
+            ))
+    return extract_from_file(method, path)
+
+
 __metaclass__ = PoolMeta
 
 
@@ -298,59 +345,158 @@ class Translation:
             return
 
     # Begin nereid changes
-    _nereid_translation_cache = Cache(
-        'ir.translation', size_limit=10240, context=False
+    #: The caches of the catalogs of nereid translations by partition, a
+    #: tuple of the language, type and module, or `None` for the catalog of
+    #: the translations of all modules. A catalog is a dictionary of the
+    #: translations by source. Each partition has its own cache so that a
+    #: change clears the catalogs of its partition alone, in every process
+    #: as the name of the cache, which includes the partition, is stamped
+    #: with the time of the change.
+    _nereid_catalog_caches = {}
+    _nereid_catalog_caches_lock = Lock()
     # End nereid changes
-    )
 
     @classmethod
     def get_translation_4_nereid(cls, module, ttype, lang, source):
         "Return translation for source"
-        ttype = unicode(ttype)
-        lang = unicode(lang)
-        source = unicode(source)
+        catalog = cls.get_nereid_catalog(unicode(lang), unicode(ttype), module)
+        return catalog.get(unicode(source))
+
+    @classmethod
+    def _get_nereid_catalog_cache(cls, partition):
+        """
+        Returns the cache of the catalog of the partition
+        """
+        cache = cls._nereid_catalog_caches.get(partition)
+        if cache is None:
+            with cls._nereid_catalog_caches_lock:
+                cache = cls._nereid_catalog_caches.get(partition)
+                if cache is None:
+                    lang, ttype, module = partition
+                    cache = Cache(
+                        'ir.translation.nereid:%s:%s:%s' % (
+                            lang, ttype, module or '*'
+                        ), size_limit=1, context=False
+                    )
+                    cls._nereid_catalog_caches[partition] = cache
+        return cache
 
-        cache_key = (lang, ttype, source, module)
+    @classmethod
+    def get_nereid_catalog(cls, lang, ttype, module=None):
+        """
+        Returns the catalog of the nereid translations of the language,
+        type and module, or of all modules if `module` is `None`, loading
+        it if it is not cached.
 
-        trans = cls._nereid_translation_cache.get(cache_key, -1)
-        if trans != -1:
-            return trans
+        .. versionadded:: 3.4.0.6
+        """
+        partition = (lang, ttype, module)
+        catalog = cls._get_nereid_catalog_cache(partition).get(partition)
+        if catalog is None:
+            catalog = cls._load_nereid_catalogs([lang], ttype, module)[
+                partition
+            ]
+        return catalog
 
+    @classmethod
+    def _load_nereid_catalogs(cls, langs, ttype=None, module=None):
+        """
+        Loads the catalogs of the languages in a single query, for a type
+        and module or all of them, caches and returns them by partition
+        """
+        ttypes = [ttype] if ttype else _nereid_types
         cursor = Transaction().cursor
         table = cls.__table__()
         where = (
-            (table.lang == lang) &
-            (table.type == ttype) &
+            table.lang.in_(langs) &
+            table.type.in_(ttypes) &
             (table.value != '') &
             (table.value != None) &
-            (table.fuzzy == False) &
-            (table.src == source)
+            (table.fuzzy == False)
         )
         if module is not None:
             where &= (table.module == module)
+        cursor.execute(*table.select(
+            table.lang, table.type, table.module, table.src, table.value,
+            where=where
+        ))
 
-        cursor.execute(*table.select(table.value, where=where))
-        res = cursor.fetchone()
-        if res:
-            cls._nereid_translation_cache.set(cache_key, res[0])
-            return res[0]
-        else:
-            cls._nereid_translation_cache.set(cache_key, False)
-            return None
+        catalogs = dict(
+            ((lang, type_, module), {}) for lang in langs for type_ in ttypes
+        )
+        for lang, type_, module_, source, value in cursor.fetchall():
+            if module is None:
+                # Lookups without a module accept a translation from any
+                # module
+                catalogs[(lang, type_, None)].setdefault(source, value)
+            catalogs.setdefault((lang, type_, module_), {})[source] = value
+
+        for partition, catalog in catalogs.iteritems():
+            cls._get_nereid_catalog_cache(partition).set(partition, catalog)
+        return catalogs
+
+    @classmethod
+    def load_translations_4_nereid(cls, langs):
+        """
+        Load the catalogs of nereid translations of the given languages
+        used by :meth:`get_translation_4_nereid` in a single query.
+
+        Returns the number of translations loaded.
+        """
+        if not langs:
+            return 0
+        catalogs = cls._load_nereid_catalogs(map(unicode, langs))
+        return sum(
+            len(catalog) for partition, catalog in catalogs.iteritems()
+            if partition[2] is not None
+        )
+
+    @classmethod
+    def clear_nereid_catalogs(cls, partitions):
+        """
+        Clears the catalogs of the partitions, tuples of the language, type
+        and module, and those of all the modules of their languages and
+        types. Partitions of other types than the nereid ones are ignored.
+
+        .. versionadded:: 3.4.0.6
+        """
+        for lang, ttype, module in partitions:
+            if ttype not in _nereid_types:
+                continue
+            cls._get_nereid_catalog_cache((lang, ttype, module)).clear()
+            cls._get_nereid_catalog_cache((lang, ttype, None)).clear()
+
+    @staticmethod
+    def _get_nereid_partitions(translations, values=None):
+        """
+        Returns the partitions of the translations, with the given values
+        if any
+        """
+        values = values or {}
+        return set((
+            values.get('lang', t.lang),
+            values.get('type', t.type),
+            values.get('module', t.module),
+        ) for t in translations)
 
     @classmethod
     def delete(cls, translations):
-        cls._nereid_translation_cache.clear()
+        cls.clear_nereid_catalogs(cls._get_nereid_partitions(translations))
         return super(Translation, cls).delete(translations)
 
     @classmethod
     def create(cls, vlist):
-        cls._nereid_translation_cache.clear()
-        return super(Translation, cls).create(vlist)
+        translations = super(Translation, cls).create(vlist)
+        cls.clear_nereid_catalogs(cls._get_nereid_partitions(translations))
+        return translations
 
     @classmethod
     def write(cls, translations, values):
-        cls._nereid_translation_cache.clear()
+        # The translations could be moved to other partitions
+        cls.clear_nereid_catalogs(
+            cls._get_nereid_partitions(translations) |
+            cls._get_nereid_partitions(translations, values)
+        )
         return super(Translation, cls).write(translations, values)
 
 
@@ -435,6 +581,7 @@ class TranslationSet:
         extract_options = cls._get_nereid_template_extract_options()
         logger = logging.getLogger('nereid.translation')
 
+        templates, jobs = [], []
         for module, directory in cls._get_installed_module_directories():
             template_dir = os.path.join(directory, 'templates')
             if not os.path.isdir(template_dir):
@@ -446,19 +593,120 @@ class TranslationSet:
                     module, template_dir
                 )
             )
-            # now that there is a template directory, load the templates
+            # now that there is a template directory, list the templates
             # using a simple filesystem loader and load all the
-            # translations from it.
+            # translations from them.
             loader = FileSystemLoader(template_dir)
             env = Environment(loader=loader)
             extensions = '.html,.jinja'
             for template in env.list_templates(extensions=extensions):
                 logger.info('Loading from: %s:%s' % (module, template))
-                file_obj = open(loader.get_source({}, template)[1])
-                for message_tuple in babel_extract(
-                        file_obj, GETTEXT_FUNCTIONS,
-                        ['trans:'], extract_options):
-                    yield (module, template) + message_tuple
+                templates.append((module, template))
+                jobs.append((
+                    'jinja2',
+                    os.path.join(template_dir, *template.split('/')),
+                    extract_options,
+                ))
+
+        for (module, template), messages in zip(
+                templates, cls._extract_messages(jobs)):
+            for message_tuple in messages:
+                yield (module, template) + message_tuple
+
+    @classmethod
+    def _get_python_files(cls, directory):
+        """
+        A generator that yields tuples of the format (filename, path) for
+        the python files of the directory, where the filename is relative to
+        the directory, like :func:`babel.messages.extract.extract_from_dir`
+        """
+        for root, dirnames, filenames in os.walk(directory):
+            dirnames[:] = sorted(
+                subdir for subdir in dirnames
+                if not subdir.startswith(('.', '_'))
+            )
+            for filename in sorted(filenames):
+                path = os.path.join(root, filename)
+                filename = os.path.relpath(path, directory).replace(
+                    os.sep, '/'
+                )
+                if any(
+                        pathmatch(pattern, filename)
+                        for pattern, method in DEFAULT_MAPPING):
+                    yield filename, path
+
+    @classmethod
+    def _get_extract_processes(cls):
+        """
+        Returns the number of processes extracting the messages, from the
+        `extract_processes` option of the `nereid` section of the tryton
+        configuration. The messages are extracted in the process of the
+        wizard unless it is more than 1.
+        """
+        return config.getint('nereid', 'extract_processes', 0)
+
+    @classmethod
+    def _extract_messages(cls, jobs):
+        """
+        Returns the lists of the messages extracted from the files of the
+        jobs, tuples of the extraction method, path and extract options, in
+        the order of the jobs.
+
+        The messages of a file are cached in the process, for the
+        `EXTRACTION_CACHE_SIZE` most recently used files, and extracted
+        again only if both the modification time or size and the hash of
+        the file changed. The other files are extracted in a pool of
+        processes, see :meth:`_get_extract_processes`, one file at a time.
+        The workers are forked from the process of the wizard and must not
+        access the database.
+        """
+        results = [None] * len(jobs)
+        to_extract = []
+        for index, (method, path, options) in enumerate(jobs):
+            key = (method, path, repr(sorted(options.items())))
+            stat = os.stat(path)
+            with _extraction_cache_lock:
+                cached = _extraction_cache.pop(key, None)
+                if cached is not None and \
+                        cached[:2] == (stat.st_mtime, stat.st_size):
+                    # Mark as the most recently used
+                    _extraction_cache[key] = cached
+                    results[index] = cached[3]
+                    continue
+            with open(path, 'rb') as file_obj:
+                digest = hashlib.sha1(file_obj.read()).hexdigest()
+            if cached is not None and cached[2] == digest:
+                # Touched but not changed
+                with _extraction_cache_lock:
+                    _extraction_cache[key] = (
+                        stat.st_mtime, stat.st_size, digest, cached[3]
+                    )
+                results[index] = cached[3]
+                continue
+            to_extract.append((index, key, stat, digest))
+
+        extract_jobs = [jobs[index] for index, _, _, _ in to_extract]
+        processes = cls._get_extract_processes()
+        if processes > 1 and len(extract_jobs) > 1:
+            # The workers are forked from within the transaction of the
+            # wizard, so they forget its connections when they start
+            pool = multiprocessing.Pool(processes, _init_extract_worker)
+            try:
+                extracted = pool.map(_extract_file, extract_jobs, 1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            extracted = map(_extract_file, extract_jobs)
+
+        with _extraction_cache_lock:
+            for (index, key, stat, digest), messages in zip(
+                    to_extract, extracted):
+                _extraction_cache[key] = (
+                    stat.st_mtime, stat.st_size, digest, messages
+                )
+                results[index] = messages
+        return results
 
     @staticmethod
     def _get_nereid_template_messages_from_file(self, template_dir, template):
@@ -473,14 +721,45 @@ class TranslationSet:
                 ['trans:'], extract_options):
             yield (template,) + message_tuple
 
+    @classmethod
+    def _create_missing_translations(cls, ttype, vlist, key_fields):
+        """
+        Creates the translations of the list of values which do not exist,
+        in chunks. The keys of the existing en_US translations of the type,
+        the values of the key fields, are read in a single query and
+        compared with those of the values in memory.
+
+        Returns the number of translations created.
+        """
+        Translation = Pool().get('ir.translation')
+        cursor = Transaction().cursor
+        table = Translation.__table__()
+
+        cursor.execute(*table.select(
+            *[Column(table, name) for name in key_fields],
+            where=(table.lang == 'en_US') & (table.type == ttype)
+        ))
+        existing = set(cursor.fetchall())
+
+        to_create = []
+        for values in vlist:
+            key = tuple(values[name] for name in key_fields)
+            if key in existing:
+                continue
+            # The same message could be extracted twice
+            existing.add(key)
+            to_create.append(values)
+
+        for sub_vlist in grouped_slice(to_create, TRANSLATION_CREATE_CHUNK):
+            Translation.create(list(sub_vlist))
+        return len(to_create)
+
     def set_nereid_template(self):
         """
         Loads all nereid templates translatable strings into the database. The
         templates loaded are only the ones which are bundled with the tryton
         modules and available in the site packages.
         """
-        pool = Pool()
-        Translation = pool.get('ir.translation')
         to_create = []
         for module, template, lineno, function, messages, comments in \
                 self._get_nereid_template_messages():
@@ -494,16 +773,6 @@ class TranslationSet:
                 messages = (messages, )
 
             for message in messages:
-                translations = Translation.search([
-                    ('lang', '=', 'en_US'),
-                    ('type', '=', 'nereid_template'),
-                    ('name', '=', template),
-                    ('src', '=', message),
-                    ('module', '=', module),
-                    ('res_id', '=', lineno),
-                ], limit=1)
-                if translations:
-                    continue
                 to_create.append({
                     'name': template,
                     'res_id': lineno,
@@ -513,8 +782,9 @@ class TranslationSet:
                     'module': module,
                     'comments': comments and '\n'.join(comments) or None,
                 })
-        if to_create:
-            Translation.create(to_create)
+        self._create_missing_translations(
+            'nereid_template', to_create, ('name', 'src', 'module', 'res_id')
+        )
 
     def set_wtforms(self):
         """
@@ -525,8 +795,6 @@ class TranslationSet:
         an integer, then a message like “Not a valid integer value” would be
         displayed.
         """
-        pool = Pool()
-        Translation = pool.get('ir.translation')
         to_create = []
         for (filename, lineno, messages, comments, context) in \
                 extract_from_dir(os.path.dirname(wtforms.__file__)):
@@ -540,15 +808,6 @@ class TranslationSet:
                 messages = (messages, )
 
             for message in messages:
-                translations = Translation.search([
-                    ('lang', '=', 'en_US'),
-                    ('type', '=', 'wtforms'),
-                    ('name', '=', filename),
-                    ('src', '=', message),
-                    ('module', '=', 'nereid'),
-                ], limit=1)
-                if translations:
-                    continue
                 to_create.append({
                     'name': filename,
                     'res_id': lineno,
@@ -558,8 +817,9 @@ class TranslationSet:
                     'module': 'nereid',
                     'comments': comments and '\n'.join(comments) or None,
                 })
-        if to_create:
-            Translation.create(to_create)
+        self._create_missing_translations(
+            'wtforms', to_create, ('name', 'src', 'module')
+        )
 
     @staticmethod
     def _get_babel_messages_from_file(self, template):
@@ -579,16 +839,19 @@ class TranslationSet:
         function extracts the translation strings from code of installed
         modules.
         """
-        pool = Pool()
-        Translation = pool.get('ir.translation')
-        to_create = []
-
+        files, jobs = [], []
         for module, directory in self._get_installed_module_directories():
             # skip messages from test files
             if 'tests' in directory:
                 continue
-            for (filename, lineno, messages, comments, context) in \
-                    extract_from_dir(directory,):
+            for filename, path in self._get_python_files(directory):
+                files.append((module, filename))
+                jobs.append(('python', path, {}))
+
+        to_create = []
+        for (module, filename), messages_tuples in zip(
+                files, self._extract_messages(jobs)):
+            for lineno, messages, comments, context in messages_tuples:
 
                 if isinstance(messages, basestring):
                     # messages could be a tuple if the function is ngettext
@@ -599,15 +862,6 @@ class TranslationSet:
                     messages = (messages, )
 
                 for message in messages:
-                    translations = Translation.search([
-                        ('lang', '=', 'en_US'),
-                        ('type', '=', 'nereid'),
-                        ('name', '=', filename),
-                        ('src', '=', message),
-                        ('module', '=', module),
-                    ], limit=1)
-                    if translations:
-                        continue
                     to_create.append({
                         'name': filename,
                         'res_id': lineno,
@@ -617,8 +871,9 @@ class TranslationSet:
                         'module': module,
                         'comments': comments and '\n'.join(comments) or None,
                     })
-        if to_create:
-            Translation.create(to_create)
+        self._create_missing_translations(
+            'nereid', to_create, ('name', 'src', 'module')
+        )
 
 
 class TranslationUpdate:
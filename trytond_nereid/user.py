@@ -4,6 +4,10 @@ import random
 import string
 import urllib
 import base64
+import hmac
+import time
+from itertools import islice, count
+from contextlib import contextmanager
 
 try:
     import hashlib
@@ -25,10 +29,16 @@ from nereid.signals import registration
 from nereid.templating import render_email
 from trytond.model import ModelView, ModelSQL, fields
 from trytond.pool import Pool
+from trytond.cache import Cache
+from trytond.tools import grouped_slice
 from trytond.pyson import Eval, Bool, Not
 from trytond.transaction import Transaction
 from trytond.config import config
+from trytond.exceptions import UserError
 from trytond import backend
+from sql import Column
+from sql.aggregate import Max
+from sql.functions import Lower
 from itsdangerous import URLSafeSerializer, TimestampSigner, SignatureExpired, \
     BadSignature, TimedJSONWebSignatureSerializer
 from .i18n import _
@@ -193,13 +203,71 @@ class NereidUser(ModelSQL, ModelView):
             'permissions': list(self.get_permissions()),
         }
 
+    #: The permissions of the users by id. The cache is cleared when the
+    #: permissions or the users are changed, in every process as the cache
+    #: is stamped with the time of the last change.
+    _permissions_cache = Cache('nereid.user.permissions', context=False)
+
+    @classmethod
+    def clear_permissions_cache(cls, *args):
+        """
+        A method which conveniently clears the cache of permissions
+        """
+        cls._permissions_cache.clear()
+
     def get_permissions(self):
         """
-        Returns all the permissions as a list of names
+        Returns all the permissions as a frozenset of values
         """
-        # TODO: Cache this value for each user to avoid hitting the database
-        # everytime.
-        return frozenset([p.value for p in self.permissions])
+        permissions = self._permissions_cache.get(self.id)
+        if permissions is None:
+            permissions = self.get_permissions_for([self.id])[self.id]
+        return permissions
+
+    @classmethod
+    def get_permissions_for(cls, user_ids):
+        """
+        Returns a dictionary of the ids of the users and the frozenset of
+        the values of their permissions, reading the permissions which are
+        not cached in a single query.
+
+        :param user_ids: The ids of the users
+
+        .. versionadded:: 3.4.0.6
+        """
+        UserPermission = Pool().get('nereid.permission-nereid.user')
+        Permission = Pool().get('nereid.permission')
+
+        result = {}
+        missing = []
+        for user_id in user_ids:
+            permissions = cls._permissions_cache.get(user_id)
+            if permissions is None:
+                missing.append(user_id)
+            else:
+                result[user_id] = permissions
+        if not missing:
+            return result
+
+        cursor = Transaction().cursor
+        relation = UserPermission.__table__()
+        permission = Permission.__table__()
+        values = dict((user_id, set()) for user_id in missing)
+        for sub_ids in grouped_slice(missing):
+            cursor.execute(*relation.join(
+                permission, condition=relation.permission == permission.id
+            ).select(
+                relation.nereid_user, permission.value,
+                where=relation.nereid_user.in_(list(sub_ids))
+            ))
+            for user_id, value in cursor.fetchall():
+                values[user_id].add(value)
+
+        for user_id, permissions in values.iteritems():
+            result[user_id] = cls._permissions_cache.set(
+                user_id, frozenset(permissions)
+            )
+        return result
 
     def has_permissions(self, perm_all=None, perm_any=None):
         """Check if the user has all required permissions in perm_all and
@@ -679,6 +747,109 @@ class NereidUser(ModelSQL, ModelView):
 
         return None
 
+    #: The fields of the users read by :meth:`load_users`, which are kept
+    #: in the cache of loaded users
+    _load_fields = (
+        'active', 'display_name', 'email', 'email_verified', 'timezone',
+    )
+
+    #: The rows of the users loaded by :meth:`load_users` by id, with the
+    #: ids and names of their parties and the ids of their companies. The
+    #: cache is cleared when the users or parties are changed.
+    _load_cache = Cache('nereid.user.load', context=False)
+
+    @classmethod
+    def clear_load_cache(cls, *args):
+        """
+        A method which conveniently clears the cache of loaded users
+        """
+        cls._load_cache.clear()
+        if has_request_context():
+            request.__dictcache__.pop('nereid_user_rows', None)
+
+    @classmethod
+    def _get_load_rows(cls, user_ids):
+        """
+        Returns a dictionary of the ids of the users which exist and their
+        rows, looked up in the request, then in the cache of the process
+        and read for the others in a single query.
+        """
+        request_rows = {}
+        if has_request_context():
+            request_rows = request.__dictcache__.setdefault(
+                'nereid_user_rows', {}
+            )
+
+        result = {}
+        missing = []
+        for user_id in user_ids:
+            row = request_rows.get(user_id)
+            if row is None:
+                row = cls._load_cache.get(user_id)
+            if row is None:
+                missing.append(user_id)
+            else:
+                result[user_id] = row
+
+        if missing:
+            Party = Pool().get('party.party')
+            cursor = Transaction().cursor
+            user = cls.__table__()
+            party = Party.__table__()
+            names = ('id', 'party', 'company') + cls._load_fields
+            columns = [Column(user, name) for name in names] + [party.name]
+            for sub_ids in grouped_slice(missing):
+                cursor.execute(*user.join(
+                    party, condition=user.party == party.id
+                ).select(*columns, where=user.id.in_(list(sub_ids))))
+                for values in cursor.fetchall():
+                    row = dict(zip(names + ('party_name',), values))
+                    result[row['id']] = cls._load_cache.set(row['id'], row)
+
+        request_rows.update(result)
+        return result
+
+    @classmethod
+    def load_users(cls, user_ids):
+        """
+        Returns the users of the given ids which exist, active or not, in
+        the same order. The users, with the names of their parties and the
+        companies, are read in a single query and cached in the request and
+        the process, and the permissions in another, so that the users are
+        ready to use without further queries.
+
+        :param user_ids: The ids of the users
+
+        .. versionadded:: 3.4.0.6
+        """
+        pool = Pool()
+        Party = pool.get('party.party')
+        Company = pool.get('company.company')
+
+        user_ids = map(int, user_ids)
+        rows = cls._get_load_rows(user_ids)
+        ids = [user_id for user_id in user_ids if user_id in rows]
+        cls.get_permissions_for(ids)
+
+        # Records are created without the context of the caller, so that
+        # nested lookups are not made with its active_test for example
+        users = []
+        for user_id in ids:
+            row = rows[user_id]
+            user = cls(user_id, _ids=ids)
+            user._cache.setdefault(user_id, {}).update(
+                (name, row[name]) for name in cls._load_fields
+            )
+            party = Party(row['party'])
+            party._cache.setdefault(row['party'], {})['name'] = \
+                row['party_name']
+            user._local_cache[user_id] = {
+                'party': party,
+                'company': Company(row['company']),
+            }
+            users.append(user)
+        return users
+
     @classmethod
     def load_user(cls, user_id):
         """
@@ -687,17 +858,71 @@ class NereidUser(ModelSQL, ModelView):
         :param user_id: Unicode ID of the user
         """
         try:
-            with Transaction().set_context(active_test=False):
-                user, = cls.search([('id', '=', int(user_id))])
+            user_id = int(user_id)
         except ValueError:
             return None
+        users = cls.load_users([user_id])
+        return users[0] if users else None
+
+    #: The ids of the users authenticated by the credentials of the
+    #: Authorization header and the time until which they are valid, keyed
+    #: by an HMAC of the credentials so that they are not kept in memory.
+    #: The cache is cleared when users change.
+    _credentials_cache = Cache(
+        'nereid.user.credentials', size_limit=4096, context=False
+    )
+
+    @classmethod
+    def clear_credentials_cache(cls, *args):
+        """
+        A method which conveniently clears the cache of credentials
+        """
+        cls._credentials_cache.clear()
 
-        # Instead of returning the active record returned in the above search
-        # we are creating a new record here. This is because the returned
-        # active record seems to carry around the context setting of
-        # active_test and any nested lookup from the record will result in
-        # records being fetched which are inactive.
-        return cls(int(user_id))
+    @classmethod
+    def _get_credentials_key(cls, credentials):
+        """
+        Returns the key of the credentials in the cache, or None if the
+        cache is disabled
+        """
+        if not current_app.auth_cache_timeout:
+            return None
+        if isinstance(credentials, unicode):
+            credentials = credentials.encode('utf-8')
+        return hmac.new(
+            current_app.secret_key, credentials,
+            hashlib.sha256 if hashlib else sha
+        ).hexdigest()
+
+    @classmethod
+    def _load_user_from_credentials_cache(cls, key):
+        """
+        Returns the active user cached for the key of credentials, if any
+        """
+        if key is None:
+            return None
+        cached = cls._credentials_cache.get(key)
+        if cached is None:
+            return None
+        user_id, expires = cached
+        if expires < time.time():
+            return None
+        user = cls.load_user(user_id)
+        if user and user.is_active():
+            return user
+
+    @classmethod
+    def _cache_credentials(cls, key, user, expires=None):
+        """
+        Caches the user authenticated by the credentials of the key, until
+        the auth cache timeout or `expires` if it is sooner
+        """
+        if key is None:
+            return
+        until = time.time() + current_app.auth_cache_timeout
+        if expires is not None:
+            until = min(until, expires)
+        cls._credentials_cache.set(key, (user.id, until))
 
     @classmethod
     def load_user_from_header(cls, header_val):
@@ -708,6 +933,14 @@ class NereidUser(ModelSQL, ModelView):
         """
         # Basic authentication
         if header_val.startswith('Basic '):
+            # The users are looked up in the company of the website
+            key = cls._get_credentials_key('%s:%s' % (
+                request.nereid_website.company.id, header_val
+            ))
+            user = cls._load_user_from_credentials_cache(key)
+            if user:
+                return user
+
             header_val = header_val.replace('Basic ', '', 1)
             try:
                 header_val = base64.b64decode(header_val)
@@ -716,6 +949,7 @@ class NereidUser(ModelSQL, ModelView):
             else:
                 user = cls.authenticate(*header_val.split(':', 1))
                 if user and user.is_active():
+                    cls._cache_credentials(key, user)
                     return user
 
         # TODO: Digest authentication
@@ -734,13 +968,18 @@ class NereidUser(ModelSQL, ModelView):
 
         :param token: The token sent in the user's request
         """
+        key = cls._get_credentials_key('token:%s' % token)
+        user = cls._load_user_from_credentials_cache(key)
+        if user:
+            return user
+
         serializer = TimedJSONWebSignatureSerializer(
             current_app.secret_key,
             expires_in=current_app.token_validity_duration
         )
 
         try:
-            data = serializer.loads(token)
+            data, header = serializer.loads(token, return_header=True)
         except SignatureExpired:
             return None     # valid token, but expired
         except BadSignature:
@@ -754,6 +993,7 @@ class NereidUser(ModelSQL, ModelView):
 
         if user.is_active():
             # Login only if the login_user method returns True for the user
+            cls._cache_credentials(key, user, header.get('exp'))
             return user
 
     def get_auth_token(self):
@@ -840,6 +1080,11 @@ class NereidUser(ModelSQL, ModelView):
         :param vlist: List of dictionary of Values
         """
         vlist = [cls._convert_values(vals.copy()) for vals in vlist]
+        # The ids of users created in transactions which were rolled back
+        # may be used again
+        cls.clear_permissions_cache()
+        cls.clear_load_cache()
+        cls.clear_credentials_cache()
         return super(NereidUser, cls).create(vlist)
 
     @classmethod
@@ -847,10 +1092,226 @@ class NereidUser(ModelSQL, ModelView):
         """
         Update salt before saving
         """
+        cls.clear_load_cache()
+        # The credentials of the users could have changed, or the users
+        # been deactivated
+        cls.clear_credentials_cache()
         return super(NereidUser, cls).write(
             nereid_users, cls._convert_values(values), *args
         )
 
+    @classmethod
+    def delete(cls, nereid_users):
+        cls.clear_permissions_cache()
+        cls.clear_load_cache()
+        cls.clear_credentials_cache()
+        return super(NereidUser, cls).delete(nereid_users)
+
+    @classmethod
+    def import_users(cls, records, company=None, chunk_size=500,
+                     progress=None):
+        """
+        Imports users, with their parties and the contact mechanisms of
+        their emails, from an iterable of dictionaries with the keys:
+
+        * `email` (required)
+        * `name`: The name of the party, the display name by default
+        * `display_name`: The display name, the name by default
+        * `password`: The password in clear text
+        * `party`: The id of an existing party to use instead of a new one
+        * `active`, `email_verified` and `timezone`
+
+        The emails are stripped and lower cased. The records are read and
+        created in chunks of `chunk_size`, with a single `create` of the
+        parties, the contact mechanisms and the users of a chunk. The
+        records are checked before, and those which are invalid or whose
+        email is already used in the company are reported as errors and
+        skipped without aborting the import. If the creation of a chunk
+        fails anyway, it is undone and its records are created one by one
+        to report the records which fail.
+
+        Unlike :meth:`registration`, no signal is sent nor activation email.
+
+        :param records: An iterable of dictionaries
+        :param company: The id of the company of the users, the company of
+                        the context by default
+        :param chunk_size: The number of records created at once
+        :param progress: A function called after each chunk with the number
+                         of records processed, users created and errors
+        :return: A tuple of the list of the ids of the created users and the
+                 list of the errors as tuples of the index of the record and
+                 the message
+
+        .. versionadded:: 3.4.0.6
+        """
+        Party = Pool().get('party.party')
+
+        if company is None:
+            company = cls.default_company()
+        if not company:
+            raise ValueError('The company of the users is required')
+
+        user_ids, errors = [], []
+        seen = set()
+        timezones = set(pytz.common_timezones)
+        records = iter(records)
+        processed = 0
+        cursor = Transaction().cursor
+        user = cls.__table__()
+        while True:
+            chunk = list(islice(records, chunk_size))
+            if not chunk:
+                break
+
+            emails = [
+                (record.get('email') or '').strip().lower()
+                for record in chunk
+            ]
+            for sub_emails in grouped_slice(filter(None, emails)):
+                where = Lower(user.email).in_(list(sub_emails))
+                cursor.execute(*user.select(
+                    Lower(user.email), where=where & (user.company == company)
+                ))
+                seen.update(email for email, in cursor.fetchall())
+            with Transaction().set_context(active_test=False):
+                parties = set(party.id for party in Party.search([
+                    ('id', 'in', filter(None, [
+                        record.get('party') for record in chunk
+                    ])),
+                ]))
+
+            valid = []
+            for index, record, email in zip(
+                    count(processed), chunk, emails):
+                if not email or '@' not in email:
+                    errors.append((index, 'Invalid email: %r' % (
+                        record.get('email')
+                    )))
+                elif not (record.get('name') or record.get('display_name')):
+                    errors.append((index, 'Name is required: %s' % email))
+                elif email in seen:
+                    errors.append((index, 'Email already used: %s' % email))
+                elif record.get('party') and record['party'] not in parties:
+                    errors.append((index, 'Unknown party: %r' % (
+                        record['party']
+                    )))
+                elif record.get('timezone') and \
+                        record['timezone'] not in timezones:
+                    errors.append((index, 'Unknown timezone: %r' % (
+                        record['timezone']
+                    )))
+                else:
+                    seen.add(email)
+                    valid.append((index, dict(record, email=email)))
+            processed += len(chunk)
+
+            try:
+                with cls._import_savepoint():
+                    user_ids.extend(cls._import_chunk(
+                        [record for _, record in valid], company
+                    ))
+            except Exception:
+                for index, record in valid:
+                    try:
+                        with cls._import_savepoint():
+                            user_ids.extend(
+                                cls._import_chunk([record], company)
+                            )
+                    except Exception, exception:
+                        if isinstance(exception, UserError):
+                            exception = exception.message
+                        errors.append((index, 'Import failed: %s: %s' % (
+                            record['email'], exception
+                        )))
+            if progress is not None:
+                progress(processed, len(user_ids), len(errors))
+
+        errors.sort()
+        return user_ids, errors
+
+    @classmethod
+    @contextmanager
+    def _import_savepoint(cls):
+        """
+        Undo the records imported within if an exception is raised.
+
+        A savepoint is used where the backend supports it. The python driver
+        of SQLite commits before a savepoint, so instead the rows inserted
+        since the start are deleted. They are those of this transaction as
+        SQLite locks the database for writing until it ends.
+        """
+        pool = Pool()
+        cursor = Transaction().cursor
+
+        if backend.name() != 'sqlite':
+            cursor.execute('SAVEPOINT nereid_import_users')
+            try:
+                yield
+            except Exception:
+                cursor.execute('ROLLBACK TO SAVEPOINT nereid_import_users')
+                raise
+            cursor.execute('RELEASE SAVEPOINT nereid_import_users')
+            return
+
+        tables = [
+            pool.get(name).__table__() for name in (
+                'nereid.user', 'party.contact_mechanism', 'party.party'
+            )
+        ]
+        last_ids = []
+        for table in tables:
+            cursor.execute(*table.select(Max(table.id)))
+            last_ids.append(cursor.fetchone()[0] or 0)
+        try:
+            yield
+        except Exception:
+            for table, last_id in zip(tables, last_ids):
+                cursor.execute(*table.delete(where=table.id > last_id))
+            raise
+
+    @classmethod
+    def _import_chunk(cls, records, company):
+        """
+        Creates the parties, contact mechanisms and users of the checked
+        records and returns the ids of the users
+        """
+        pool = Pool()
+        Party = pool.get('party.party')
+        ContactMechanism = pool.get('party.contact_mechanism')
+
+        if not records:
+            return []
+
+        new = [record for record in records if not record.get('party')]
+        parties = []
+        if new:
+            parties = Party.create([{
+                'name': record.get('name') or record['display_name'],
+                'addresses': [],
+            } for record in new])
+            ContactMechanism.create([{
+                'party': party.id,
+                'type': 'email',
+                'value': record['email'],
+            } for record, party in zip(new, parties)])
+        party_ids = iter(party.id for party in parties)
+
+        vlist = []
+        for record in records:
+            values = {
+                'party': record.get('party') or next(party_ids),
+                'company': company,
+                'email': record['email'],
+                'display_name': (
+                    record.get('display_name') or record['name']
+                ),
+            }
+            for name in ('password', 'active', 'email_verified', 'timezone'):
+                if name in record:
+                    values[name] = record[name]
+            vlist.append(values)
+        return [user.id for user in cls.create(vlist)]
+
     @staticmethod
     def get_gravatar_url(email, **kwargs):
         """
@@ -988,6 +1449,21 @@ class Permission(ModelSQL, ModelView):
                 'Permissions must be unique by value'),
         ]
 
+    @classmethod
+    def create(cls, vlist):
+        Pool().get('nereid.user').clear_permissions_cache()
+        return super(Permission, cls).create(vlist)
+
+    @classmethod
+    def write(cls, permissions, values, *args):
+        Pool().get('nereid.user').clear_permissions_cache()
+        return super(Permission, cls).write(permissions, values, *args)
+
+    @classmethod
+    def delete(cls, permissions):
+        Pool().get('nereid.user').clear_permissions_cache()
+        return super(Permission, cls).delete(permissions)
+
 
 class UserPermission(ModelSQL):
     "Nereid User Permissions"
@@ -1001,3 +1477,20 @@ class UserPermission(ModelSQL):
         'nereid.user', 'User',
         ondelete='CASCADE', select=True, required=True
     )
+
+    @classmethod
+    def create(cls, vlist):
+        Pool().get('nereid.user').clear_permissions_cache()
+        return super(UserPermission, cls).create(vlist)
+
+    @classmethod
+    def write(cls, user_permissions, values, *args):
+        Pool().get('nereid.user').clear_permissions_cache()
+        return super(UserPermission, cls).write(
+            user_permissions, values, *args
+        )
+
+    @classmethod
+    def delete(cls, user_permissions):
+        Pool().get('nereid.user').clear_permissions_cache()
+        return super(UserPermission, cls).delete(user_permissions)